@@ -1,15 +1,28 @@
 #!/usr/bin/env python
 
+import argparse
 import ast
-import meta
+import copy
+import cPickle as pickle
+import emitter
+import fnmatch
+import hashlib
+import launcher
+import multiprocessing
 import os
 import re
 import sys
+import warnings
+from collections import Counter, defaultdict
 from cStringIO import StringIO
 from ply import yacc
 
 import pysh.pyshyacc as pyshyacc
+import profiling
 import pysh.interp as interp
+import shellsplit
+import transcache
+import varflow
 from m4 import Parser
 
 MACROS = [
@@ -109,53 +122,439 @@ MACROS = [
     'MOZ_DO_OUTPUT_SUBDIRS',
 ]
 
+# Macros whose handlers depend on or change MacroHandler state beyond the
+# thunks, substs and arguments they record. Their invocations, and those
+# of any macro whose arguments use them, are never cached.
+STATEFUL_MACROS = set([
+    # the AC_LANG language
+    'AC_LANG_SAVE',
+    'AC_LANG_RESTORE',
+    'AC_LANG_C',
+    'AC_LANG_CPLUSPLUS',
+    # compiler probes, which use the language and number their results
+    'AC_TRY_COMPILE',
+    'AC_TRY_LINK',
+    'AC_CHECK_HEADER',
+    'MOZ_CHECK_HEADER',
+    'MOZ_CHECK_HEADERS',
+    'AC_CHECK_FUNCS',
+    'AC_CHECK_LIB',
+    'MOZ_C_SUPPORTS_WARNING',
+    'MOZ_CXX_SUPPORTS_WARNING',
+    # these number their cache lookups
+    'AC_CACHE_VAL',
+    'AC_CACHE_CHECK',
+    # counts the sections of the script
+    'MOZ_ARG_HEADER',
+])
+
+# The test program of AC_TRY_COMPILE and AC_TRY_LINK.
+PROBE_PROGRAM = '''%(includes)s
+int main() {
+%(body)s
+; return 0; }
+'''
+
+# The test program of AC_CHECK_FUNCS and AC_CHECK_LIB, which declares the
+# function itself so that only linking can fail.
+FUNC_PROBE_PROGRAM = '''#include <assert.h>
+/* Override any gcc2 internal prototype to avoid an error.  */
+#ifdef __cplusplus
+extern "C"
+#endif
+char %(func)s();
+int main() {
+/* The GNU C library defines this for functions which it implements
+    to always fail with ENOSYS.  Some functions are actually named
+    something starting with __ and the normal name is an alias.  */
+#if defined (__stub_%(func)s) || defined (__stub___%(func)s)
+choke me
+#else
+%(func)s();
+#endif
+; return 0; }
+'''
+
+THUNK_RE = re.compile('__python(\d+)__')
+
+# m4 builtins whose expansion depends on more than the text of the macro
+# call they appear in: files and commands, which can change between
+# inputs, and the macro table, which the input's definitions change.
+# Macro arguments using them are never cached.
+IMPURE_M4_RE = re.compile(r'\b(include|sinclude|m4_include|m4_sinclude|syscmd|esyscmd|'
+                          r'define|undefine|pushdef|popdef|builtin|indir|'
+                          r'__file__|__line__)\b')
+
+# Entries of MacroHandler.arg_cache, after which it starts over.
+ARG_CACHE_SIZE = 10000
+
+# Command substitutions the generated script may memoize, as fnmatch
+# patterns of the command as written in configure.in, each with the
+# environment variables the command reads besides PATH and those named in
+# the command itself. Only commands without side effects belong here.
+DEFAULT_MEMOIZE = (
+    ('uname', ()),
+    ('uname -*', ()),
+    ('$CC -dumpversion', ()),
+    ('$CXX -dumpversion', ()),
+    ('$CC --version*', ('LANG', 'LC_ALL', 'LC_MESSAGES')),
+    ('$CXX --version*', ('LANG', 'LC_ALL', 'LC_MESSAGES')),
+    ('$CC -v 2>&1*', ('LANG', 'LC_ALL', 'LC_MESSAGES')),
+    ('$CXX -v 2>&1*', ('LANG', 'LC_ALL', 'LC_MESSAGES')),
+    ('$PYTHON -c *', ('PYTHONPATH', 'PYTHONHOME')),
+    ('basename *', ()),
+    ('dirname *', ()),
+    ('echo *', ()),
+    ('expr *', ()),
+)
+
+# Shell syntax that makes a command substitution unsafe to memoize whatever
+# pattern it matches, once any 2>&1 is removed: pipelines, redirections,
+# command lists, background jobs and nested substitutions. The patterns
+# only vouch for a single simple command.
+UNMEMOIZABLE_RE = re.compile(r'[;&`<>|]|\$\(')
+
+# Variables a command substitution can refer to, as $NAME or ${NAME}.
+VARIABLE_RE = re.compile(r'\$\{?([A-Za-z_][A-Za-z0-9_]*)')
+
+def code_size(code):
+    '''
+    Estimates the bytes of memory held by the syntax tree of a thunk.
+    '''
+    size = 0
+    for stmt in (code if isinstance(code, list) else [code]):
+        for node in ast.walk(stmt):
+            size += sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+    return size
+
+class UnusedThunkWarning(UserWarning):
+    '''
+    A translation finished with thunks left, whose code is missing from it.
+    '''
+
+class ThunkTable(object):
+    '''
+    The Python code of macro expansions, which the m4 output refers to with
+    [__pythonN__] placeholders. The translator takes each entry when it
+    reaches its placeholder, which drops it from the table, so only thunks
+    whose placeholders are still ahead of the translation are kept alive.
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+        self.entries = {}
+        self.sizes = {}
+        self.count = 0
+        self.pending_size = 0
+        # Entries taken since begin(), to put back on rollback().
+        self.taken = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, code):
+        index = self.count
+        self.count += 1
+        if code is None:
+            # Taken already, as replayed from the cache.
+            return index
+        self.entries[index] = code
+        self.sizes[index] = size = code_size(code)
+        self.pending_size += size
+        self.stats['thunks_created'] += 1
+        self.stats['thunks_peak_pending'] = max(self.stats['thunks_peak_pending'],
+                                                len(self.entries))
+        self.stats['thunks_peak_bytes'] = max(self.stats['thunks_peak_bytes'],
+                                              self.pending_size)
+        return index
+
+    def peek(self, index):
+        if index not in self.entries:
+            raise UnhandledTranslation('Python thunk %d was already used' % index)
+        return self.entries[index]
+
+    def take(self, index):
+        '''
+        Returns the code of a thunk, which can only be taken once.
+        '''
+        code = self.peek(index)
+        del self.entries[index]
+        self.pending_size -= self.sizes.pop(index)
+        if self.taken is not None:
+            self.taken.append((index, code))
+        return code
+
+    def since(self, start):
+        '''
+        Returns the entries from start on, with None for those taken.
+        '''
+        return [self.entries.get(i) for i in xrange(start, self.count)]
+
+    def begin(self):
+        '''
+        Keeps the entries taken from now on, until commit() or rollback().
+        '''
+        self.taken = []
+
+    def commit(self):
+        self.taken = None
+
+    def rollback(self):
+        for index, code in self.taken:
+            self.entries[index] = code
+            self.sizes[index] = size = code_size(code)
+            self.pending_size += size
+        self.taken = None
+
+    def discard(self):
+        '''
+        Drops the thunks left, when they were used elsewhere, as by the
+        worker processes of a parallel translation.
+        '''
+        self.entries.clear()
+        self.sizes.clear()
+        self.pending_size = 0
+
+    def finish(self):
+        '''
+        Drops the thunks left once a translation is done, counting them as
+        never used and warning about them.
+        '''
+        unused = sorted(self.entries)
+        self.stats['thunks_unused'] += len(unused)
+        self.discard()
+        if unused:
+            warnings.warn('Python thunks %s were never used' %
+                          ', '.join(str(i) for i in unused), UnusedThunkWarning)
+
+class ArgumentDef(object):
+    '''
+    A command line option of the generated script.
+    '''
+    __slots__ = ('arg', 'name', 'help', 'action')
+
+    def __init__(self, arg, name, help, action):
+        self.arg = arg
+        self.name = name
+        self.help = help
+        self.action = action
+
 class MacroHandler:
     def __init__(self):
-        self.expansions = []
         self.substs = set()
+        # ArgumentDefs of the generated script's options.
         self.args = []
+        self.macro_tables = {}
+        # m4 expansions of macro arguments of the current input, keyed on
+        # the unexpanded text. Only expansions that didn't call into any of
+        # our handlers or IMPURE_M4_RE builtins are stored, since those are
+        # free of side effects.
+        self.arg_cache = {}
+        self.handler_calls = 0
+        self.stateful_calls = 0
+        self.stats = Counter()
+        self.thunks = ThunkTable(self.stats)
+        # A transcache.TranslationCache for whole macro invocations, if any.
+        self.cache = None
+        self.profiler = None
+        self.lang = 'C'
+        self.lang_stack = []
+        self.probe_count = 0
+        self.cached_count = 0
+        self.section_count = 0
+        # The ShellTranslator for parse_shell, made when first needed.
+        self.shell_translator = None
+        # Allowlist of command substitutions to memoize, like DEFAULT_MEMOIZE.
+        self.memoize = DEFAULT_MEMOIZE
+
+    def get_macro_table(self, macros):
+        key = tuple(macros)
+        table = self.macro_tables.get(key)
+        if table is None:
+            table = {}
+            for m in macros:
+                if hasattr(self, m):
+                    table[m] = self.make_macro(m)
+                else:
+                    # for now replace all other macros with true so the shell parses
+                    table[m] = lambda x: '[true]'
+            self.macro_tables[key] = table
+        return table
 
     def add_macros(self, macros, p):
-        for m in macros:
-            if hasattr(self, m):
-                p.macros[m] = self.make_macro(m, p)
-            else:
-                # for now replace all other macros with true so the shell parses
-                p.macros[m] = lambda x: '[true]'
+        p.macros.update(self.get_macro_table(macros))
+
+    def make_parser(self, source):
+        '''
+        Returns an m4 Parser for source, with our quotes and MACROS.
+
+        A Parser can't be reused: it takes its input when it is created,
+        and expand_arg() runs inside the parse of the text the argument
+        came from, so that parser is still busy. The closures of the
+        macro table are built once and shared, and a new Parser only gets
+        a copy of the table's entries.
+        '''
+        self.stats['parsers_created'] += 1
+        p = Parser(source)
+        p.changequote('[',']')
+        self.add_macros(MACROS, p)
+        return p
 
-    def make_macro(self, macro, original_parser):
+    def make_macro(self, macro):
         def invoke(args):
-            return self.invoke_macro(macro, args, original_parser)
+            return self.invoke_macro(macro, args)
         return invoke
 
-    def invoke_macro(self, macro, args, original_parser):
-        parsed_args = []
-        for arg in args:
-            p = Parser(arg)
-            p.changequote('[',']')
-            macro_handler.add_macros(MACROS, p)
+    def invoke_macro(self, macro, args):
+        if self.profiler is None:
+            return self.dispatch_macro(macro, args)
+        start = self.profiler.enter()
+        try:
+            return self.dispatch_macro(macro, args)
+        finally:
+            self.profiler.leave('macros', macro, start)
+
+    def dispatch_macro(self, macro, args):
+        if macro in STATEFUL_MACROS:
+            self.stateful_calls += 1
+        elif self.cache is not None and not any(IMPURE_M4_RE.search(a) for a in args):
+            return self.invoke_cached(macro, args)
+        return self.call_handler(macro, args)
+
+    def call_handler(self, macro, args):
+        parsed_args = [self.expand_arg(arg) for arg in args]
+        self.handler_calls += 1
+        return getattr(self, macro)(parsed_args)
+
+    def invoke_cached(self, macro, args):
+        '''
+        Invokes a macro through self.cache. An entry records everything the
+        invocation did: the thunks it created, the substs and arguments it
+        added and the text it expanded to.
+        '''
+        key = self.cache.key('macro', macro, *args)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.handler_calls += 1
+            return self.replay(entry)
+        start = len(self.thunks)
+        substs = set(self.substs)
+        nargs = len(self.args)
+        stateful_calls = self.stateful_calls
+        result = self.call_handler(macro, args)
+        if self.stateful_calls == stateful_calls:
+            entry = self.make_cache_entry(result, start, substs, nargs)
+            if entry is not None:
+                self.cache.put(key, entry)
+        return result
+
+    def make_cache_entry(self, result, start, substs, nargs):
+        thunks = self.thunks.since(start)
+        # Thunk placeholders get renumbered when an entry is replayed, which
+        # only works for those in the returned text.
+        for m in THUNK_RE.finditer(result or ''):
+            if not start <= int(m.group(1)) < len(self.thunks):
+                return None
+        if any('__python' in dump_code(t) for t in thunks if t is not None):
+            return None
+        return (result, start, thunks, sorted(self.substs - substs), self.args[nargs:])
+
+    def replay(self, entry):
+        result, start, thunks, substs, args = entry
+        offset = len(self.thunks) - start
+        for thunk in thunks:
+            self.thunks.add(thunk)
+        self.substs.update(substs)
+        self.args.extend(args)
+        if result and offset:
+            result = THUNK_RE.sub(lambda m: '__python%d__' % (int(m.group(1)) + offset), result)
+        return result
+
+    def expand_arg(self, arg):
+        '''
+        Returns the m4 expansion of a single macro argument.
+        '''
+        expanded = self.arg_cache.get(arg)
+        if expanded is not None:
+            self.stats['arg_cache_hits'] += 1
+            return expanded
+        self.stats['arg_cache_misses'] += 1
+        handler_calls = self.handler_calls
+        with profiling.phase(self.profiler, 'macro arguments'):
+            p = self.make_parser(arg)
             stream = StringIO()
             p.parse(stream=stream)
-            parsed_args.append(stream.getvalue())
-        return getattr(self, macro)(parsed_args)
+            expanded = stream.getvalue()
+        if self.handler_calls == handler_calls and not IMPURE_M4_RE.search(arg):
+            if len(self.arg_cache) >= ARG_CACHE_SIZE:
+                self.arg_cache.clear()
+            self.arg_cache[arg] = expanded
+        return expanded
+
+    def reset(self):
+        '''
+        Forgets everything recorded for the previous input. The macro tables
+        stay valid and are kept.
+        '''
+        self.thunks = ThunkTable(self.stats)
+        self.arg_cache = {}
+        self.substs = set()
+        self.args = []
+        self.lang = 'C'
+        self.lang_stack = []
+        self.probe_count = 0
+        self.cached_count = 0
+        self.section_count = 0
 
-    def get_expansion(self, index):
-        return self.expansions[index]
+    # What reset() clears, besides the thunks.
+    SNAPSHOT_FIELDS = ('substs', 'args', 'lang', 'lang_stack', 'probe_count',
+                       'cached_count', 'section_count')
+
+    def snapshot(self):
+        '''
+        Returns the state recorded so far for the current input, pickled so
+        that every restore() gets a copy of its own to consume and modify.
+        '''
+        state = dict((name, getattr(self, name)) for name in self.SNAPSHOT_FIELDS)
+        thunks = self.thunks
+        state['thunks'] = (thunks.entries, thunks.sizes, thunks.count,
+                           thunks.pending_size)
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    def restore(self, snapshot):
+        '''
+        Starts a new input from the state returned by snapshot().
+        '''
+        self.arg_cache = {}
+        state = pickle.loads(snapshot)
+        entries, sizes, count, pending_size = state.pop('thunks')
+        self.thunks = ThunkTable(self.stats)
+        self.thunks.entries = entries
+        self.thunks.sizes = sizes
+        self.thunks.count = count
+        self.thunks.pending_size = pending_size
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
     def py(self, code):
         if isinstance(code, basestring):
             code = ast.parse(code).body
-        index = len(self.expansions)
-        self.expansions.append(code)
-        return '[__python%d__]' % index
+        return '[__python%d__]' % self.thunks.add(code)
 
     def AC_SUBST(self, args):
         self.substs.add(args[0])
 
-    def ac_msg(self, msg):
+    def msg_code(self, msg):
         expr = ast.parse('sys.stdout.write()').body[0]
         expr.value.args = [ast.Str(msg + '\n')]
-        return self.py(expr)
+        return expr
+
+    def ac_msg(self, msg):
+        return self.py(self.msg_code(msg))
+
+    def msg_var(self, var):
+        expr = ast.parse('sys.stdout.write(vars.get("", "") + "\\n")').body[0]
+        expr.value.args[0].left.args[0].s = var
+        return expr
 
     def AC_MSG_CHECKING(self, args):
         return self.ac_msg('configure: checking ' + args[0])
@@ -176,14 +575,20 @@ class MacroHandler:
         return self.py(code)
 
     def parse_shell(self, shell):
-        translator = ShellTranslator(self, None)
-        return translator.translate(shell)
+        '''
+        Translates shell code in a macro argument, with one translator
+        shared by all macros.
+        '''
+        if self.shell_translator is None:
+            self.shell_translator = ShellTranslator(self, None)
+        self.shell_translator.profiler = self.profiler
+        return self.shell_translator.translate(shell)
 
     help_re = re.compile(r'^\s*--[a-z-]+\s+')
     def add_argument(self, arg, name, action, help, if_given, if_not_given):
         help = self.help_re.sub('', help)
         name = re.sub(r'[^\w]', '_', name)
-        self.args.append((arg, name, help, action))
+        self.args.append(ArgumentDef(arg, name, help, action))
         if if_given:
             if_given = self.parse_shell(if_given)
         else:
@@ -197,11 +602,233 @@ class MacroHandler:
                      if_not_given)
         return self.py(if_)
 
+    def MOZ_ARG_HEADER(self, args):
+        self.section_count += 1
+        return self.py([SectionBreak(args[0] if args else '')])
+
     def MOZ_ARG_ENABLE_BOOL(self, args):
         if_given = args[2] if len(args) > 2 else None
         if_not_given = args[3] if len(args) > 3 else None
         return self.add_argument('--enable-%s' % args[0], args[0], 'store_true', args[1], if_given, if_not_given)
 
+    def AC_LANG_C(self, args):
+        self.lang = 'C'
+
+    def AC_LANG_CPLUSPLUS(self, args):
+        self.lang = 'C++'
+
+    def AC_LANG_SAVE(self, args):
+        self.lang_stack.append(self.lang)
+
+    def AC_LANG_RESTORE(self, args):
+        if self.lang_stack:
+            self.lang = self.lang_stack.pop()
+
+    def shell_action(self, args, index):
+        '''
+        Returns the translation of the optional shell code in args[index].
+        '''
+        if len(args) > index and args[index].strip():
+            return self.parse_shell(args[index])
+        return []
+
+    def set_var(self, var, value):
+        assign = ast.parse('vars[""] = ""').body[0]
+        assign.targets[0].slice.value.s = var
+        assign.value.s = value
+        return assign
+
+    def append_var(self, var, value):
+        assign = ast.parse('vars[""] = Format("")(vars, {})').body[0]
+        assign.targets[0].slice.value.s = var
+        assign.value.func.args[0].s = value
+        return assign
+
+    def probe(self, kind, source, found, notfound, libs='', flags='', lang=None):
+        '''
+        Returns statements starting a compiler probe, and running found or
+        notfound once its result is in. The probe is started by an
+        assignment of its own, which hoist_probes moves as early as it can.
+        '''
+        name = '_probe%d' % self.probe_count
+        self.probe_count += 1
+        submit = ast.parse('%s = probes.submit(vars)' % name).body[0]
+        submit.value.args.extend(ast.Str(a) for a in
+                                 (lang or self.lang, kind, source, libs, flags))
+        test = ast.parse('%s.get()' % name).body[0].value
+        return [submit, ast.If(test, found or [ast.Pass()], notfound)]
+
+    def cached(self, var, statements):
+        '''
+        Returns statements that take the value of var from the config cache
+        or, if it isn't there, run statements to set it and cache it.
+        '''
+        name = '_cached%d' % self.cached_count
+        self.cached_count += 1
+        code = ast.parse('%s = config_cache.lookup(vars, "")\n'
+                         'if %s is None:\n'
+                         '    config_cache.store(vars, "")\n'
+                         'else:\n'
+                         '    vars[""] = %s' % (name, name, name)).body
+        lookup, if_ = code
+        lookup.value.args[1].s = var
+        if_.body[0].value.args[1].s = var
+        if_.body[0:0] = statements
+        if_.orelse[0].targets[0].slice.value.s = var
+        return code
+
+    def checked_probe(self, checking, cache_var, kind, source, found, notfound,
+                      libs='', flags='', lang=None):
+        '''
+        Returns statements reporting and caching the result of a probe in
+        cache_var as yes or no, like the AC_CHECK_* macros, and then
+        running found or notfound.
+        '''
+        code = [self.msg_code('configure: checking ' + checking)]
+        code.extend(self.cached(cache_var,
+                                self.probe(kind, source,
+                                           [self.set_var(cache_var, 'yes')],
+                                           [self.set_var(cache_var, 'no')],
+                                           libs, flags, lang)))
+        code.append(self.msg_var(cache_var))
+        if found or notfound:
+            test = ast.parse('vars.get("", "") == "yes"').body[0].value
+            test.left.args[0].s = cache_var
+            code.append(ast.If(test, found or [ast.Pass()], notfound))
+        return code
+
+    def AC_CACHE_VAL(self, args):
+        return self.py(self.cached(args[0], self.shell_action(args, 1)))
+
+    def AC_CACHE_CHECK(self, args):
+        code = [self.msg_code('configure: checking ' + args[0])]
+        code.extend(self.cached(args[1], self.shell_action(args, 2)))
+        code.append(self.msg_var(args[1]))
+        return self.py(code)
+
+    def try_program(self, kind, args):
+        source = PROBE_PROGRAM % {'includes': args[0], 'body': args[1] if len(args) > 1 else ''}
+        return self.py(self.probe(kind, source,
+                                  self.shell_action(args, 2),
+                                  self.shell_action(args, 3)))
+
+    def AC_TRY_COMPILE(self, args):
+        return self.try_program('compile', args)
+
+    def AC_TRY_LINK(self, args):
+        return self.try_program('link', args)
+
+    def check_header(self, header, found, notfound, includes=''):
+        safe = header.replace('.', '_').replace('/', '_').replace('+', 'p').replace('-', '_')
+        source = PROBE_PROGRAM % {'includes': '%s\n#include <%s>' % (includes, header), 'body': ''}
+        return self.checked_probe('for ' + header, 'ac_cv_header_' + safe, 'compile',
+                                  source, found, notfound)
+
+    def AC_CHECK_HEADER(self, args):
+        return self.py(self.check_header(args[0], self.shell_action(args, 1),
+                                         self.shell_action(args, 2)))
+
+    def MOZ_CHECK_HEADER(self, args):
+        return self.py(self.check_header(args[0], self.shell_action(args, 1),
+                                         self.shell_action(args, 2),
+                                         args[3] if len(args) > 3 else ''))
+
+    def MOZ_CHECK_HEADERS(self, args):
+        # Translate the actions once: the macros in them are expanded, and
+        # their thunks taken, only once.
+        found = self.shell_action(args, 1)
+        notfound = self.shell_action(args, 2)
+        code = []
+        for header in args[0].split():
+            code.append(self.set_var('ac_hdr', header))
+            code.extend(self.check_header(header, copy.deepcopy(found),
+                                          copy.deepcopy(notfound),
+                                          args[3] if len(args) > 3 else ''))
+        return self.py(code)
+
+    def AC_CHECK_FUNCS(self, args):
+        found = self.shell_action(args, 1)
+        notfound = self.shell_action(args, 2)
+        code = []
+        for func in args[0].split():
+            code.append(self.set_var('ac_func', func))
+            code.extend(self.checked_probe('for ' + func, 'ac_cv_func_' + func, 'link',
+                                           FUNC_PROBE_PROGRAM % {'func': func},
+                                           copy.deepcopy(found),
+                                           copy.deepcopy(notfound)))
+        return self.py(code)
+
+    def AC_CHECK_LIB(self, args):
+        lib, func = args[0], args[1]
+        found = self.shell_action(args, 2)
+        if len(args) < 3 or not args[2].strip():
+            found = [self.append_var('LIBS', '-l%s {LIBS}' % lib)]
+        libs = '-l%s %s' % (lib, args[4] if len(args) > 4 else '')
+        return self.py(self.checked_probe('for %s in -l%s' % (func, lib),
+                                          'ac_cv_lib_%s_%s' % (lib, func), 'link',
+                                          FUNC_PROBE_PROGRAM % {'func': func},
+                                          found, self.shell_action(args, 3), libs.strip()))
+
+    def supports_warning(self, lang, flags_var, args):
+        prefix, warning, var = args[0], args[1], args[2]
+        found = [self.append_var(flags_var, '{%s} %s%s' % (flags_var, prefix, warning))]
+        source = PROBE_PROGRAM % {'includes': '', 'body': 'return(0);'}
+        return self.py(self.checked_probe('whether the %s compiler supports %s%s' %
+                                          (lang, prefix, warning),
+                                          var, 'compile', source, found, [],
+                                          flags='-Werror -W' + warning, lang=lang))
+
+    def MOZ_C_SUPPORTS_WARNING(self, args):
+        return self.supports_warning('C', '_WARNINGS_CFLAGS', args)
+
+    def MOZ_CXX_SUPPORTS_WARNING(self, args):
+        return self.supports_warning('C++', '_WARNINGS_CXXFLAGS', args)
+
+    def format_arg(self, text):
+        '''
+        Returns an expression expanding the variables in a macro argument.
+        '''
+        template = expand_simple(text.strip(), {}, '')
+        if template is None:
+            template = varflow.escape(text.strip())
+        expr = ast.parse('Format("")(vars, {})').body[0].value
+        expr.func.args[0].s = template
+        return expr
+
+    def find_program(self, function, args):
+        '''
+        Returns code setting the variable args[0] with function of the
+        generated script's Programs to one of the programs in args[1], or
+        to args[2] if there are none in the path args[3] or PATH.
+        '''
+        var = args[0].strip()
+        code = [self.msg_code('configure: checking for ' + args[1].strip())]
+        assign = ast.parse('vars[""] = programs.%s(vars.get("", ""))' % function).body[0]
+        assign.targets[0].slice.value.s = var
+        call = assign.value
+        call.args[0].args[0].s = var
+        call.args.append(self.format_arg(args[1]))
+        call.args.append(self.format_arg(args[2] if len(args) > 2 else ''))
+        if len(args) > 3 and args[3].strip():
+            call.args.append(self.format_arg(args[3]))
+        else:
+            call.args.append(ast.parse('vars.get("PATH", "")').body[0].value)
+        code.append(assign)
+        code.append(self.msg_var(var))
+        return self.py(code)
+
+    def AC_PATH_PROG(self, args):
+        return self.find_program('path_prog', args)
+
+    def MOZ_PATH_PROG(self, args):
+        return self.find_program('path_prog', args)
+
+    def MOZ_PATH_PROGS(self, args):
+        return self.find_program('path_prog', args)
+
+    def AC_CHECK_PROGS(self, args):
+        return self.find_program('check_prog', args)
+
 
 # Parser for test(1) expressions
 SPECIAL = {
@@ -237,23 +864,25 @@ class PLYCompatToken(object):
 
 class Lexer:
     def __init__(self, tokens):
-        self._tokens = tokens
+        self._tokens = iter(tokens)
 
     def token(self):
-        if not self._tokens:
+        t = next(self._tokens, None)
+        if t is None:
             return None
-        t = self._tokens.pop(0)
         return PLYCompatToken(SPECIAL.get(t, 'WORD'), t)
 
 class TestParser:
     tokens = ['WORD'] + SPECIAL.values()
 
-    def __init__(self, translator, tokens, vars, cmds):
-        yacc.yacc(module=self)
-        self.translator = translator
-        self._input = tokens
-        self.vars = vars
-        self.cmds = cmds
+    def __init__(self):
+        # Building the LALR tables is by far the most expensive part of
+        # parsing a test expression, so do it exactly once and keep the
+        # tables in memory instead of round-tripping through parsetab.py.
+        self._parser = yacc.yacc(module=self, write_tables=False, debug=False)
+        self.translator = None
+        self.vars = None
+        self.cmds = None
 
     def word(self, w):
         return self.translator.translate_value(w, self.vars, self.cmds)
@@ -323,10 +952,37 @@ class TestParser:
             expr.value.args = [self.word(p[2])]
             p[0] = expr.value
 
-    def parse(self):
-        lexer = Lexer(self._input)
-        ret = yacc.parse(lexer=lexer)
-        return ret
+    def p_error(self, p):
+        if p is None:
+            raise UnhandledTranslation('Unexpected end of test expression')
+        raise UnhandledTranslation('Syntax error in test expression at %r' % p.value)
+
+    def parse(self, translator, tokens, vars, cmds):
+        self.translator = translator
+        self.vars = vars
+        self.cmds = cmds
+        try:
+            return self._parser.parse(lexer=Lexer(tokens))
+        except:
+            # Don't leave a half-parsed expression on the stacks for
+            # whoever uses the shared parser next.
+            self._parser.restart()
+            raise
+        finally:
+            self.translator = None
+            self.vars = None
+            self.cmds = None
+
+_test_parser = None
+
+def get_test_parser():
+    '''
+    Returns the TestParser shared by every translation in this process.
+    '''
+    global _test_parser
+    if _test_parser is None:
+        _test_parser = TestParser()
+    return _test_parser
 
 class UnhandledTranslation(Exception):
     def __init__(self, msg, thing=None):
@@ -347,7 +1003,583 @@ class UnhandledTranslation(Exception):
                 m += ': ' + s.getvalue()
         return m
 
-flatten=lambda l: sum(map(flatten,l),[]) if isinstance(l,list) else [l]
+def iflatten(l):
+    '''
+    Yields the non-list items of a nested list, in order, in time linear
+    in the number of items.
+    '''
+    if not isinstance(l, list):
+        yield l
+        return
+    stack = [iter(l)]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, list):
+                stack.append(iter(x))
+                break
+            yield x
+        else:
+            stack.pop()
+
+def flatten(l):
+    return list(iflatten(l))
+
+# The variables probes.submit() reads the compiler and its flags from,
+# which are also those config_cache.lookup() fingerprints. The probes'
+# commands get no other variables of the script (PROBE_ENV in template.py).
+PROBE_INPUTS = set(['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LIBS', 'PATH'])
+
+# Calls in generated code that a compiler probe may be started ahead of.
+# Anything running a command could create or remove files the probe uses,
+# and a probe started ahead of an exit would run for nothing.
+PROBE_HOIST_SAFE_CALLS = set([
+    'Format',
+    'Format()',
+    'CaseDispatch',
+    'CaseDispatch()',
+    'for_loop',
+    'quoted',
+    'vars.get',
+    'exports.add',
+    'os.path.isdir',
+    'os.path.isfile',
+    'os.path.exists',
+    'os.path.dirname',
+    'sys.stdout.write',
+    'sys.stderr.write',
+    'probes.submit',
+    'config_cache.lookup',
+    'config_cache.store',
+    'substitutions.output',
+])
+
+def is_hoistable(stmt):
+    '''
+    Returns whether stmt starts a compiler probe or looks up the config
+    cache, or does so under a cache miss test.
+    '''
+    if isinstance(stmt, ast.If):
+        return (is_cache_miss_test(stmt.test) and len(stmt.body) == 1 and
+                not stmt.orelse and is_hoistable(stmt.body[0]))
+    return (isinstance(stmt, ast.Assign) and isinstance(stmt.value, ast.Call) and
+            varflow.call_name(stmt.value) in ('probes.submit', 'config_cache.lookup'))
+
+def is_cache_miss_test(test):
+    return (isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and
+            test.left.id.startswith('_cached') and isinstance(test.ops[0], ast.Is))
+
+class ProbeHoister(object):
+    '''
+    Moves the statements starting compiler probes and looking up the config
+    cache, in statements and in the bodies nested in them, as early as they
+    can go, so that probes run while the script does other things. They
+    don't move past anything that runs a command or sets one of
+    PROBE_INPUTS. A probe that only runs on a cache miss moves out of the
+    cache miss test, and keeps the test.
+
+    Statements are added one at a time, and given back as soon as nothing
+    added later can move before them, so only the statements since the
+    last one nothing can pass are held.
+    '''
+    def __init__(self):
+        self.pending = []
+        self.transparent = {}
+
+    def is_transparent(self, stmt):
+        ok = self.transparent.get(id(stmt))
+        if ok is None:
+            written = varflow.written_vars(stmt)
+            ok = (written is not None and not written & PROBE_INPUTS and
+                  all(name in PROBE_HOIST_SAFE_CALLS or
+                      (name and name.startswith('_probe') and name.endswith('.get'))
+                      for name in varflow.calls(stmt)))
+            self.transparent[id(stmt)] = ok
+        return ok
+
+    def can_pass(self, stmt, names):
+        return self.is_transparent(stmt) and not varflow.assigned_names(stmt) & names
+
+    def hoist(self, stmt):
+        # Stopping at the previous hoisted statement keeps probes in the
+        # order of the script, which is the order they are waited for.
+        names = varflow.loaded_names(stmt)
+        result = self.pending
+        i = len(result)
+        while i and not is_hoistable(result[i - 1]) and self.can_pass(result[i - 1], names):
+            i -= 1
+        result.insert(i, stmt)
+
+    def add(self, stmt):
+        '''
+        Adds the next statement. Returns the statements that are now in
+        their final place.
+        '''
+        for field in ('body', 'orelse'):
+            body = getattr(stmt, field, None)
+            if isinstance(body, list) and body:
+                setattr(stmt, field, hoist_probes(body))
+        if is_hoistable(stmt):
+            self.hoist(stmt)
+        else:
+            if isinstance(stmt, ast.If) and is_cache_miss_test(stmt.test):
+                while len(stmt.body) > 1 and is_hoistable(stmt.body[0]):
+                    self.hoist(ast.If(copy.deepcopy(stmt.test), [stmt.body.pop(0)], []))
+            self.pending.append(stmt)
+        # Nothing moves before the last statement that can't be passed.
+        for i in reversed(xrange(len(self.pending))):
+            stmt = self.pending[i]
+            if is_hoistable(stmt) or not self.is_transparent(stmt):
+                return self.release(i + 1)
+        return []
+
+    def release(self, count):
+        ready = self.pending[:count]
+        del self.pending[:count]
+        # ids of released statements may be reused by new ones
+        for stmt in ready:
+            self.transparent.pop(id(stmt), None)
+        return ready
+
+    def flush(self):
+        '''
+        Returns the statements still held, once there are no more.
+        '''
+        return self.release(len(self.pending))
+
+def hoist_probes(statements):
+    '''
+    Runs a ProbeHoister over a complete list of statements.
+    '''
+    hoister = ProbeHoister()
+    result = []
+    for stmt in statements:
+        result.extend(hoister.add(stmt))
+    result.extend(hoister.flush())
+    return result
+
+# Local names of generated code that only the statements right after their
+# assignment use: the word and the matching arm of a case statement, and
+# the results of probes and cache lookups. A unit can keep them to itself.
+UNIT_LOCAL_RE = re.compile(r'^(case|_arm|_probe\d+|_cached\d+)$')
+
+# Calls a unit may make: none of them has effects beyond vars, the config
+# cache and configure messages.
+UNIT_SAFE_CALLS = set([
+    'Format',
+    'Format()',
+    'CaseDispatch',
+    'CaseDispatch()',
+    'for_loop',
+    'quoted',
+    'vars.get',
+    'sys.stdout.write',
+    'probes.submit',
+    'config_cache.lookup',
+    'config_cache.store',
+    'programs.path_prog',
+    'programs.check_prog',
+])
+
+# Statements a unit can't hold.
+UNIT_UNSAFE_NODES = (ast.Return, ast.Raise, ast.Global, ast.FunctionDef,
+                     ast.ClassDef, ast.Exec, ast.Import, ast.ImportFrom)
+
+def unit_call_reads(call):
+    '''
+    Returns the variables that a call passed vars reads, for
+    varflow.read_vars. Probes and the config cache read PROBE_INPUTS, and
+    the cache the variable it is asked about too.
+    '''
+    name = varflow.call_name(call)
+    if name == 'probes.submit':
+        return PROBE_INPUTS
+    if name in ('config_cache.lookup', 'config_cache.store'):
+        if len(call.args) > 1 and isinstance(call.args[1], ast.Str):
+            return PROBE_INPUTS | set([call.args[1].s])
+    return None
+
+def is_unit_safe_call(name):
+    return (name in UNIT_SAFE_CALLS or
+            (name is not None and name.startswith('_probe') and name.endswith('.get')))
+
+def is_message(stmt):
+    return (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call) and
+            varflow.call_name(stmt.value) == 'sys.stdout.write')
+
+def is_checking_message(stmt):
+    if not is_message(stmt) or not stmt.value.args:
+        return False
+    arg = stmt.value.args[0]
+    return isinstance(arg, ast.Str) and arg.s.startswith('configure: checking ')
+
+class UnitBuilder(object):
+    '''
+    Turns the top-level statements of main() that only compute configure
+    variables into units, for --lazy: functions that the generated script
+    runs once a later statement needs a variable they set, or is about to
+    change one they use. Statements get a units.need() for the units they
+    depend on right before them, inside the branches of ifs, so a check
+    whose results are only used under a disabled option never runs. At the
+    end, the units setting AC_SUBST variables run.
+
+    A unit is a run of statements that set variables and write messages,
+    and nothing else. Statements are joined into one unit by the local
+    names one passes to the next, like a probe and the test of its result,
+    and a check takes the messages announcing and reporting it along.
+
+    Statements are added one at a time, and given back with the next
+    statement that isn't part of the same unit.
+    '''
+    def __init__(self, substs, stats):
+        self.substs = substs
+        self.stats = stats
+        # [statement, reads, writes, deferrable, assigned names] of the
+        # statements of the unit being built
+        self.group = []
+        # Units that may not have run yet, by id, with the ids of the units
+        # writing and reading each variable.
+        self.live = set()
+        self.writers = defaultdict(list)
+        self.readers = defaultdict(list)
+        self.count = 0
+        # Local names assigned outside of units so far, except UNIT_LOCAL_RE
+        # ones.
+        self.assigned = set()
+
+    def analyze(self, stmt):
+        reads = varflow.read_vars(stmt, unit_call_reads)
+        writes = varflow.written_vars(stmt)
+        assigned = varflow.assigned_names(stmt)
+        deferrable = (reads is not None and writes is not None and
+                      all(UNIT_LOCAL_RE.match(n) for n in assigned) and
+                      not varflow.loaded_names(stmt) & self.assigned and
+                      all(is_unit_safe_call(name) for name in varflow.calls(stmt)) and
+                      not any(isinstance(n, UNIT_UNSAFE_NODES) or
+                              (isinstance(n, ast.Print) and n.dest is not None)
+                              for n in ast.walk(stmt)))
+        return [stmt, reads, writes, deferrable, assigned]
+
+    def joins(self, item):
+        stmt, reads, writes, deferrable, assigned = item
+        if varflow.loaded_names(stmt) & set().union(*[i[4] for i in self.group]):
+            return True
+        if not deferrable:
+            return False
+        if all(is_message(i[0]) for i in self.group):
+            # the check a message announces
+            return is_checking_message(self.group[-1][0]) and not is_message(stmt)
+        if is_message(stmt):
+            # a message reporting the result
+            written = set().union(*[i[2] or set() for i in self.group])
+            return bool(reads) and reads <= written
+        return False
+
+    def add(self, stmt):
+        '''
+        Adds the next statement. Returns the statements that are now final.
+        '''
+        item = self.analyze(stmt)
+        if self.group and self.joins(item):
+            self.group.append(item)
+            return []
+        ready = self.flush()
+        self.group = [item]
+        return ready
+
+    def flush(self):
+        '''
+        Returns the statements still held.
+        '''
+        group, self.group = self.group, []
+        if not group:
+            return []
+        statements = [i[0] for i in group]
+        if all(i[3] for i in group):
+            reads = set().union(*[i[1] for i in group])
+            writes = set().union(*[i[2] for i in group])
+            assigned = set().union(*[i[4] for i in group])
+            passed = set(n for s in statements for n in varflow.loaded_names(s)
+                         if UNIT_LOCAL_RE.match(n))
+            if writes and passed <= assigned and not all(is_message(s) for s in statements):
+                return self.make_unit(statements, reads, writes)
+        for i in group:
+            self.assigned.update(n for n in i[4] if not UNIT_LOCAL_RE.match(n))
+        return self.with_needs(statements, True)
+
+    def finish(self):
+        '''
+        Returns the statements still held, and one running the units that
+        set AC_SUBST variables and waiting for those still running.
+        '''
+        ready = self.flush()
+        if self.count:
+            finish = ast.parse('units.finish([])').body[0]
+            finish.value.args[0].elts = [ast.Num(i) for i in
+                                         self.needs(set(self.substs), set())]
+            ready.append(finish)
+        return ready
+
+    def make_unit(self, statements, reads, writes):
+        id = self.count
+        self.count += 1
+        self.stats['units'] += 1
+        depends = set()
+        function = ast.parse('def _unit(): pass').body[0]
+        function.name = '_unit%d' % id
+        function.body = self.with_needs(statements, False, depends)
+        add = ast.parse('units.add(0, [], _unit)').body[0]
+        add.value.args = [ast.Num(id),
+                          ast.List([ast.Num(d) for d in sorted(depends)], ast.Load()),
+                          ast.Name(function.name, ast.Load())]
+        self.live.add(id)
+        for var in writes:
+            self.writers[var].append(id)
+        for var in reads:
+            self.readers[var].append(id)
+        return [function, add]
+
+    def needs(self, reads, writes):
+        '''
+        Returns the ids of the units that have to run before code reading
+        and writing the given variables, or None for all of them.
+        '''
+        if reads is None or writes is None:
+            if not self.live:
+                return []
+            return None
+        ids = set()
+        for var in reads | writes:
+            ids.update(self.writers.get(var, ()))
+        for var in writes:
+            ids.update(self.readers.get(var, ()))
+        return sorted(ids & self.live)
+
+    def need_call(self, ids):
+        expr = ast.parse('units.need([])').body[0]
+        expr.value.args[0].elts = [ast.Num(i) for i in ids]
+        return expr
+
+    def with_needs(self, body, top, depends=None):
+        '''
+        Returns body with units.need() calls for the units its statements
+        depend on. At the top level, these units are sure to have run
+        afterwards. For the body of a unit, the units its statements always
+        depend on are added to depends instead.
+        '''
+        out = []
+        for stmt in body:
+            if isinstance(stmt, ast.If):
+                ids = self.needs(varflow.read_vars(stmt.test, unit_call_reads),
+                                 varflow.written_vars(stmt.test))
+                stmt.body = self.with_needs(stmt.body, False)
+                stmt.orelse = self.with_needs(stmt.orelse, False)
+            else:
+                ids = self.needs(varflow.read_vars(stmt, unit_call_reads),
+                                 varflow.written_vars(stmt))
+            if depends is not None:
+                # A unit's variables are all known, so ids isn't None.
+                depends.update(ids)
+            elif ids is None:
+                out.append(ast.parse('units.need_all()').body[0])
+                if top:
+                    self.live.clear()
+                    self.writers.clear()
+                    self.readers.clear()
+            elif ids:
+                out.append(self.need_call(ids))
+                if top:
+                    self.live.difference_update(ids)
+            out.append(stmt)
+        return out
+
+class SectionBreak(ast.stmt):
+    '''
+    Marks where MOZ_ARG_HEADER starts a section of the script. Package
+    output starts a new module at those at the top level; everywhere else
+    they are removed.
+    '''
+    _fields = ('title',)
+
+    def __init__(self, title=''):
+        self.title = title
+
+class SectionBreakRemover(ast.NodeTransformer):
+    def visit_SectionBreak(self, node):
+        return None
+
+    def generic_visit(self, node):
+        ast.NodeTransformer.generic_visit(self, node)
+        if isinstance(getattr(node, 'body', None), list) and not node.body:
+            node.body = [ast.Pass()]
+        return node
+
+# Constructors whose calls with constant arguments hoist_constants moves to
+# module level, and the prefix of the names it gives them.
+CONSTANT_CONSTRUCTORS = {
+    'Format': '_format',
+    'CaseDispatch': '_case',
+}
+
+class ConstantHoister(ast.NodeTransformer):
+    def __init__(self):
+        self.names = {}
+        self.definitions = []
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        name = varflow.call_name(node)
+        if name not in CONSTANT_CONSTRUCTORS or node.keywords or node.starargs or node.kwargs:
+            return node
+        if not all(varflow.is_literal(a) for a in node.args):
+            return node
+        key = (name, dump_code(node.args))
+        constant = self.names.get(key)
+        if constant is None:
+            constant = '%s%d' % (CONSTANT_CONSTRUCTORS[name], len(self.definitions))
+            self.names[key] = constant
+            self.definitions.append(ast.Assign([ast.Name(constant, ast.Store())], node))
+        return ast.Name(constant, ast.Load())
+
+def hoist_constants(module, function):
+    '''
+    Replaces calls of CONSTANT_CONSTRUCTORS with constant arguments in
+    function, such as the Format()s of the strings the script expands, with
+    module-level constants, so their work is done once when the script
+    starts. Identical calls share a constant. Constants are numbered in the
+    order they first appear, and defined right before the
+    `if __name__ == '__main__'` block at the end of the module.
+    '''
+    hoister = ConstantHoister()
+    hoister.visit(function)
+    module.body[-1:-1] = hoister.definitions
+
+class SectionModule(object):
+    '''
+    Writes a section of package output: a module whose run() function,
+    taking main()'s local variables as arguments, holds the statements of
+    the section.
+    '''
+    def __init__(self, path, parameters, title):
+        self.file = open(path, 'w')
+        # The package's __init__ is the template.
+        self.file.write('from . import *\n')
+        run = ast.parse('def run(): pass').body[0]
+        run.args.args = [ast.Name(p, ast.Param()) for p in parameters]
+        run.body = []
+        self.emitter = emitter.SourceEmitter(ast.Module([run]), run, self.file)
+        self.emitter.begin()
+        self.constants = ConstantHoister()
+        self.empty = True
+        if title:
+            self.write(ast.Expr(ast.Str(title)))
+
+    def write(self, stmt):
+        self.emitter.write(self.constants.visit(stmt))
+        self.empty = False
+
+    def close(self):
+        if self.empty:
+            self.emitter.write(ast.Pass())
+        self.emitter.finish(self.constants.definitions)
+        self.file.close()
+
+# __main__ of package output, to run it with python -m or as python DIR. It
+# loads the package under a fixed name, as DIR needn't be a module name
+# (configure.py, my-configure).
+PACKAGE_MAIN = '''import imp
+import os
+import sys
+
+package = os.path.dirname(os.path.abspath(__file__))
+imp.load_module('configure_package', None, package,
+                ('', '', imp.PKG_DIRECTORY)).main(sys.argv[1:])
+'''
+
+def dump_code(code):
+    '''
+    Returns ast.dump() of an AST node or of a (nested) list of them.
+    '''
+    if isinstance(code, list):
+        return '[%s]' % ', '.join(dump_code(c) for c in code)
+    return ast.dump(code)
+
+# Commands the generated script runs in-process with utilities.call(), by
+# the names of template.UTILITIES. Options they don't implement make them
+# fall back to a shell at runtime.
+IN_PROCESS_UTILITIES = set([
+    'true', ':', 'false', 'echo', 'cat', 'mkdir', 'rm', 'touch', 'basename',
+    'dirname', 'tr', 'sed', 'expr', 'cp', 'mv', 'ln',
+])
+
+# Redirections utilities.call() handles, by file descriptor and operator,
+# with the keyword argument each one sets.
+IN_PROCESS_REDIRECTS = {
+    ('0', '<'): 'stdin',
+    ('1', '>'): 'stdout',
+    ('1', '>>'): 'stdout',
+    ('2', '>'): 'stderr',
+}
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+# Statistics counted over the calls in the translated code, by the name of
+# the function called.
+COMMAND_STATS = {
+    'subprocess.call': ['shell_forks'],
+    'subprocess.check_output': ['shell_forks'],
+    'substitutions.output': ['shell_forks', 'substitutions_memoizable'],
+    'utilities.call': ['shell_forks_avoided'],
+}
+
+def command_stats(statements):
+    '''
+    Returns a Counter of how commands in statements are run: in a shell,
+    in-process, or through the substitution memo.
+    '''
+    stats = Counter()
+    for stmt in statements:
+        for name in varflow.calls(stmt):
+            for stat in COMMAND_STATS.get(name, ()):
+                stats[stat] += 1
+    return stats
+
+# Pieces of the words the translator expands without the pysh interpreter:
+# ${NAME}, $NAME, and runs of characters that are literal outside quotes,
+# or inside double quotes.
+SIMPLE_PIECE_RE = re.compile(r'\$\{([A-Za-z_]\w*)\}|\$([A-Za-z_]\w*)|([^$`\'"\\~]+)')
+SIMPLE_QUOTED_PIECE_RE = re.compile(r'\$\{([A-Za-z_]\w*)\}|\$([A-Za-z_]\w*)|([^$`"\\]+)')
+
+def expand_simple(text, gets, default):
+    '''
+    Expands a word that is a single-quoted string, or made of
+    SIMPLE_PIECE_RE pieces and possibly double-quoted as a whole, the way
+    the interpreter does with a fakedict: variables become {NAME} and are
+    recorded in gets with default. Returns None for any other word.
+    '''
+    if text.startswith("'"):
+        if text.find("'", 1) == len(text) - 1:
+            return text[1:-1]
+        return None
+    pattern = SIMPLE_PIECE_RE
+    if text.startswith('"'):
+        if len(text) < 2 or not text.endswith('"'):
+            return None
+        text = text[1:-1]
+        pattern = SIMPLE_QUOTED_PIECE_RE
+    out = []
+    pos = 0
+    while pos < len(text):
+        m = pattern.match(text, pos)
+        if m is None:
+            return None
+        if m.group(3) is None:
+            name = m.group(1) or m.group(2)
+            gets[name] = default
+            out.append('{%s}' % name)
+        else:
+            out.append(m.group(3))
+        pos = m.end()
+    return ''.join(out)
 
 class fakedict(dict):
     def __init__(self, *args, **kwargs):
@@ -370,21 +1602,52 @@ class ShellTranslator:
         self.macro_handler = macro_handler
         self.template = template
         # mostly for word expansion
-        self.interp = interp.Interpreter(os.getcwd())
-           # disable filename expansion
-        self.interp._env.set_opt('-f')
+        self.interp = self.make_interp()
+        # Interpreters not in use by a WrapExpand. Each WrapExpand patches
+        # the interpreter it uses, so one nested inside another, as when
+        # translating re-enters itself, gets one of its own.
+        self.free_interps = [self.interp]
+        self.profiler = None
+        # Whether to turn main() into units that run on demand.
+        self.lazy = False
+        # Whether simple words are expanded without the interpreter, and the
+        # status and variable default it gives for them; see calibrate().
+        self.fast_path = None
+        self.fast_status = None
+        self.fast_default = None
+
+    def make_interp(self):
+        i = interp.Interpreter(os.getcwd())
+        # disable filename expansion
+        i._env.set_opt('-f')
         # hack around variable expansion
-        self.interp._env._env = fakedict()
+        i._env._env = fakedict()
+        self.macro_handler.stats['interpreters_created'] += 1
+        return i
+
+    def acquire_interp(self):
+        if self.free_interps:
+            return self.free_interps.pop()
+        return self.make_interp()
+
+    def release_interp(self, i):
+        self.free_interps.append(i)
 
     class WrapExpand:
-        def __init__(self, translator, interp):
+        '''
+        Sets up an interpreter of the translator for expanding words, and
+        collects the variables and command substitutions they use.
+        '''
+        def __init__(self, translator):
             self.translator = translator
-            self.interp = interp
-            self.subshell_output = interp.subshell_output
+            self.interp = None
+            self.subshell_output = None
             self.commands = []
             self.var_gets = set()
 
         def __enter__(self):
+            self.interp = self.translator.acquire_interp()
+            self.subshell_output = self.interp.subshell_output
             # This is monkeypatching an interp.Interpreter method
             def wrap_subshell(command):
                 #XXX: this isn't sufficient. needs to parse command
@@ -394,7 +1657,7 @@ class ShellTranslator:
                                      [self.translator.pathmanip('dirname', ast.Name('__file__', ast.Load())).value,
                                       ast.Str('.')])
                 else:
-                    cmd = self.translator.make_call(command, call_type='check_output').value
+                    cmd = self.translator.substitution(command)
                 ret = '{cmd%d}' % len(self.commands)
                 self.commands.append(cmd)
                 return 0, ret
@@ -406,6 +1669,7 @@ class ShellTranslator:
         def __exit__(self, exc_type, exc_val, exc_tb):
             self.interp.subshell_output = self.subshell_output
             self.interp._env._env.reset()
+            self.translator.release_interp(self.interp)
             return False
 
     def quoted(self, thing):
@@ -415,14 +1679,61 @@ class ShellTranslator:
         expr.value.args = [ast.Str(thing)]
         return expr.value
 
+    def calibrate(self):
+        '''
+        Checks that the interpreter expands simple words like expand_simple
+        does, and finds the status and the variable default it gives, so
+        that the fast path returns exactly the same. Without a match,
+        everything goes through the interpreter.
+        '''
+        with self.WrapExpand(self) as wrap:
+            words = wrap.interp.expand_token(('TOKEN', 'a$B${C}'))
+            status, value = wrap.interp.expand_variable(('A', 'a$B${C}'))
+            gets = dict(wrap.var_gets)
+        default = gets.get('B')
+        self.fast_path = (words == ['a{B}{C}'] and value == 'a{B}{C}' and
+                          gets == {'B': default, 'C': default})
+        self.fast_status = status
+        self.fast_default = default
+
+    def expand_fast(self, texts):
+        '''
+        Returns the expansions of texts and the variables they use, or None
+        if any of them needs the interpreter.
+        '''
+        if self.fast_path is None:
+            self.calibrate()
+        if not self.fast_path:
+            return None
+        gets = {}
+        expanded = []
+        for text in texts:
+            res = expand_simple(text, gets, self.fast_default)
+            if res is None:
+                self.macro_handler.stats['words_interpreted'] += len(texts)
+                return None
+            expanded.append(res)
+        self.macro_handler.stats['words_fast_path'] += len(texts)
+        return expanded, gets
+
     def expand_words(self, words, remember_quotes=False):
         '''
         Returns (wordlist, variables_used, subcommands)
         '''
-        with self.WrapExpand(self, self.interp) as wrap:
+        fast = self.expand_fast([word[1] for word in words])
+        if fast is not None:
+            expanded, gets = fast
+            args = []
+            for word, res in zip(words, expanded):
+                if (word[1].startswith('"') or word[1].startswith('\'')) and remember_quotes:
+                    args.append(self.quoted(res))
+                else:
+                    args.append(res)
+            return (args, gets, [])
+        with self.WrapExpand(self) as wrap:
             args = []
             for word in words:
-                res = self.interp.expand_token(word)
+                res = wrap.interp.expand_token(word)
                 # we don't actually expand vars, so this should be true
                 assert len(res) == 1
                 if (word[1].startswith('"') or word[1].startswith('\'')) and remember_quotes:
@@ -435,19 +1746,23 @@ class ShellTranslator:
         '''
         Returns ((status, word), variables_used, subcommands)
         '''
-        with self.WrapExpand(self, self.interp) as wrap:
-            return (self.interp.expand_variable(word), wrap.var_gets, wrap.commands)
+        fast = self.expand_fast([word[1]])
+        if fast is not None:
+            expanded, gets = fast
+            return ((self.fast_status, expanded[0]), gets, [])
+        with self.WrapExpand(self) as wrap:
+            return (wrap.interp.expand_variable(word), wrap.var_gets, wrap.commands)
 
     def translate_if(self, if_):
-        test = flatten(self.translate_commands(if_.cond))
+        test = self.translate_body(if_.cond)
         if len(test) > 1:
             raise UnhandledTranslation('Pipeline in if condition')
         if not test:
             raise UnhandledTranslation('Empty if condition?')
-        body = flatten(self.translate_commands(if_.if_cmds))
+        body = self.translate_body(if_.if_cmds)
         if not body:
             body.append(ast.Pass())
-        orelse = flatten(self.translate_commands(if_.else_cmds))
+        orelse = self.translate_body(if_.else_cmds)
 
         if isinstance(test[0], ast.Expr):
             call = test[0].value
@@ -462,37 +1777,51 @@ class ShellTranslator:
 
     def translate_case_pattern(self, pattern):
         words, vars, commands = self.expand_words([('TOKEN', pattern)])
-        call = ast.parse('fnmatch.fnmatch(case)').body[0].value
-        call.args.append(self.translate_value(words[0], vars, commands))
-        return call
+        return self.translate_value(words[0], vars, commands)
 
     def translate_case(self, case):
+        '''
+        Translates a case statement to a CaseDispatch finding the number of
+        the matching arm, followed by an if chain on that number. Patterns
+        that expand variables or commands are passed to the CaseDispatch
+        as lambdas, so they are only expanded if no earlier arm matches.
+        '''
         words, vars, commands = self.expand_words([('TOKEN', case.token)])
         assign = ast.Assign(targets=[ast.Name('case', ast.Store())],
                             value=self.translate_value(words[0], vars, commands))
-        prev_if = None
         ret = [assign]
+        arms = []
+        dynamic = ast.Dict([], [])
+        bodies = []
+        default = []
         for c in case.case_list:
-            body = flatten(self.translate_commands(c.statements))
+            body = self.translate_body(c.statements)
             if len(c.patterns) == 1 and c.patterns[0] == '*':
-                statements = body
+                # Arms after this one can't match.
+                default = body
+                break
+            patterns = [self.translate_case_pattern(p) for p in c.patterns]
+            if all(isinstance(p, ast.Str) for p in patterns):
+                arms.append(ast.Tuple(patterns, ast.Load()))
             else:
-                matches = []
-                for p in c.patterns:
-                    matches.append(self.translate_case_pattern(p))
-                if len(matches) == 1:
-                    test = matches[0]
-                else:
-                    test = ast.BoolOp(op=ast.Or(), values=matches)
-                statements = [ast.If(test, body, [])]
-            if not prev_if:
-                ret.extend(statements)
-            elif hasattr(prev_if, 'orelse'):
-                prev_if.orelse = statements
-            if statements:
-                prev_if = statements[0]
-            else:
-                prev_if = None
+                arms.append(ast.Name('None', ast.Load()))
+                dynamic.keys.append(ast.Num(len(bodies)))
+                dynamic.values.append(ast.Lambda(ast.arguments([], None, None, []),
+                                                 ast.List(patterns, ast.Load())))
+            bodies.append(body)
+        if not bodies:
+            ret.extend(default)
+            return ret
+        dispatch = ast.parse('_arm = CaseDispatch([])(case)').body[0]
+        dispatch.value.func.args[0].elts = arms
+        if dynamic.keys:
+            dispatch.value.args.append(dynamic)
+        ret.append(dispatch)
+        chain = default
+        for i in reversed(xrange(len(bodies))):
+            test = ast.parse('_arm == %d' % i).body[0].value
+            chain = [ast.If(test, bodies[i] or [ast.Pass()], chain)]
+        ret.extend(chain)
         return ret
 
 
@@ -518,7 +1847,18 @@ class ShellTranslator:
                 return self.translate_simplecommand(pipe.commands[0], pipe.reverse_status)
             return self.translate_commands(pipe.commands[0])
 
-        return self.make_call(self.stringify(pipe))
+        # The status is negated here, so the command the shell runs, when
+        # the utilities fall back to it, is without the !.
+        fallback = ast.Str(' | '.join(self.stringify(c) for c in pipe.commands))
+        cmds = [c[1] for c in pipe.commands]
+        call = None
+        if all(isinstance(c, pyshyacc.SimpleCommand) and not c.redirs and not c.assigns
+               for c in cmds):
+            call = self.translate_utilities([c.words for c in cmds], [], fallback)
+        call = call or self.make_call(fallback)
+        if pipe.reverse_status:
+            return ast.UnaryOp(op=ast.Not(), operand=call.value)
+        return call
 
     def translate_andor(self, andor):
         left = self.translate_commands(andor.left)
@@ -549,14 +1889,35 @@ class ShellTranslator:
             return commands[0]
         return self.make_format(ast.Str(value), commands)
 
+    def compiled_format(self, s):
+        call = ast.parse('Format()').body[0].value
+        call.args = [s]
+        return call
+
     def make_format(self, thing, commands, func=None):
-        call = ast.parse('format("", vars, {})').body[0].value
-        call.args[0] = thing
+        '''
+        Returns a call formatting thing, a string, with the variables and
+        the output of commands. With func='for_loop', thing is a list of
+        strings and quoted strings to expand into the words of a for loop.
+        '''
         if func:
-            call.func.id = func
+            call = ast.parse('%s([], vars, {})' % func).body[0].value
+            items = []
+            for item in thing.elts:
+                if isinstance(item, ast.Call):
+                    # quoted()
+                    item.args[0] = self.compiled_format(item.args[0])
+                    items.append(item)
+                else:
+                    items.append(self.compiled_format(item))
+            thing.elts = items
+            call.args[0] = thing
+        else:
+            call = ast.parse('f(vars, {})').body[0].value
+            call.func = self.compiled_format(thing)
         if commands:
-            call.args[2].keys = [ast.Str('cmd%d' % i) for i in range(len(commands))]
-            call.args[2].values = commands
+            call.args[-1].keys = [ast.Str('cmd%d' % i) for i in range(len(commands))]
+            call.args[-1].values = commands
         return call
 
     def make_var_assignment(self, var, value):
@@ -571,9 +1932,9 @@ class ShellTranslator:
         (status, expanded), vars, commands = self.expand_variable((k, v))
         return self.make_var_assignment(k, self.translate_value(expanded, vars, commands))
 
-    thunk_re = re.compile('__python(\d+)__')
+    thunk_re = THUNK_RE
     def python_thunk(self, index):
-        return self.macro_handler.get_expansion(index)
+        return self.macro_handler.thunks.take(index)
 
     def sys_exit(self, ret):
         expr = ast.parse('sys.exit()').body[0]
@@ -632,12 +1993,111 @@ class ShellTranslator:
             raise UnhandledTranslation('Unknown call_type %s' % call_type)
         return expr
 
+    def translate_utility_words(self, words):
+        '''
+        Returns an expression for the arguments of a command to run with
+        utilities.call(), or None if words need more of the shell than
+        for_loop() does.
+        '''
+        for w in words:
+            raw = w[1]
+            if '{' in raw or '}' in raw:
+                return None
+            if raw[:1] in '"\'' and (len(raw) < 2 or raw[-1] != raw[0] or
+                                      '"' in raw[1:-1] or '\'' in raw[1:-1]):
+                return None
+            if raw[:1] not in '"\'' and ('"' in raw or '\'' in raw or
+                                          GLOB_CHARS.search(raw)):
+                return None
+        args, vars, commands = self.expand_words(words, remember_quotes=True)
+        if commands:
+            return None
+        items = []
+        for a in args:
+            if isinstance(a, str) and '{' not in a:
+                # a word without expansions is never split
+                a = self.quoted(a)
+            elif isinstance(a, str):
+                a = ast.Str(a)
+            items.append(a)
+        if not vars:
+            return ast.List([i.args[0] for i in items], ast.Load())
+        return self.make_format(ast.List(items, ast.Load()), [], func='for_loop')
+
+    def translate_utilities(self, cmds, redirs, fallback):
+        '''
+        Returns a statement running the pipeline of commands cmds, given as
+        lists of words, with redirections redirs in-process, or None if
+        they can't be.
+        fallback is what to run in a shell if the utilities turn out not to
+        support some option at runtime.
+        '''
+        pipeline = []
+        for cmd_words in cmds:
+            if not cmd_words:
+                return None
+            words, vars, commands = self.expand_words(cmd_words[:1])
+            if words[0] not in IN_PROCESS_UTILITIES or vars or commands:
+                return None
+            argv = self.translate_utility_words(cmd_words)
+            if argv is None:
+                return None
+            pipeline.append(argv)
+        keywords = []
+        for r in redirs:
+            io_number = str(r.io_number) if r.io_number is not None else ('0' if r.op == '<' else '1')
+            keyword = IN_PROCESS_REDIRECTS.get((io_number, r.op))
+            if keyword is None or GLOB_CHARS.search(r.filename):
+                return None
+            words, vars, commands = self.expand_words([('TOKEN', r.filename)])
+            if commands:
+                return None
+            keywords.append(ast.keyword(keyword, self.translate_value(words[0], vars, commands)))
+            if r.op == '>>':
+                keywords.append(ast.keyword('append', ast.Name('True', ast.Load())))
+        if (isinstance(fallback, ast.Call) and varflow.call_name(fallback) == 'Format()'
+                and not fallback.args[-1].keys):
+            # only formatted if needed
+            fallback = fallback.func
+        expr = ast.parse('utilities.call([], fallback, vars)').body[0]
+        expr.value.args[0].elts = pipeline
+        expr.value.args[1] = fallback
+        expr.value.keywords = keywords
+        return expr
+
+    def memoized_depends(self, command):
+        '''
+        Returns the variables the output of command substitution `command`
+        depends on if it may be memoized, None otherwise.
+        '''
+        text = command.strip()
+        if UNMEMOIZABLE_RE.search(text.replace('2>&1', '')):
+            return None
+        for pattern, env in self.macro_handler.memoize:
+            if fnmatch.fnmatchcase(text, pattern):
+                return sorted(set(VARIABLE_RE.findall(text)) | set(env) | set(['PATH']))
+        return None
+
+    def substitution(self, command):
+        '''
+        Returns an expression for the output of command substitution
+        `command`, going through the memo of the generated script if the
+        allowlist permits.
+        '''
+        depends = self.memoized_depends(command)
+        if depends is None:
+            return self.make_call(command, call_type='check_output').value
+        call = ast.parse('substitutions.output("", vars, ())').body[0].value
+        call.args[0].s = command
+        call.args[2].elts = [ast.Str(v) for v in depends]
+        return call
+
     def translate_test(self, words, vars, commands):
         words.pop(0)
-        parser = TestParser(self, words, vars, commands)
+        expr = get_test_parser().parse(self, words, vars, commands)
         # the not is because the if parser expects to be working in
         # shell exit codes.
-        return ast.Expr(ast.UnaryOp(ast.Not(), parser.parse()))
+        return ast.Expr(ast.UnaryOp(ast.Not(), expr))
 
     def translate_simplecommand_words(self, cmd_words, reverse_status=False):
         words, vars, commands = self.expand_words(cmd_words)
@@ -661,7 +2121,9 @@ class ShellTranslator:
         if words[0] == 'test':
             call = self.translate_test(words, vars, commands)
         else:
-            call = self.make_call(self.translate_value(' '.join(words), vars, commands))
+            fallback = self.translate_value(' '.join(words), vars, commands)
+            call = (self.translate_utilities([cmd_words], [], fallback)
+                    or self.make_call(fallback))
         if reverse_status:
             return ast.UnaryOp(op=ast.Not(), operand=call.value)
         return call
@@ -669,8 +2131,14 @@ class ShellTranslator:
     def translate_simplecommand(self, cmd, reverse_status=False):
         cmd = cmd[1]
         if cmd.redirs:
-            # punt
-            return self.make_call(self.stringify(cmd))
+            fallback = ast.Str(self.stringify(cmd))
+            call = None
+            if not cmd.assigns:
+                call = self.translate_utilities([cmd.words], cmd.redirs, fallback)
+            call = call or self.make_call(fallback)
+            if reverse_status:
+                return ast.UnaryOp(op=ast.Not(), operand=call.value)
+            return call
         if cmd.words:
             return self.translate_simplecommand_words(cmd.words, reverse_status)
         else:
@@ -689,13 +2157,24 @@ class ShellTranslator:
         items = ast.List(items, ast.Load())
         if gets or commands:
             items = self.make_format(items, commands, func='for_loop')
-        body = [self.make_var_assignment(for_.name, ast.Name(for_.name, ast.Load()))] + flatten(self.translate_commands(for_.cmds))
+        else:
+            # Nothing to expand, so quoted words are plain strings.
+            items.elts = [i.args[0] if isinstance(i, ast.Call) else i for i in items.elts]
+        body = [self.make_var_assignment(for_.name, ast.Name(for_.name, ast.Load()))]
+        body.extend(iflatten(self.translate_commands(for_.cmds)))
 
         return ast.For(target=ast.Name(for_.name, ast.Store()),
                        iter=items,
                        body=body,
                        orelse=[])
 
+    def translate_body(self, commands):
+        '''
+        Translates commands into a flat list of statements.
+        '''
+        with profiling.phase(self.profiler, 'translate'):
+            return flatten(self.translate_commands(commands))
+
     def translate_commands(self, v):
         if isinstance(v, list):
             return [self.translate_commands(c) for c in v]
@@ -707,6 +2186,15 @@ class ShellTranslator:
                     return self.translate_commands(v[1])
             return self.translate_commands(list(v))
 
+        if self.profiler is None:
+            return self.translate_node(v)
+        start = self.profiler.enter()
+        try:
+            return self.translate_node(v)
+        finally:
+            self.profiler.leave('nodes', type(v).__name__, start)
+
+    def translate_node(self, v):
         if isinstance(v, pyshyacc.IfCond):
             return self.translate_if(v)
         elif isinstance(v, pyshyacc.CaseCond):
@@ -727,49 +2215,615 @@ class ShellTranslator:
             raise UnhandledTranslation('Unhandled thing', v)
 
     def make_argparse_arguments(self):
-        for arg, name, help, action in self.macro_handler.args:
+        for argument in self.macro_handler.args:
             expr = ast.parse('parser.add_argument()').body[0]
-            expr.value.args = [ast.Str(arg)]
+            expr.value.args = [ast.Str(argument.arg)]
             expr.value.keywords = [
-                ast.keyword('dest', ast.Str(name)),
-                ast.keyword('action', ast.Str(action)),
-                ast.keyword('help', ast.Str(help)),
+                ast.keyword('dest', ast.Str(argument.name)),
+                ast.keyword('action', ast.Str(argument.action)),
+                ast.keyword('help', ast.Str(argument.help)),
             ]
             yield expr
 
-    def translate(self, shell, toplevel=False):
-        commands, leftover = pyshyacc.parse(shell, True)
+    def translate(self, shell, toplevel=False, jobs=1, cache=None, stream=None,
+                  package=None):
+        '''
+        Translates shell. A toplevel script fills self.template, or with a
+        stream, is written to it as the filled template's source, or with a
+        package directory, is written there split into sections; anything
+        else is returned as a list of statements.
+        '''
+        if toplevel and (jobs > 1 or cache is not None):
+            statements = self.translate_in_chunks(shell, jobs, cache)
+            if statements is not None:
+                return self.finish_template(statements, stream, package)
+        commands, leftover = self.parse(shell)
         if toplevel:
-            return self.translate_toplevel(commands)
-        return flatten(self.translate_commands(commands))
+            return self.finish_template(self.translate_toplevel(commands), stream, package)
+        return self.translate_body(commands)
+
+    def parse(self, shell):
+        with profiling.phase(self.profiler, 'shell parse'):
+            return pyshyacc.parse(shell, True)
+
+    def translate_chunk(self, shell):
+        '''
+        Translates a piece of a script as split by shellsplit. The piece
+        has to parse completely on its own.
+        '''
+        commands, leftover = self.parse(shell)
+        if leftover:
+            raise UnhandledTranslation('Shell chunk did not parse completely')
+        return self.translate_body(commands)
+
+    def chunk_key(self, cache, chunk):
+        '''
+        Returns the cache key for a chunk. Thunk placeholders are numbered
+        from zero within the chunk, and the contents of the thunks they
+        refer to are part of the key, so that adding or removing macro
+        invocations earlier in the script doesn't invalidate the chunk.
+        '''
+        thunks = []
+        def renumber(m):
+            thunks.append(dump_code(self.macro_handler.thunks.peek(int(m.group(1)))))
+            return '__python%d__' % (len(thunks) - 1)
+        text = self.thunk_re.sub(renumber, chunk)
+        return cache.key('chunk', text, *thunks)
+
+    def translate_in_chunks(self, shell, jobs, cache):
+        '''
+        Translates the top-level commands of shell separately, in `jobs`
+        processes and/or reusing translations from cache. Returns the
+        statements in script order, or None if the script can't be
+        translated in independent chunks. The caller should then translate
+        it as a whole, which also reports any errors the usual way.
+        '''
+        chunks = shellsplit.split_toplevel(shell)
+        if cache is None:
+            chunks = shellsplit.group_chunks(chunks, jobs * CHUNKS_PER_JOB)
+            if len(chunks) < 2:
+                return None
+            results = self.translate_chunks(chunks, jobs)
+            if results is None:
+                return None
+        else:
+            keys = [self.chunk_key(cache, c) for c in chunks]
+            results = [cache.get(k) for k in keys]
+            missing = [i for i, r in enumerate(results) if r is None]
+            translated = self.translate_chunks([chunks[i] for i in missing], jobs)
+            if translated is None:
+                return None
+            for i, statements in zip(missing, translated):
+                cache.put(keys[i], statements)
+                results[i] = statements
+        # The thunks were used by the workers, or by the cached chunks.
+        self.macro_handler.thunks.discard()
+        return [s for statements in results for s in statements]
+
+    def translate_chunks(self, chunks, jobs):
+        '''
+        Translates each of chunks, in a pool of `jobs` processes if there is
+        more than one. Returns a list of statement lists, or None if any
+        chunk failed.
+        '''
+        global _chunk_translator
+        if jobs < 2 or len(chunks) < 2:
+            # The script is translated again as a whole if a chunk fails,
+            # which needs the thunks the others took.
+            thunks = self.macro_handler.thunks
+            thunks.begin()
+            try:
+                results = [self.translate_chunk(c) for c in chunks]
+            except Exception:
+                thunks.rollback()
+                return None
+            thunks.commit()
+            return results
+        _chunk_translator = self
+        with profiling.phase(self.profiler, 'shell parse and translate in workers'):
+            pool = multiprocessing.Pool(jobs)
+            try:
+                chunksize = max(1, len(chunks) // (jobs * CHUNKS_PER_JOB))
+                results = pool.map(_translate_chunk, chunks, chunksize)
+            except Exception:
+                results = None
+            finally:
+                pool.terminate()
+                pool.join()
+                _chunk_translator = None
+        if results is None or not all(ok for ok, _ in results):
+            return None
+        return [statements for _, statements in results]
 
     def translate_toplevel(self, commands):
+        '''
+        Yields the statements of the top-level commands, translating each
+        command only when the previous one's statements are used up, and
+        dropping it once it is translated.
+        '''
+        commands.reverse()
+        while commands:
+            with profiling.phase(self.profiler, 'translate'):
+                statements = flatten(self.translate_commands(commands.pop()))
+            for stmt in statements:
+                yield stmt
+
+    def finish_statements(self, statements, split=False):
+        '''
+        Runs the passes over the whole script on statements, as they come:
+        constant folding, then moving probes earlier, or with self.lazy,
+        making units of the checks. Yields the statements in their final
+        order as soon as they are known. With split, the top-level
+        SectionBreaks are kept, and nothing moves past them.
+        '''
+        folder = varflow.ConstantFolder()
+        hoister = None
+        units = None
+        if self.lazy:
+            # Probes start when a unit needs their results instead.
+            units = hoister = UnitBuilder(self.macro_handler.substs, self.macro_handler.stats)
+        elif self.macro_handler.probe_count or self.macro_handler.cached_count:
+            hoister = ProbeHoister()
+        remover = None
+        if self.macro_handler.section_count:
+            remover = SectionBreakRemover()
+        for stmt in statements:
+            if isinstance(stmt, SectionBreak):
+                if split:
+                    for ready in (hoister.flush() if hoister is not None else []):
+                        yield ready
+                    yield stmt
+                continue
+            if remover is not None:
+                stmt = remover.visit(stmt)
+            for folded in folder.fold_statement(stmt):
+                self.macro_handler.stats.update(command_stats([folded]))
+                if hoister is None:
+                    yield folded
+                    continue
+                for ready in hoister.add(folded):
+                    yield ready
+        if units is not None:
+            for ready in units.finish():
+                yield ready
+        elif hoister is not None:
+            for ready in hoister.flush():
+                yield ready
+        self.macro_handler.stats.update(folder.stats)
+
+    def prepare_template(self):
+        '''
+        Fills in the parts of the template before main(), and returns main.
+        '''
         main = filter(lambda x: isinstance(x, ast.FunctionDef) and x.name == 'main', self.template.body)[0]
-        main.body.extend(flatten(self.translate_commands(commands)))
         substassign = filter(lambda x: isinstance(x, ast.Assign) and x.targets[0].id == 'SUBSTS', self.template.body)[0]
         substassign.value.args = [ast.List([ast.Str(s) for s in self.macro_handler.substs], ast.Load())]
         make_arg_parser = filter(lambda x: isinstance(x, ast.FunctionDef) and x.name == 'make_arg_parser', self.template.body)[0]
         make_arg_parser.body[-1:-1] = self.make_argparse_arguments()
+        return main
 
+    def finish_template(self, statements, stream=None, package=None):
+        if package is not None:
+            return self.emit_package(statements, package)
+        if stream is None:
+            return self.fill_template(statements)
+        return self.emit_template(statements, stream)
 
-p = Parser(sys.stdin.read())
-p.changequote('[',']')
-macro_handler = MacroHandler()
-macro_handler.add_macros(MACROS, p)
-
-stream = StringIO()
-# Parse m4
-p.parse(stream=stream)
-shell = stream.getvalue()
-if len(sys.argv) > 1:
-    sys.stdout.write(shell)
-    sys.exit(0)
+    def fill_template(self, statements):
+        main = self.prepare_template()
+        main.body.extend(self.finish_statements(statements))
+        hoist_constants(self.template, main)
 
-# now translate shell to Python
-template_file = os.path.join(os.path.dirname(__file__), 'template.py')
-template = ast.parse(open(template_file, 'r').read())
+    def emit_template(self, statements, stream):
+        '''
+        Writes the source of the template filled with statements to stream,
+        writing each statement as soon as it is final and dropping it. The
+        source is the same as that of the template filled by
+        fill_template().
+        '''
+        main = self.prepare_template()
+        hoister = ConstantHoister()
+        main.body = [hoister.visit(stmt) for stmt in main.body]
+        source = emitter.SourceEmitter(self.template, main, stream)
+        with profiling.phase(self.profiler, 'dump'):
+            source.begin()
+        for stmt in self.finish_statements(statements):
+            stmt = hoister.visit(stmt)
+            with profiling.phase(self.profiler, 'dump'):
+                source.write(stmt)
+        with profiling.phase(self.profiler, 'dump'):
+            source.finish(hoister.definitions)
+
+    def emit_package(self, statements, directory):
+        '''
+        Writes the translation as a package in directory, which is created
+        if needed. main() in its __init__ imports and runs the section
+        modules one after the other, passing its local variables to them.
+        Imported modules are compiled once and then loaded from their .pyc,
+        and a section is only compiled when the script gets to it.
+        '''
+        main = self.prepare_template()
+        # Everything main() sets up for the statements. Loop variables may
+        # be unset.
+        parameters = sorted(set(t.id for stmt in main.body if isinstance(stmt, ast.Assign)
+                                for t in stmt.targets if isinstance(t, ast.Name)))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            # .pyc files of a previous translation may look newer than the
+            # new sources.
+            if name.startswith('section_') or name.startswith('__init__.'):
+                os.unlink(os.path.join(directory, name))
+        sections = []
+        section = None
+        for stmt in self.finish_statements(statements, split=True):
+            if section is None or isinstance(stmt, SectionBreak):
+                if section is not None:
+                    section.close()
+                sections.append('section_%03d' % len(sections))
+                section = SectionModule(os.path.join(directory, sections[-1] + '.py'),
+                                        parameters, getattr(stmt, 'title', None))
+                if isinstance(stmt, SectionBreak):
+                    continue
+            with profiling.phase(self.profiler, 'dump'):
+                section.write(stmt)
+        if section is not None:
+            section.close()
+        run = ast.parse('for section in []:\n'
+                        '    importlib.import_module("." + section, __name__).run()').body[0]
+        run.iter.elts = [ast.Str(name) for name in sections]
+        run.body[0].value.args = [ast.Name(p, ast.Load()) for p in parameters]
+        main.body.append(run)
+        with open(os.path.join(directory, '__init__.py'), 'w') as f:
+            source = emitter.SourceEmitter(self.template, main, f)
+            source.begin()
+            source.finish()
+        with open(os.path.join(directory, '__main__.py'), 'w') as f:
+            f.write(PACKAGE_MAIN)
+
+# Top-level chunks handed to each worker by translate_chunks. More chunks
+# than workers evens out the load when some chunks are much bigger.
+CHUNKS_PER_JOB = 4
+
+# Set by ShellTranslator.translate_chunks right before it starts its
+# process pool, so the forked workers inherit the translator along with the
+# macro expansions that the script's thunks refer to.
+_chunk_translator = None
+
+def _translate_chunk(shell):
+    try:
+        return True, _chunk_translator.translate_chunk(shell)
+    except Exception:
+        return False, None
+
+
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template.py')
+
+# Builtins changing m4 state that a prefix snapshot doesn't keep, and those
+# that could run them out of sight: included files and indirect calls.
+UNRESUMABLE_RE = re.compile(r'\b(changequote|changecom|divert|undivert|m4wrap|m4_wrap|'
+                            r'undefine|popdef|include|sinclude|m4_include|m4_sinclude|'
+                            r'builtin|indir)\b')
+
+def resumable_prefix(text):
+    '''
+    Returns whether m4 expansion can stop after text and resume later with
+    the same result: text ends a line, leaves no quote, comment or macro
+    call open, and doesn't change m4 state other than the macro table.
+    '''
+    if not text.endswith('\n') or UNRESUMABLE_RE.search(text):
+        return False
+    quotes = parens = 0
+    comment = False
+    for c in text:
+        if comment:
+            comment = c != '\n'
+        elif c == '[':
+            quotes += 1
+        elif c == ']':
+            quotes -= 1
+        elif quotes:
+            continue
+        elif c == '#':
+            comment = True
+        elif c == '(':
+            parens += 1
+        elif c == ')':
+            parens -= 1
+    return quotes == 0 and parens == 0
+
+class Options(object):
+    '''
+    Options for ConfigureTranslator. Anything not passed to the
+    constructor keeps the default given here.
+    '''
+    # Stop after m4 expansion and return the shell script.
+    m4_only = False
+    # Number of processes to translate the shell script with.
+    jobs = 1
+    # Directory for the incremental translation cache, or None.
+    cache_dir = None
+    # Collect timings in ConfigureTranslator.profiler.
+    profile = False
+    # Command substitutions the generated script may memoize, as
+    # (pattern, environment variables) pairs.
+    memoize = DEFAULT_MEMOIZE
+    # Make the generated script only run the checks whose results it uses.
+    lazy = False
+    # Text that inputs start with, like a shared prologue of macro
+    # definitions. It is expanded once, and inputs starting with it resume
+    # from the m4 state after it.
+    shared_prefix = None
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.iteritems():
+            if not hasattr(self, k):
+                raise TypeError('Unknown option %s' % k)
+            setattr(self, k, v)
+
+class ConfigureTranslator(object):
+    '''
+    Translates configure.in sources to Python. The parsed template, the
+    macro tables and the shell interpreter are kept between calls to
+    translate(), so a single instance should be used for many inputs.
+    '''
+    def __init__(self, options=None):
+        self.options = options or Options()
+        with open(TEMPLATE_FILE, 'r') as f:
+            self.template = ast.parse(f.read())
+        self.macro_handler = MacroHandler()
+        self.macro_handler.memoize = self.options.memoize
+        self.shell_translator = ShellTranslator(self.macro_handler, None)
+        self.shell_translator.lazy = self.options.lazy
+        self.macro_handler.shell_translator = self.shell_translator
+        self.cache = None
+        if self.options.cache_dir:
+            self.cache = transcache.TranslationCache(self.options.cache_dir,
+                                                     translator_digest(self.options.memoize))
+            self.macro_handler.cache = self.cache
+        # The m4 output, macro table and MacroHandler.snapshot() after
+        # options.shared_prefix, once an input has started with it.
+        self.prefix_snapshot = None
+        self.profiler = None
+        if self.options.profile:
+            self.profiler = profiling.Profiler()
+            self.macro_handler.profiler = self.profiler
+            self.shell_translator.profiler = self.profiler
+
+    def expand(self, source):
+        '''
+        Runs m4 over source and returns the resulting shell script.
+        '''
+        prefix = self.options.shared_prefix
+        if prefix and source.startswith(prefix) and resumable_prefix(prefix):
+            return self.expand_resumed(source[len(prefix):])
+        self.macro_handler.reset()
+        return self.run_m4(source)[0]
 
-translator = ShellTranslator(macro_handler, template)
-translator.translate(shell, toplevel=True)
+    def run_m4(self, source, macros=None):
+        '''
+        Runs m4 over source, with the macros in macros defined on top of
+        ours, and returns the output and the parser.
+        '''
+        with profiling.phase(self.profiler, 'm4'):
+            p = self.macro_handler.make_parser(source)
+            if macros is not None:
+                p.macros.update(macros)
+            stream = StringIO()
+            p.parse(stream=stream)
+            return stream.getvalue(), p
 
-sys.stdout.write(meta.dump_python_source(template))
+    def expand_resumed(self, rest):
+        '''
+        Expands an input made of the shared prefix followed by rest. The
+        prefix is expanded once, for the first such input, after which the
+        output, the macro table (with the prologue's own definitions) and
+        the macro handler state are saved. Later inputs start from a copy
+        of that state and only run m4 over rest.
+        '''
+        stats = self.macro_handler.stats
+        if self.prefix_snapshot is None:
+            self.macro_handler.reset()
+            output, p = self.run_m4(self.options.shared_prefix)
+            # Builtins bound to this parser are defined by every parser.
+            macros = dict((name, macro) for name, macro in p.macros.iteritems()
+                          if getattr(macro, '__self__', None) is not p)
+            self.prefix_snapshot = (output, macros, self.macro_handler.snapshot())
+            stats['prefix_snapshot_misses'] += 1
+        else:
+            with profiling.phase(self.profiler, 'm4'):
+                self.macro_handler.restore(self.prefix_snapshot[2])
+            stats['prefix_snapshot_hits'] += 1
+        output, macros, _ = self.prefix_snapshot
+        return output + self.run_m4(rest, macros)[0]
+
+    def translate(self, source):
+        stream = StringIO()
+        self.translate_to(source, stream)
+        return stream.getvalue()
+
+    def translate_package(self, source, directory):
+        '''
+        Translates source into a package in directory, with main() split
+        into a module per section of configure.in.
+        '''
+        shell = self.expand(source)
+        template = copy.deepcopy(self.template)
+        self.shell_translator.template = template
+        try:
+            self.shell_translator.translate(shell, toplevel=True,
+                                            jobs=self.options.jobs,
+                                            cache=self.cache,
+                                            package=directory)
+            self.macro_handler.thunks.finish()
+        finally:
+            self.shell_translator.template = None
+            self.macro_handler.thunks.discard()
+
+    def translate_to(self, source, stream):
+        '''
+        Translates source, writing the Python source to stream as it is
+        produced.
+        '''
+        shell = self.expand(source)
+        if self.options.m4_only:
+            stream.write(shell)
+            return
+        # Translation fills in the template, so work on a copy.
+        template = copy.deepcopy(self.template)
+        self.shell_translator.template = template
+        try:
+            self.shell_translator.translate(shell, toplevel=True,
+                                            jobs=self.options.jobs,
+                                            cache=self.cache,
+                                            stream=stream)
+            self.macro_handler.thunks.finish()
+        finally:
+            self.shell_translator.template = None
+            self.macro_handler.thunks.discard()
+
+    def report_stats(self, stream):
+        stats = Counter(self.macro_handler.stats)
+        if self.cache is not None:
+            stats.update(self.cache.stats)
+        for name in sorted(stats):
+            stream.write('%s: %d\n' % (name, stats[name]))
+        words = stats['words_fast_path'] + stats['words_interpreted']
+        if words:
+            stream.write('word expansion fast path: %.1f%%\n' %
+                         (100.0 * stats['words_fast_path'] / words))
+        if self.cache is not None:
+            self.cache.report(stream)
+
+def translator_digest(memoize=DEFAULT_MEMOIZE):
+    '''
+    Returns a hash identifying this version of the translator, including
+    the modules and parsers it uses, and the options that change its
+    output, which keys the translation cache.
+    '''
+    h = hashlib.sha1(sys.version)
+    h.update(repr(memoize))
+    modules = [sys.modules[__name__], shellsplit, varflow, emitter,
+               pyshyacc, interp, sys.modules[Parser.__module__]]
+    for module in modules:
+        try:
+            with open(os.path.splitext(os.path.abspath(module.__file__))[0] + '.py', 'rb') as f:
+                h.update(f.read())
+        except IOError:
+            # Installed without its source.
+            h.update(getattr(module, '__version__', module.__file__))
+    return h.hexdigest()
+
+def translate(source, options=None):
+    '''
+    Translates the configure.in text in source, returning Python source.
+    '''
+    return ConfigureTranslator(options).translate(source)
+
+def make_option_parser():
+    parser = argparse.ArgumentParser(
+        description='Translate an autoconf configure.in into a Python script. '
+        'Without --batch, reads configure.in from stdin and writes to stdout.')
+    parser.add_argument('-E', '--m4-only', action='store_true',
+                        help='only run m4 and write out the shell script')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='translate independent parts of the shell '
+                        'script in JOBS processes (0 means one per CPU)')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='keep translations of macro invocations and '
+                        'top-level commands in DIR, and reuse them for the '
+                        'parts of the input that did not change')
+    parser.add_argument('--stats', action='store_true',
+                        help='write translation statistics to stderr')
+    parser.add_argument('--profile', action='store_true',
+                        help='write the time spent in each phase, macro and '
+                        'shell node type to stderr. With -j, work done in '
+                        'the worker processes only shows up as a phase')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='also write the profile to FILE as JSON')
+    parser.add_argument('--profile-top', type=int, default=20, metavar='N',
+                        help='number of macros and node types to profile (default: 20)')
+    parser.add_argument('--memoize', action='append', default=[], metavar='PATTERN',
+                        help='let the generated script memoize command '
+                        'substitutions matching PATTERN (see --memoize-'
+                        'substitutions in the generated script); may be repeated')
+    parser.add_argument('--no-default-memoize', action='store_true',
+                        help='only memoize the substitutions given with --memoize')
+    parser.add_argument('--lazy', action='store_true',
+                        help='make the generated script run checks only when '
+                        'a later statement or AC_SUBST uses their results')
+    parser.add_argument('--shared-prefix', metavar='FILE',
+                        help='expand the text in FILE, which inputs start '
+                        'with, only once, and resume from the m4 state '
+                        'after it for every input that starts with it')
+    parser.add_argument('--batch', nargs=2, action='append', default=[],
+                        metavar=('INPUT', 'OUTPUT'),
+                        help='translate INPUT into OUTPUT; may be repeated '
+                        'to translate many files in one process')
+    parser.add_argument('--package', action='store_true',
+                        help='write each OUTPUT of --batch as a package '
+                        'directory, with a module for each MOZ_ARG_HEADER '
+                        'section. Run it with python OUTPUT')
+    parser.add_argument('--compile', action='store_true',
+                        help='also write the compiled code of each OUTPUT of '
+                        '--batch to OUTPUT.code, for launcher.py to run it '
+                        'without compiling it again')
+    return parser
+
+def main(argv):
+    parser = make_option_parser()
+    args = parser.parse_args(argv)
+    if args.package and (not args.batch or args.m4_only):
+        parser.error('--package needs --batch, and not -E')
+    if args.compile and (not args.batch or args.m4_only or args.package):
+        parser.error('--compile needs --batch, and not -E or --package')
+    batch = args.batch
+    package = args.package
+    compile_output = args.compile
+    show_stats = args.stats
+    profile_json = args.profile_json
+    profile_top = args.profile_top
+    memoize = [(pattern, ()) for pattern in args.memoize]
+    if not args.no_default_memoize:
+        memoize[:0] = DEFAULT_MEMOIZE
+    args.memoize = tuple(memoize)
+    if args.shared_prefix:
+        with open(args.shared_prefix, 'r') as f:
+            args.shared_prefix = f.read()
+    del args.batch, args.stats, args.profile_json, args.profile_top
+    del args.no_default_memoize, args.package, args.compile
+    if profile_json:
+        args.profile = True
+    if args.jobs == 0:
+        args.jobs = multiprocessing.cpu_count()
+    translator = ConfigureTranslator(Options(**vars(args)))
+    if not batch:
+        translator.translate_to(sys.stdin.read(), sys.stdout)
+    for infile, outfile in batch:
+        with open(infile, 'r') as f:
+            source = f.read()
+        if package:
+            translator.translate_package(source, outfile)
+            continue
+        # Don't leave a partial output behind if translation fails.
+        try:
+            with open(outfile + '.tmp', 'w') as f:
+                translator.translate_to(source, f)
+        except:
+            if os.path.exists(outfile + '.tmp'):
+                os.unlink(outfile + '.tmp')
+            raise
+        os.rename(outfile + '.tmp', outfile)
+        if compile_output:
+            with profiling.phase(translator.profiler, 'compile'):
+                launcher.write_cache(outfile)
+    if show_stats:
+        translator.report_stats(sys.stderr)
+    if translator.profiler is not None:
+        translator.profiler.report(sys.stderr, profile_top)
+        if profile_json:
+            with open(profile_json, 'w') as f:
+                f.write(translator.profiler.as_json(profile_top))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the configure.in translator.
+
+Usage: python bench.py [-n ITERATIONS] [--size N] [--baseline FILE]
+                       [--save-baseline FILE] [--threshold FRACTION]
+                       [BENCHMARK ...]
+
+Every benchmark runs in its own process, so its peak memory use can be
+reported. Inputs are generated, so nothing outside this repository is
+needed. With --baseline, the time per unit of work and the peak memory
+of every benchmark are compared against a file written earlier with
+--save-baseline. The exit status is 1 if anything got slower or bigger
+by more than the threshold.
+'''
+
+import argparse
+import copy
+import json
+import multiprocessing
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import autoconf
+
+# A sample of the test(1) expressions found in Mozilla's configure.in.
+TEST_EXPRESSIONS = [
+    'test -n "$MOZ_DEBUG"',
+    'test -z "$CROSS_COMPILE"',
+    'test "$GNU_CC" = 1',
+    'test "$OS_ARCH" != WINNT',
+    'test -z "$CROSS_COMPILE" -a "$OS_ARCH" != WINNT',
+    'test "$MOZ_WIDGET_TOOLKIT" = gtk2 -o "$MOZ_WIDGET_TOOLKIT" = gtk3',
+    'test ! -d "$srcdir/js/src"',
+    'test -f "$_topsrcdir/config.status"',
+    'test -e "$MOZ_BUILD_ROOT/.mozconfig"',
+    'test "$_CC_MAJOR_VERSION" -lt 4',
+    'test "$_MSC_VER" -ge 1800',
+    'test -n "$MOZ_OPTIMIZE" -a ! -n "$MOZ_DEBUG"',
+]
+
+CASE_SIZES = [10, 100, 1000, 10000]
+
+def bench_test(iterations, size):
+    '''
+    Translates every expression in TEST_EXPRESSIONS `iterations` times.
+    '''
+    translator = autoconf.ShellTranslator(autoconf.MacroHandler(), None)
+    corpus = [[('TOKEN', w) for w in e.split()] for e in TEST_EXPRESSIONS]
+    start = time.time()
+    for i in xrange(iterations):
+        for words in corpus:
+            translator.translate_simplecommand_words(words)
+    return [('test', iterations * len(corpus), 'translations', time.time() - start)]
+
+def make_case(arms):
+    lines = ['case "$target" in']
+    for i in xrange(arms):
+        lines.append('  *-arch%d-*) CPU_ARCH=arch%d; _arm=%d ;;' % (i, i, i))
+    lines.append('  *) CPU_ARCH=unknown ;;')
+    lines.append('esac')
+    return '\n'.join(lines) + '\n'
+
+def bench_case_scaling(iterations, size):
+    '''
+    Translates case statements with CASE_SIZES arms. The time per arm
+    should stay flat as the statement grows. Bigger statements are
+    translated fewer times, so each size takes about as long.
+    '''
+    translator = autoconf.ShellTranslator(autoconf.MacroHandler(), None)
+    results = []
+    for arms in CASE_SIZES:
+        shell = make_case(arms)
+        repeat = max(1, iterations * CASE_SIZES[0] // arms)
+        start = time.time()
+        for i in xrange(repeat):
+            translator.translate(shell)
+        results.append(('case-scaling[%d]' % arms, repeat * arms, 'arms',
+                        time.time() - start))
+    return results
+
+# Generators for synthetic configure.in inputs. Each takes a size and
+# returns m4 source.
+
+def gen_arg_bools(size):
+    parts = []
+    for i in xrange(size):
+        parts.append('MOZ_ARG_ENABLE_BOOL(feature%d,\n'
+                     '[  --enable-feature%d      Enable feature %d],\n'
+                     '    MOZ_FEATURE%d=1\n'
+                     '    AC_MSG_RESULT([feature%d enabled]),\n'
+                     '    MOZ_FEATURE%d=)\n' % (i, i, i, i, i, i))
+    return ''.join(parts)
+
+def gen_nesting(size):
+    '''
+    Ten blocks of if and case statements nested `size` deep.
+    '''
+    lines = []
+    for block in xrange(10):
+        for d in xrange(size):
+            indent = '  ' * d
+            if d % 2:
+                lines.append('%scase "$target%d" in' % (indent, d))
+                lines.append('%s*-linux*|*-android*)' % indent)
+            else:
+                lines.append('%sif test -n "$LEVEL%d"; then' % (indent, d))
+            lines.append('%s  DEPTH=%d' % (indent, d))
+        for d in reversed(xrange(size)):
+            indent = '  ' * d
+            if d % 2:
+                lines.append('%s  ;;' % indent)
+                lines.append('%s*)' % indent)
+                lines.append('%s  DEPTH=none' % indent)
+                lines.append('%s  ;;' % indent)
+                lines.append('%sesac' % indent)
+            else:
+                lines.append('%selse' % indent)
+                lines.append('%s  DEPTH=none' % indent)
+                lines.append('%sfi' % indent)
+    return '\n'.join(lines) + '\n'
+
+def gen_for_lists(size):
+    items = ' '.join('item%d' % i for i in xrange(size))
+    parts = []
+    for i in xrange(10):
+        parts.append('for f in %s $EXTRA_ITEMS%d; do\n'
+                     '  LAST=$f\n'
+                     'done\n' % (items, i))
+    return ''.join(parts)
+
+def gen_substitutions(size):
+    parts = []
+    for i in xrange(size):
+        parts.append('VERSION%d=`$CC -dumpversion`\n'
+                     'OS%d=$(uname -s)\n'
+                     'NAME%d=`echo "$OS%d" | sed -e "s/-/_/g"`\n' % (i, i, i, i))
+    return ''.join(parts)
+
+def gen_test_chains(size):
+    parts = []
+    for i in xrange(size):
+        parts.append('if test -n "$A%d" -a "$B%d" = yes -o "$C%d" != no -a ! -d "$D%d"; then\n'
+                     '  RESULT%d=1\n'
+                     'fi\n' % (i, i, i, i, i))
+    return ''.join(parts)
+
+SHAPES = {
+    'arg-bools': gen_arg_bools,
+    'nesting': gen_nesting,
+    'for-lists': gen_for_lists,
+    'substitutions': gen_substitutions,
+    'test-chains': gen_test_chains,
+}
+
+def make_m4_bench(shape):
+    def bench(iterations, size):
+        translator = autoconf.ConfigureTranslator()
+        source = SHAPES[shape](size)
+        start = time.time()
+        for i in xrange(iterations):
+            translator.expand(source)
+        return [('m4/%s' % shape, iterations, 'expansions', time.time() - start)]
+    return bench
+
+def make_shell_bench(shape):
+    def bench(iterations, size):
+        translator = autoconf.ConfigureTranslator()
+        source = SHAPES[shape](size)
+        elapsed = 0
+        for i in xrange(iterations):
+            # Expansion isn't timed, but is redone for every translation so
+            # that each one starts from fresh macro expansions.
+            shell = translator.expand(source)
+            translator.shell_translator.template = copy.deepcopy(translator.template)
+            start = time.time()
+            translator.shell_translator.translate(shell, toplevel=True)
+            elapsed += time.time() - start
+        return [('shell/%s' % shape, iterations, 'translations', elapsed)]
+    return bench
+
+def make_pipeline_bench(shape):
+    def bench(iterations, size):
+        translator = autoconf.ConfigureTranslator()
+        source = SHAPES[shape](size)
+        start = time.time()
+        for i in xrange(iterations):
+            translator.translate(source)
+        return [('pipeline/%s' % shape, iterations, 'translations', time.time() - start)]
+    return bench
+
+BENCHMARKS = {
+    'test': bench_test,
+    'case-scaling': bench_case_scaling,
+}
+for shape in SHAPES:
+    BENCHMARKS['m4/%s' % shape] = make_m4_bench(shape)
+    BENCHMARKS['shell/%s' % shape] = make_shell_bench(shape)
+    BENCHMARKS['pipeline/%s' % shape] = make_pipeline_bench(shape)
+
+def peak_memory_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes rather than kilobytes
+        peak //= 1024
+    return peak
+
+def _run_benchmark(conn, name, iterations, size):
+    try:
+        rows = BENCHMARKS[name](iterations, size)
+        conn.send((rows, peak_memory_kb(), None))
+    except Exception as e:
+        conn.send((None, None, '%s: %s' % (type(e).__name__, e)))
+    conn.close()
+
+def run_isolated(name, iterations, size):
+    '''
+    Runs a benchmark in a child process. Returns its result rows, the peak
+    memory use of the process in kB, and why it failed, or None.
+    '''
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_run_benchmark,
+                                      args=(sender, name, iterations, size))
+    process.start()
+    # Only the child may keep the pipe open, so that recv() sees it die.
+    sender.close()
+    try:
+        rows, peak, error = receiver.recv()
+    except EOFError:
+        rows, peak, error = None, None, None
+    process.join()
+    if rows is None and error is None:
+        error = 'exited with status %s' % process.exitcode
+    return rows, peak, error
+
+def compare(label, result, baseline, threshold):
+    '''
+    Returns a list of descriptions of how result regressed from baseline.
+    '''
+    regressions = []
+    for metric in ('seconds_per_unit', 'peak_memory_kb'):
+        old = baseline.get(metric)
+        new = result.get(metric)
+        if old and new and new > old * (1 + threshold):
+            regressions.append('%s: %s went from %g to %g (+%.0f%%)' %
+                               (label, metric, old, new, 100.0 * (new - old) / old))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('--size', type=int, default=50,
+                        help='size of the generated inputs (default: 50)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare against results saved in FILE')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='save the results to FILE')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction by which a result may exceed the '
+                        'baseline (default: 0.2)')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run (default: all of %s)' %
+                        ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    failures = []
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        rows, peak, error = run_isolated(name, args.iterations, args.size)
+        if error:
+            sys.stdout.write('%s: failed: %s\n' % (name, error))
+            failures.append(name)
+            continue
+        for label, count, unit, elapsed in rows:
+            elapsed = max(elapsed, 1e-9)
+            results[label] = {
+                'count': count,
+                'unit': unit,
+                'seconds': elapsed,
+                'seconds_per_unit': elapsed / count,
+                'peak_memory_kb': peak,
+            }
+            sys.stdout.write('%s: %d %s in %.3fs (%.0f/s, %.1fus each), peak %s kB\n' %
+                             (label, count, unit, elapsed, count / elapsed,
+                              elapsed * 1e6 / count, peak))
+            if label in baseline:
+                regressions.extend(compare(label, results[label], baseline[label],
+                                           args.threshold))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if failures:
+        sys.stderr.write('Failed benchmarks: %s\n' % ', '.join(failures))
+    if regressions:
+        sys.stderr.write('Regressions beyond %.0f%%:\n' % (args.threshold * 100))
+        for r in regressions:
+            sys.stderr.write('  %s\n' % r)
+    if failures or regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,58 @@
+'''
+Writes the source of a module whose main function is filled in one
+statement at a time, without holding the whole module. The result is the
+same as meta.dump_python_source of the complete module.
+'''
+
+import ast
+import meta
+
+def strip_prefix(source, prefix):
+    '''
+    Returns source without prefix, which it has to start with.
+    '''
+    if not source.startswith(prefix):
+        raise ValueError('meta wrote unexpected source: %r' % source[:len(prefix)])
+    return source[len(prefix):]
+
+class SourceEmitter(object):
+    '''
+    Writes module to stream in three parts: begin() writes everything up to
+    and including the statements already in function, write() appends a
+    statement to function, and finish() writes the rest of the module.
+
+    meta writes a node by writing its children one after the other, so the
+    source of a statement in a function is what comes after the function's
+    header in the source of the function with only that statement.
+    '''
+    def __init__(self, module, function, stream):
+        self.module = module
+        self.function = function
+        self.stream = stream
+        self.index = module.body.index(function)
+        # What meta writes before any module, and before the first
+        # statement of the function.
+        self.header = meta.dump_python_source(ast.Module([]))
+        self.prefix = meta.dump_python_source(self.wrapper([]))
+
+    def wrapper(self, body):
+        return ast.FunctionDef(self.function.name, self.function.args, body,
+                               self.function.decorator_list)
+
+    def begin(self):
+        head = ast.Module(self.module.body[:self.index + 1])
+        self.stream.write(meta.dump_python_source(head))
+
+    def write(self, stmt):
+        source = meta.dump_python_source(self.wrapper([stmt]))
+        self.stream.write(strip_prefix(source, self.prefix))
+
+    def finish(self, definitions=()):
+        '''
+        Writes the rest of the module, with definitions inserted before its
+        last statement, like hoist_constants does.
+        '''
+        rest = self.module.body[self.index + 1:]
+        tail = ast.Module(rest[:-1] + list(definitions) + rest[-1:])
+        source = meta.dump_python_source(tail)
+        self.stream.write(strip_prefix(source, self.header))
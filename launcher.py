@@ -0,0 +1,86 @@
+'''
+Runs a generated configure script from a cache of its compiled code, so
+that a big script starts without being parsed and compiled again. The
+cache is kept next to the script, as SCRIPT.code, and is used as long as
+it was made from the same source by the same Python version.
+
+    python launcher.py configure.py [ARGS ...]
+
+autoconf.py --compile writes the cache when it writes the script.
+'''
+
+import hashlib
+import imp
+import marshal
+import os
+import sys
+import tempfile
+
+def cache_path(path):
+    return path + '.code'
+
+def header(source):
+    '''
+    Returns what a cache of the code of source starts with: the magic
+    number of the Python version's bytecode and the hash of source.
+    '''
+    return imp.get_magic() + hashlib.sha1(source).hexdigest()
+
+def write_cache(path, source=None):
+    '''
+    Compiles the script at path, whose text is source if given, writes its
+    cache and returns its code.
+    '''
+    if source is None:
+        with open(path, 'rb') as f:
+            source = f.read()
+    code = compile(source, path, 'exec')
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header(source))
+            marshal.dump(code, f)
+        os.rename(tmp, cache_path(path))
+    except (IOError, OSError):
+        # Running the script doesn't depend on the cache.
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
+    return code
+
+def load(path):
+    '''
+    Returns the code of the script at path, from its cache if that is up to
+    date, or else compiling it and updating the cache.
+    '''
+    with open(path, 'rb') as f:
+        source = f.read()
+    expected = header(source)
+    try:
+        with open(cache_path(path), 'rb') as f:
+            if f.read(len(expected)) == expected:
+                return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    return write_cache(path, source)
+
+def run(path, args):
+    '''
+    Runs the script at path as __main__ with the command line arguments
+    args.
+    '''
+    code = load(path)
+    sys.argv = [path] + list(args)
+    sys.path[0] = os.path.dirname(os.path.abspath(path))
+    module = imp.new_module('__main__')
+    module.__file__ = path
+    module.__builtins__ = __builtins__
+    sys.modules['__main__'] = module
+    exec code in module.__dict__
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write('usage: %s SCRIPT [ARGS ...]\n' % sys.argv[0])
+        sys.exit(2)
+    run(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,119 @@
+'''
+Collects where translation time goes: wall time per phase, and time per
+macro and per shell node type. Used by autoconf.py --profile.
+'''
+
+import json
+import time
+
+class Phase(object):
+    '''
+    Context manager that adds the time spent inside it to a phase of a
+    Profiler. Phases can be re-entered recursively; only the outermost
+    entry is timed.
+    '''
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        depth = self.profiler.phase_depth.get(self.name, 0)
+        self.profiler.phase_depth[self.name] = depth + 1
+        if depth == 0:
+            self.start = time.time()
+        else:
+            self.start = None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.phase_depth[self.name] -= 1
+        if self.start is not None:
+            self.profiler.add_phase_time(self.name, time.time() - self.start)
+        return False
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+NULL_PHASE = NullPhase()
+
+def phase(profiler, name):
+    '''
+    Returns a context manager timing phase `name` on profiler, which may be
+    None.
+    '''
+    if profiler is None:
+        return NULL_PHASE
+    return Phase(profiler, name)
+
+class Profiler(object):
+    '''
+    Phases may nest inside each other: the m4 phase includes the
+    re-expansion of macro arguments, and the shell parse and translation of
+    the arguments of MOZ_ARG_* macros.
+
+    Macros and shell nodes are timed with enter() and leave(). Each entry
+    records the number of calls, the total time, and the self time, which
+    excludes the macros and nodes nested inside it.
+    '''
+    def __init__(self):
+        self.phase_names = []
+        self.phase_times = {}
+        self.phase_depth = {}
+        self.tables = {'macros': {}, 'nodes': {}}
+        self._children = []
+
+    def add_phase_time(self, name, elapsed):
+        if name not in self.phase_times:
+            self.phase_names.append(name)
+            self.phase_times[name] = 0.0
+        self.phase_times[name] += elapsed
+
+    def enter(self):
+        self._children.append(0.0)
+        return time.time()
+
+    def leave(self, table, name, start):
+        elapsed = time.time() - start
+        children = self._children.pop()
+        if self._children:
+            self._children[-1] += elapsed
+        entry = self.tables[table].get(name)
+        if entry is None:
+            entry = self.tables[table][name] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += elapsed - children
+
+    def top(self, table, count):
+        '''
+        Returns the `count` most expensive entries of a table as
+        (name, calls, total, self) tuples.
+        '''
+        entries = sorted(self.tables[table].iteritems(),
+                         key=lambda item: (-item[1][1], item[0]))
+        return [(name, calls, total, self_time)
+                for name, (calls, total, self_time) in entries[:count]]
+
+    def as_json(self, count):
+        def rows(table):
+            return [{'name': name, 'calls': calls, 'total': total, 'self': self_time}
+                    for name, calls, total, self_time in self.top(table, count)]
+        return json.dumps({
+            'phases': [{'name': name, 'seconds': self.phase_times[name]}
+                       for name in self.phase_names],
+            'macros': rows('macros'),
+            'nodes': rows('nodes'),
+        }, indent=2, sort_keys=True)
+
+    def report(self, stream, count):
+        stream.write('%-40s %10s\n' % ('phase', 'seconds'))
+        for name in self.phase_names:
+            stream.write('%-40s %10.3f\n' % (name, self.phase_times[name]))
+        for table, title in (('macros', 'macro'), ('nodes', 'shell node')):
+            stream.write('\n%-40s %8s %10s %10s\n' % (title, 'calls', 'total', 'self'))
+            for name, calls, total, self_time in self.top(table, count):
+                stream.write('%-40s %8d %10.3f %10.3f\n' % (name, calls, total, self_time))
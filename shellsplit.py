@@ -0,0 +1,272 @@
+'''
+Splits a shell script into its top-level complete commands without fully
+parsing it, so that the pieces can be handed to pyshyacc separately.
+
+This is a scanner, not a parser: it tracks quoting, command substitutions,
+here-documents and the reserved words that open and close compound
+commands, which is enough to find the newlines that end a top-level
+command. Callers must still cope with a chunk that doesn't parse on its own.
+'''
+
+# Reserved words that open a compound command, and the word that closes it.
+OPENERS = {
+    'if': 'fi',
+    'case': 'esac',
+    'for': 'done',
+    'while': 'done',
+    'until': 'done',
+    '{': '}',
+}
+
+# Reserved words after which another command starts.
+COMMAND_PREFIXES = set(['then', 'else', 'elif', 'do', '!'])
+
+BREAK_CHARS = set(' \t\n;&|()<>')
+
+class Case:
+    '''
+    An open case statement, tracking whether we are in its subject word,
+    in a pattern list or in the commands of an arm.
+    '''
+    closer = 'esac'
+
+    def __init__(self):
+        self.state = 'subject'
+
+def _skip_quoted(shell, i):
+    '''
+    Skips over the quoted string, command substitution or parameter
+    expansion starting at shell[i], returning the index just after it.
+    '''
+    n = len(shell)
+    stack = []
+    while True:
+        if i >= n:
+            return n
+        c = shell[i]
+        top = stack[-1] if stack else None
+        if top == "'":
+            if c == "'":
+                stack.pop()
+            i += 1
+        elif c == '\\':
+            i += 2
+        elif c == '"' and top == '"':
+            stack.pop()
+            i += 1
+        elif c == '`' and top == '`':
+            stack.pop()
+            i += 1
+        elif c == ')' and top == '(':
+            stack.pop()
+            i += 1
+        elif c == '}' and top == '{':
+            stack.pop()
+            i += 1
+        elif c == "'" and top != '"':
+            stack.append("'")
+            i += 1
+        elif c in '"`':
+            stack.append(c)
+            i += 1
+        elif c == '$' and shell[i+1:i+2] in ('(', '{'):
+            stack.append(shell[i+1])
+            i += 2
+        elif c == '(' and top == '(':
+            stack.append('(')
+            i += 1
+        else:
+            i += 1
+        if not stack:
+            return i
+
+def _heredoc_delimiter(shell, i):
+    '''
+    Reads the here-document delimiter word starting at shell[i]. Returns
+    (delimiter, strip_tabs, index after the word).
+    '''
+    strip_tabs = False
+    if shell[i:i+1] == '-':
+        strip_tabs = True
+        i += 1
+    while shell[i:i+1] in (' ', '\t'):
+        i += 1
+    start = i
+    while i < len(shell) and shell[i] not in BREAK_CHARS:
+        i += 1
+    word = shell[start:i]
+    for q in ('"', "'", '\\'):
+        word = word.replace(q, '')
+    return word, strip_tabs, i
+
+def _skip_heredocs(shell, i, heredocs):
+    '''
+    Skips the bodies of pending here-documents, starting at the beginning
+    of the line at shell[i].
+    '''
+    for delimiter, strip_tabs in heredocs:
+        while i < len(shell):
+            end = shell.find('\n', i)
+            if end == -1:
+                end = len(shell)
+            line = shell[i:end]
+            i = end + 1
+            if strip_tabs:
+                line = line.lstrip('\t')
+            if line == delimiter:
+                break
+    return min(i, len(shell))
+
+def split_toplevel(shell):
+    '''
+    Returns a list of strings that concatenate back to shell, each holding
+    one or more complete top-level commands. If the structure of the script
+    can't be followed, the whole script is returned as a single chunk.
+    '''
+    chunks = []
+    chunk_start = 0
+    stack = []
+    heredocs = []
+    command_position = True
+    # Set after |, && and ||, which continue the command on the next line.
+    continued = False
+    i = 0
+    n = len(shell)
+    while i < n:
+        c = shell[i]
+        case = stack[-1] if stack and isinstance(stack[-1], Case) else None
+        if c in ' \t':
+            i += 1
+        elif c == '\n':
+            i += 1
+            if heredocs:
+                i = _skip_heredocs(shell, i, heredocs)
+                heredocs = []
+            if not stack and not continued:
+                chunks.append(shell[chunk_start:i])
+                chunk_start = i
+            if not case or case.state != 'pattern':
+                command_position = True
+        elif c == '#':
+            end = shell.find('\n', i)
+            i = n if end == -1 else end
+        elif c == ';':
+            if shell[i:i+2] == ';;':
+                if case:
+                    case.state = 'pattern'
+                i += 2
+            else:
+                i += 1
+            command_position = True
+            continued = False
+        elif c in '&|':
+            if case and case.state == 'pattern':
+                # alternatives in a pattern list
+                i += 1
+                continue
+            if shell[i:i+2] in ('&&', '||'):
+                i += 2
+                continued = True
+            else:
+                continued = c == '|'
+                i += 1
+            command_position = True
+        elif c == '(':
+            if case and case.state == 'pattern':
+                i += 1
+            elif command_position:
+                stack.append(')')
+                i += 1
+            else:
+                # function definition: name (), whose body may start on
+                # the next line
+                i += 1
+                while shell[i:i+1] in (' ', '\t'):
+                    i += 1
+                if shell[i:i+1] == ')':
+                    i += 1
+                command_position = True
+                continued = True
+        elif c == ')':
+            i += 1
+            if case and case.state == 'pattern':
+                case.state = 'body'
+                command_position = True
+            elif stack and stack[-1] == ')':
+                stack.pop()
+                command_position = False
+        elif c in '<>':
+            if shell[i:i+2] == '<<' and shell[i+2:i+3] != '<':
+                delimiter, strip_tabs, i = _heredoc_delimiter(shell, i + 2)
+                heredocs.append((delimiter, strip_tabs))
+            else:
+                i += 1
+                while i < n and shell[i] in '<>&|':
+                    i += 1
+            command_position = False
+            continued = False
+        else:
+            # a word
+            start = i
+            while i < n and shell[i] not in BREAK_CHARS:
+                if shell[i] in '\'"`' or (shell[i] == '$' and shell[i+1:i+2] in ('(', '{')):
+                    i = _skip_quoted(shell, i)
+                elif shell[i] == '\\':
+                    i += 2
+                else:
+                    i += 1
+            word = shell[start:i]
+            continued = False
+            if word == '\\\n':
+                # line continuation between words
+                continue
+            if case and case.state == 'subject':
+                if word == 'in':
+                    case.state = 'pattern'
+                continue
+            if case and case.state == 'pattern':
+                if word == 'esac':
+                    stack.pop()
+                    command_position = False
+                continue
+            if not command_position:
+                continue
+            if word in OPENERS:
+                if word == 'case':
+                    stack.append(Case())
+                    command_position = False
+                else:
+                    stack.append(OPENERS[word])
+                    command_position = word != 'for'
+            elif word in COMMAND_PREFIXES:
+                command_position = True
+            elif stack and word == getattr(stack[-1], 'closer', stack[-1]):
+                stack.pop()
+                command_position = False
+            else:
+                command_position = False
+    if stack:
+        return [shell]
+    if chunk_start < n:
+        chunks.append(shell[chunk_start:])
+    return chunks
+
+def group_chunks(chunks, count):
+    '''
+    Joins consecutive chunks into about `count` strings of similar length.
+    '''
+    total = sum(len(c) for c in chunks)
+    target = max(1, total // max(1, count))
+    groups = []
+    current = []
+    size = 0
+    for c in chunks:
+        current.append(c)
+        size += len(c)
+        if size >= target:
+            groups.append(''.join(current))
+            current = []
+            size = 0
+    if current:
+        groups.append(''.join(current))
+    return groups
@@ -1,23 +1,97 @@
 import argparse
+import atexit
 import fnmatch
+import hashlib
+import importlib
+import marshal
+import multiprocessing
 import os
+import re
+import shlex
+import shutil
 import string
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-from collections import defaultdict
+from collections import Counter
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 SUBSTS = set()
 
 def make_arg_parser():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-file', default='config.cache', metavar='FILE',
+                        help='cache test results in FILE')
+    parser.add_argument('--memoize-substitutions', action='store_true',
+                        help='run each side-effect-free command substitution '
+                        'once for each set of inputs')
+    parser.add_argument('--eager-units', action='store_true',
+                        help='run every check of a script translated with --lazy, '
+                        'whether its results are used or not')
+    parser.add_argument('--unit-jobs', type=int, default=1, metavar='JOBS',
+                        help='run the units of a script translated with --lazy '
+                        'in JOBS threads (0 means one per CPU)')
+    parser.add_argument('--runtime-stats', action='store_true',
+                        help='write statistics about commands run to stderr at exit')
     return parser
 
+class Vars(dict):
+    '''
+    The configure variables. Unset variables read as empty strings, as in
+    the shell.
+    '''
+    def __missing__(self, key):
+        return ''
+
+
+class FormatLookup(object):
+    def __init__(self, vars, extra):
+        self.vars = vars
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        return self.vars.get(key, '')
+
+
+FORMATTER = string.Formatter()
+
 def format(s, vars, extra):
-    d = defaultdict(str, vars)
-    for k, v in extra.iteritems():
-        d[k] = v
-    return string.Formatter().vformat(s, (), d)
+    return FORMATTER.vformat(s, (), FormatLookup(vars, extra))
+
+
+class Format(object):
+    '''
+    A string with {name} references to variables, parsed once. Calling it
+    with the variables and extra values (the output of commands) fills in
+    the references, at a cost that only depends on how many there are.
+    '''
+    def __init__(self, s):
+        self.s = s
+        self.parts = []
+        self.simple = True
+        for literal, field, spec, conversion in FORMATTER.parse(s):
+            if spec or conversion:
+                self.simple = False
+            self.parts.append((literal, field))
+
+    def __call__(self, vars, extra):
+        if not self.simple:
+            return format(self.s, vars, extra)
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                if field in extra:
+                    out.append(extra[field])
+                else:
+                    out.append(vars[field])
+        return ''.join(out)
 
 
 class quoted:
@@ -25,23 +99,1232 @@ class quoted:
         self.q = q
 
 
+GLOB_CHARS = re.compile(r'[*?[]')
+
+def glob_regex(pattern):
+    regex = fnmatch.translate(pattern)
+    # Python 2 puts the flags at the end, where they can't stay once the
+    # pattern is part of a bigger regex.
+    if regex.endswith('(?ms)'):
+        regex = regex[:-5]
+    return regex
+
+
+class CaseDispatch(object):
+    '''
+    Finds the first arm of a case statement with a pattern matching a word.
+    arms has a tuple of patterns for each arm, or None for arms whose
+    patterns are only known at runtime. Those are passed to the call as
+    functions returning the patterns, by arm number, and matched with
+    fnmatch. Runs of other arms are matched at once: exact strings with a
+    dict, and globs with regexes of up to GROUPS_PER_REGEX arms each, as
+    Python 2 limits the number of groups in a regex.
+    '''
+    GROUPS_PER_REGEX = 90
+
+    def __init__(self, arms):
+        self.segments = []
+        run = []
+        for i, arm in enumerate(arms):
+            if arm is None:
+                if run:
+                    self.segments.append(self.compile(run))
+                    run = []
+                self.segments.append(i)
+            else:
+                run.append((i, arm))
+        if run:
+            self.segments.append(self.compile(run))
+
+    def compile(self, arms):
+        exact = {}
+        globs = []
+        for i, patterns in arms:
+            regexes = []
+            for p in patterns:
+                if GLOB_CHARS.search(p):
+                    regexes.append(glob_regex(p))
+                else:
+                    exact.setdefault(p, i)
+            if regexes:
+                globs.append((i, '(?P<a%d>%s)' % (i, '|'.join(regexes))))
+        compiled = []
+        for start in range(0, len(globs), self.GROUPS_PER_REGEX):
+            chunk = globs[start:start + self.GROUPS_PER_REGEX]
+            compiled.append((chunk[0][0], re.compile('|'.join([g for i, g in chunk]), re.S)))
+        return exact, compiled
+
+    def __call__(self, word, dynamic=None):
+        '''
+        Returns the number of the matching arm, or -1.
+        '''
+        for segment in self.segments:
+            if isinstance(segment, int):
+                for p in dynamic[segment]():
+                    if fnmatch.fnmatch(word, p):
+                        return segment
+                continue
+            exact, regexes = segment
+            arm = exact.get(word, -1)
+            for first, regex in regexes:
+                if arm != -1 and first > arm:
+                    break
+                m = regex.match(word)
+                if m:
+                    found = int(m.lastgroup[1:])
+                    if arm == -1 or found < arm:
+                        arm = found
+                    break
+            if arm != -1:
+                return arm
+        return -1
+
+
 def for_loop(things, vars, extra):
+    '''
+    Yields the words of a for loop's list. things are Formats, and quoted
+    Formats that expand to a single word.
+    '''
     for t in things:
         if isinstance(t, quoted):
-            yield format(t.q, vars, extra)
+            yield t.q(vars, extra)
         else:
-            for x in format(t, vars, extra).split():
+            for x in t(vars, extra).split():
                 yield x
 
 
+# Compiler, flags variable and source extension for each AC_LANG.
+LANGUAGES = {
+    'C': ('CC', 'cc', 'CFLAGS', '.c'),
+    'C++': ('CXX', 'c++', 'CXXFLAGS', '.cpp'),
+}
+
+# The variables a probe's command gets from vars. The rest of its
+# environment is the one the script started with. A probe is only started
+# ahead of the script if none of these change in between (PROBE_INPUTS in
+# autoconf.py), so it runs as it would have where it was.
+PROBE_ENV = ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LIBS', 'PATH']
+
+class Probes(object):
+    '''
+    Runs compiler probes in a pool of threads. submit() starts a probe with
+    the compiler, flags and PATH found in vars at the time of the call, and
+    returns an object whose get() waits for the probe and returns whether
+    it succeeded. Identical probes only run once.
+    '''
+    def __init__(self, jobs=None):
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.pool = None
+        self.scratch = None
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.pool = ThreadPool(self.jobs)
+        self.scratch = tempfile.mkdtemp(prefix='conftest')
+        atexit.register(shutil.rmtree, self.scratch, True)
+
+    def submit(self, vars, lang, kind, source, libs='', flags=''):
+        compiler_var, default_compiler, flags_var, ext = LANGUAGES[lang]
+        command = (shlex.split(vars.get(compiler_var) or default_compiler) +
+                   shlex.split(vars.get(flags_var, '')) +
+                   shlex.split(vars.get('CPPFLAGS', '')) +
+                   shlex.split(flags))
+        if kind == 'compile':
+            command += ['-c', 'conftest' + ext, '-o', 'conftest.o']
+        else:
+            command += (['conftest' + ext, '-o', 'conftest'] +
+                        shlex.split(vars.get('LDFLAGS', '')) +
+                        shlex.split(libs) +
+                        shlex.split(vars.get('LIBS', '')))
+        env = dict(os.environ)
+        for name in PROBE_ENV:
+            if name in vars:
+                env[name] = vars[name]
+            else:
+                env.pop(name, None)
+        key = (tuple(command), source, env.get('PATH'))
+        # Units running in parallel submit probes from many threads.
+        with self.lock:
+            result = self.results.get(key)
+            if result is None:
+                if self.pool is None:
+                    self.start()
+                result = self.pool.apply_async(self.run, (command, source, ext, env))
+                self.results[key] = result
+        return result
+
+    def run(self, command, source, ext, env):
+        directory = tempfile.mkdtemp(dir=self.scratch)
+        try:
+            with open(os.path.join(directory, 'conftest' + ext), 'w') as f:
+                f.write(source)
+            with open(os.devnull, 'w') as null:
+                return subprocess.call(command, cwd=directory, env=env,
+                                       stdout=null, stderr=null) == 0
+        except OSError:
+            # No such compiler.
+            return False
+        finally:
+            shutil.rmtree(directory, True)
+
+
+# The variables whose values, along with the compilers they name, make up
+# the fingerprint of cached values.
+FINGERPRINT_VARS = ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LIBS']
+
+class ConfigCache(object):
+    '''
+    Values of cache variables (AC_CACHE_VAL), kept between runs in a single
+    marshal file that is read once at startup and written back at exit.
+    Each value is stored with a fingerprint of the compilers and flags in
+    use when it was computed, and is ignored once those change.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.compilers = {}
+        if not path or path == os.devnull:
+            self.path = None
+        else:
+            self.load()
+            atexit.register(self.save)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                entries = marshal.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+
+    def compiler_identity(self, command, path):
+        '''
+        Returns a string identifying the executable that runs for command,
+        by its location, size and modification time.
+        '''
+        key = (command, path)
+        identity = self.compilers.get(key)
+        if identity is None:
+            words = shlex.split(command)
+            identity = command
+            for word in words[:2]:
+                # skip wrappers like ccache to the compiler itself
+                for d in ([''] if os.sep in word else path.split(os.pathsep)):
+                    exe = os.path.join(d, word)
+                    if os.path.isfile(exe):
+                        st = os.stat(exe)
+                        identity += '\0%s:%d:%d' % (os.path.abspath(exe), st.st_size, st.st_mtime)
+                        break
+            self.compilers[key] = identity
+        return identity
+
+    def fingerprint(self, vars):
+        h = hashlib.sha1()
+        for v in FINGERPRINT_VARS:
+            value = vars.get(v, '')
+            if v in ('CC', 'CXX') and value:
+                value = self.compiler_identity(value, vars.get('PATH', os.defpath))
+            h.update('%s=%s\0' % (v, value))
+        return h.hexdigest()
+
+    def lookup(self, vars, var):
+        '''
+        Returns the cached value of var, or None if there is none for the
+        current compilers and flags.
+        '''
+        entry = self.entries.get(var)
+        if entry is None or entry[0] != self.fingerprint(vars):
+            return None
+        return entry[1]
+
+    def store(self, vars, var):
+        if self.path is not None and var in vars:
+            self.entries[var] = (self.fingerprint(vars), vars[var])
+            self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            self.write()
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp = None
+        try:
+            # Write a temporary file and rename it into place, so an
+            # interrupted run never leaves a truncated cache behind.
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(self.entries, f)
+            os.rename(tmp, self.path)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            sys.stderr.write('configure: warning: could not write %s: %s\n' % (self.path, e))
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+class Unsupported(Exception):
+    '''
+    Raised by the in-process utilities for options and inputs they don't
+    implement, before doing anything. The command then runs in a shell.
+    '''
+
+
+def bre_regex(bre):
+    '''
+    Translates a POSIX basic regular expression to a Python one.
+    '''
+    out = []
+    i = 0
+    while i < len(bre):
+        c = bre[i]
+        if c == '\\':
+            i += 1
+            if i == len(bre):
+                raise Unsupported()
+            c = bre[i]
+            if c.isalpha() or c in '+?|':
+                # GNU extensions like \w and \+
+                raise Unsupported()
+            if c in '(){}':
+                out.append(c)
+            elif c.isdigit():
+                out.append('\\' + c)
+            else:
+                out.append(re.escape(c))
+        elif c == '[':
+            start = i + 1
+            if bre[start:start + 1] == '^':
+                start += 1
+            # a ] right after the [ or [^ is part of the set
+            end = bre.find(']', start + 1)
+            body = bre[i + 1:end]
+            if end == -1 or '[' in body:
+                # unterminated, or [:class:] and the like
+                raise Unsupported()
+            negate = body.startswith('^')
+            if negate:
+                body = body[1:]
+            out.append('[' + ('^' if negate else '') + body.replace('\\', '\\\\') + ']')
+            i = end
+        elif c in '+?|(){}':
+            out.append('\\' + c)
+        elif c == '*' and (not out or out[-1] in ('^', '(')):
+            # a leading * is literal
+            out.append('\\*')
+        else:
+            out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+def parse_options(args, allowed):
+    '''
+    Splits leading single-letter options off args. Returns the set of
+    options and the remaining arguments.
+    '''
+    options = set()
+    while args and args[0].startswith('-') and len(args[0]) > 1:
+        if args[0] == '--':
+            return options, args[1:]
+        for o in args[0][1:]:
+            if o not in allowed:
+                raise Unsupported()
+            options.add(o)
+        args = args[1:]
+    return options, args
+
+
+# The in-process utilities take their arguments, their standard input (None
+# if there is none) and a stream for error messages, and return their exit
+# status and output.
+
+def utility_true(args, input, err):
+    return 0, ''
+
+def utility_false(args, input, err):
+    return 1, ''
+
+def utility_echo(args, input, err):
+    newline = '\n'
+    if args and args[0] == '-n':
+        newline = ''
+        args = args[1:]
+    for a in args:
+        if '\\' in a:
+            # escape sequences differ between shells
+            raise Unsupported()
+    return 0, ' '.join(args) + newline
+
+def utility_cat(args, input, err):
+    options, files = parse_options(args, '')
+    out = []
+    status = 0
+    for f in files or ['-']:
+        if f == '-':
+            if input is None:
+                raise Unsupported()
+            out.append(input)
+        else:
+            try:
+                with open(f, 'rb') as fh:
+                    out.append(fh.read())
+            except IOError as e:
+                err.write('cat: %s: %s\n' % (f, e.strerror))
+                status = 1
+    return status, ''.join(out)
+
+def utility_mkdir(args, input, err):
+    options, dirs = parse_options(args, 'p')
+    if not dirs:
+        raise Unsupported()
+    status = 0
+    for d in dirs:
+        try:
+            if 'p' not in options:
+                os.mkdir(d)
+            elif not os.path.isdir(d):
+                os.makedirs(d)
+        except OSError as e:
+            err.write('mkdir: cannot create directory %s: %s\n' % (d, e.strerror))
+            status = 1
+    return status, ''
+
+def utility_rm(args, input, err):
+    options, files = parse_options(args, 'frR')
+    status = 0
+    for f in files:
+        try:
+            if not os.path.isdir(f) or os.path.islink(f):
+                os.unlink(f)
+            elif options & set('rR'):
+                shutil.rmtree(f)
+            else:
+                err.write('rm: cannot remove %s: Is a directory\n' % f)
+                status = 1
+        except OSError as e:
+            if 'f' not in options or os.path.lexists(f):
+                err.write('rm: cannot remove %s: %s\n' % (f, e.strerror))
+                status = 1
+    return status, ''
+
+def utility_touch(args, input, err):
+    options, files = parse_options(args, '')
+    status = 0
+    for f in files:
+        try:
+            with open(f, 'a'):
+                os.utime(f, None)
+        except (IOError, OSError) as e:
+            err.write('touch: cannot touch %s: %s\n' % (f, e.strerror))
+            status = 1
+    return status, ''
+
+def utility_basename(args, input, err):
+    if not 1 <= len(args) <= 2 or args[0].startswith('-'):
+        raise Unsupported()
+    path = args[0].rstrip('/')
+    if not path:
+        base = '/' if args[0] else ''
+    else:
+        base = path.rsplit('/', 1)[-1]
+        if len(args) == 2 and args[1] and base != args[1] and base.endswith(args[1]):
+            base = base[:-len(args[1])]
+    return 0, base + '\n'
+
+def utility_dirname(args, input, err):
+    if len(args) != 1 or args[0].startswith('-'):
+        raise Unsupported()
+    path = args[0].rstrip('/')
+    if '/' not in path:
+        directory = '/' if args[0].startswith('/') else '.'
+    else:
+        directory = path.rsplit('/', 1)[0].rstrip('/') or '/'
+    return 0, directory + '\n'
+
+def tr_set(spec):
+    chars = []
+    i = 0
+    while i < len(spec):
+        c = spec[i]
+        if c == '[':
+            # classes and repeats
+            raise Unsupported()
+        if c == '\\' and i + 1 < len(spec):
+            i += 1
+            c = {'n': '\n', 't': '\t', '\\': '\\'}.get(spec[i])
+            if c is None:
+                raise Unsupported()
+        if spec[i + 1:i + 2] == '-' and i + 2 < len(spec):
+            chars.extend([chr(x) for x in range(ord(c), ord(spec[i + 2]) + 1)])
+            i += 3
+        else:
+            chars.append(c)
+            i += 1
+    return ''.join(chars)
+
+def utility_tr(args, input, err):
+    options, sets = parse_options(args, 'd')
+    if input is None or len(sets) != (1 if options else 2):
+        raise Unsupported()
+    if 'd' in options:
+        return 0, input.translate(None, tr_set(sets[0]))
+    from_chars, to_chars = tr_set(sets[0]), tr_set(sets[1])
+    if not from_chars or not to_chars:
+        raise Unsupported()
+    to_chars = to_chars[:len(from_chars)].ljust(len(from_chars), to_chars[-1])
+    return 0, input.translate(string.maketrans(from_chars, to_chars))
+
+def sed_substitution(script):
+    '''
+    Parses a sed s command. Returns the compiled regex, the replacement as
+    a list of strings and group numbers, and whether it is global.
+    '''
+    if len(script) < 4 or script[0] != 's' or script[1] in '\\\n':
+        raise Unsupported()
+    delimiter = script[1]
+    parts = []
+    current = []
+    i = 2
+    while i < len(script) and len(parts) < 2:
+        c = script[i]
+        if c == '\\' and i + 1 < len(script):
+            if script[i + 1] == delimiter:
+                current.append(delimiter)
+            else:
+                current.append(script[i:i + 2])
+            i += 2
+        else:
+            if c == delimiter:
+                parts.append(''.join(current))
+                current = []
+            else:
+                current.append(c)
+            i += 1
+    flags = script[i:]
+    if len(parts) != 2 or flags not in ('', 'g') or not parts[0]:
+        raise Unsupported()
+    regex = None
+    try:
+        regex = re.compile(bre_regex(parts[0]))
+    except re.error:
+        pass
+    if regex is None:
+        raise Unsupported()
+    replacement = []
+    text = parts[1]
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '&':
+            replacement.append(0)
+        elif c == '\\' and i + 1 < len(text):
+            i += 1
+            if text[i].isdigit():
+                replacement.append(int(text[i]))
+            elif text[i] == 'n':
+                replacement.append('\n')
+            else:
+                replacement.append(text[i])
+        else:
+            replacement.append(c)
+        i += 1
+    return regex, replacement, flags == 'g'
+
+def sed_replace(replacement, m):
+    out = []
+    for r in replacement:
+        if isinstance(r, int):
+            out.append(m.group(r) or '')
+        else:
+            out.append(r)
+    return ''.join(out)
+
+def utility_sed(args, input, err):
+    scripts = []
+    while len(args) > 1 and args[0] == '-e':
+        scripts.append(args[1])
+        args = args[2:]
+    if not scripts:
+        if not args or args[0].startswith('-'):
+            raise Unsupported()
+        scripts.append(args[0])
+        args = args[1:]
+    commands = []
+    for script in scripts:
+        for command in script.split(';'):
+            command = command.strip()
+            if command:
+                commands.append(sed_substitution(command))
+    status, data = utility_cat(args, input, err)
+    out = []
+    for line in data.splitlines(True):
+        newline = '\n' if line.endswith('\n') else ''
+        line = line[:len(line) - len(newline)]
+        for regex, replacement, replace_all in commands:
+            line = regex.sub(lambda m: sed_replace(replacement, m), line,
+                             0 if replace_all else 1)
+        out.append(line + newline)
+    return status, ''.join(out)
+
+def is_null(v):
+    return v in ('', '0')
+
+class ExprParser(object):
+    '''
+    Evaluates the arguments of expr(1).
+    '''
+    COMPARISONS = ('=', '!=', '<', '<=', '>', '>=')
+
+    def __init__(self, args):
+        self.args = args
+        self.i = 0
+
+    def peek(self):
+        if self.i < len(self.args):
+            return self.args[self.i]
+        return None
+
+    def next(self):
+        self.i += 1
+        return self.args[self.i - 1]
+
+    def parse(self):
+        v = self.alternation()
+        if self.i != len(self.args):
+            raise Unsupported()
+        return v
+
+    def alternation(self):
+        v = self.conjunction()
+        while self.peek() == '|':
+            self.next()
+            w = self.conjunction()
+            if is_null(v):
+                v = '0' if is_null(w) else w
+        return v
+
+    def conjunction(self):
+        v = self.comparison()
+        while self.peek() == '&':
+            self.next()
+            w = self.comparison()
+            if is_null(v) or is_null(w):
+                v = '0'
+        return v
+
+    def comparison(self):
+        v = self.addition()
+        while self.peek() in self.COMPARISONS:
+            op = self.next()
+            w = self.addition()
+            try:
+                a, b = int(v), int(w)
+            except ValueError:
+                a, b = v, w
+            v = str(int({'=': a == b, '!=': a != b, '<': a < b, '<=': a <= b,
+                         '>': a > b, '>=': a >= b}[op]))
+        return v
+
+    def addition(self):
+        v = self.multiplication()
+        while self.peek() in ('+', '-'):
+            op = self.next()
+            w = self.multiplication()
+            if op == '+':
+                v = str(int(v) + int(w))
+            else:
+                v = str(int(v) - int(w))
+        return v
+
+    def multiplication(self):
+        v = self.match()
+        while self.peek() in ('*', '/', '%'):
+            op = self.next()
+            a, b = int(v), int(self.match())
+            if op != '*' and b == 0:
+                raise Unsupported()
+            if op == '*':
+                v = str(a * b)
+            else:
+                # expr truncates towards zero
+                q = abs(a) // abs(b)
+                if (a < 0) != (b < 0):
+                    q = -q
+                v = str(q if op == '/' else a - b * q)
+        return v
+
+    def match(self):
+        v = self.primary()
+        while self.peek() == ':':
+            self.next()
+            regex = re.compile(bre_regex(self.next()))
+            m = regex.match(v)
+            if regex.groups:
+                v = (m.group(1) or '') if m else ''
+            else:
+                v = str(m.end() if m else 0)
+        return v
+
+    def primary(self):
+        if self.peek() == '(':
+            self.next()
+            v = self.alternation()
+            if self.next() != ')':
+                raise Unsupported()
+            return v
+        return self.next()
+
+def utility_expr(args, input, err):
+    v = None
+    try:
+        v = ExprParser(args).parse()
+    except (IndexError, ValueError, re.error):
+        pass
+    if v is None:
+        # let the shell report the error
+        raise Unsupported()
+    return (1 if is_null(v) else 0), v + '\n'
+
+def utility_cp(args, input, err):
+    options, files = parse_options(args, 'f')
+    if len(files) != 2 or os.path.isdir(files[0]):
+        raise Unsupported()
+    try:
+        shutil.copy(files[0], files[1])
+    except (IOError, OSError) as e:
+        err.write('cp: cannot copy %s to %s: %s\n' % (files[0], files[1], e.strerror))
+        return 1, ''
+    return 0, ''
+
+def utility_mv(args, input, err):
+    options, files = parse_options(args, 'f')
+    if len(files) != 2:
+        raise Unsupported()
+    try:
+        shutil.move(files[0], files[1])
+    except (IOError, OSError, shutil.Error) as e:
+        err.write('mv: cannot move %s to %s: %s\n' % (files[0], files[1], e))
+        return 1, ''
+    return 0, ''
+
+def utility_ln(args, input, err):
+    options, files = parse_options(args, 'sf')
+    if len(files) != 2:
+        raise Unsupported()
+    target, link = files
+    if os.path.isdir(link) and not os.path.islink(link):
+        link = os.path.join(link, os.path.basename(target))
+    try:
+        if 'f' in options and os.path.lexists(link):
+            os.unlink(link)
+        if 's' in options:
+            os.symlink(target, link)
+        else:
+            os.link(target, link)
+    except OSError as e:
+        err.write('ln: cannot create link %s: %s\n' % (link, e.strerror))
+        return 1, ''
+    return 0, ''
+
+UTILITIES = {
+    'true': utility_true,
+    ':': utility_true,
+    'false': utility_false,
+    'echo': utility_echo,
+    'cat': utility_cat,
+    'mkdir': utility_mkdir,
+    'rm': utility_rm,
+    'touch': utility_touch,
+    'basename': utility_basename,
+    'dirname': utility_dirname,
+    'tr': utility_tr,
+    'sed': utility_sed,
+    'expr': utility_expr,
+    'cp': utility_cp,
+    'mv': utility_mv,
+    'ln': utility_ln,
+}
+
+# The utilities that change files. They only run as the last command of a
+# pipeline, so that a later command can't turn out to be unsupported after
+# they ran, and then run again in the shell.
+SIDE_EFFECT_UTILITIES = frozenset(['mkdir', 'rm', 'touch', 'cp', 'mv', 'ln'])
+
+
+class Utilities(object):
+    '''
+    Runs pipelines of the UTILITIES in-process, saving a fork of /bin/sh
+    for each. Anything they don't support runs in a shell instead.
+    '''
+    def __init__(self):
+        self.stats = Counter()
+
+    def call(self, pipeline, fallback, vars, stdin=None, stdout=None,
+             append=False, stderr=None):
+        '''
+        Runs pipeline, a list of argument lists. fallback is the command
+        line to run in a shell instead, as a string or a Format of vars.
+        Returns the exit status of the last command.
+        '''
+        try:
+            status, output, errors = self.run(pipeline, stdin)
+        except Unsupported:
+            self.stats['shell_fallbacks'] += 1
+            if isinstance(fallback, Format):
+                fallback = fallback(vars, {})
+            sys.stdout.flush()
+            return subprocess.call(fallback, shell=True, env=vars)
+        self.stats['in_process'] += 1
+        if not self.write(stdout, output, sys.stdout, append):
+            status = 1
+        if not self.write(stderr, errors, sys.stderr, False):
+            status = 1
+        return status
+
+    def run(self, pipeline, stdin):
+        argvs = [list(argv) for argv in pipeline]
+        for argv in argvs:
+            if not argv or argv[0] not in UTILITIES:
+                raise Unsupported()
+        for argv in argvs[:-1]:
+            if argv[0] in SIDE_EFFECT_UTILITIES:
+                raise Unsupported()
+        data = None
+        if stdin is not None:
+            try:
+                with open(stdin, 'rb') as f:
+                    data = f.read()
+            except IOError:
+                pass
+            if data is None:
+                # let the shell report it
+                raise Unsupported()
+        errors = StringIO()
+        status = 0
+        for argv in argvs:
+            status, data = UTILITIES[argv[0]](argv[1:], data, errors)
+        return status, data, errors.getvalue()
+
+    def write(self, path, data, default, append):
+        '''
+        Writes data to the file at path, or to default if path is None.
+        Returns False if the file can't be written, which the shell reports
+        as a failure of the command.
+        '''
+        written = True
+        if path is None:
+            default.write(data)
+        else:
+            try:
+                with open(path, 'ab' if append else 'wb') as f:
+                    f.write(data)
+            except IOError as e:
+                sys.stderr.write('%s: %s\n' % (path, e.strerror))
+                written = False
+        return written
+
+
+# The system calls that checking a file takes (stat and access), and that
+# listing a directory takes (open, getdents and close).
+CHECK_SYSCALLS = 2
+LISTING_SYSCALLS = 3
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+class Programs(object):
+    '''
+    Finds programs for AC_PATH_PROG and friends. The directories of a search
+    path are each listed once, into a map from the names in them to the
+    directories they are in, which is kept for as long as the path stays
+    the same. A lookup then only checks the candidates the map has, instead
+    of every directory in turn for every name.
+    '''
+    def __init__(self):
+        self.indexes = {}
+        self.stats = Counter()
+        # Lookups can run in parallel units.
+        self.lock = threading.Lock()
+
+    def index(self, path):
+        index = self.indexes.get(path)
+        if index is None:
+            dirs = [d or '.' for d in path.split(os.pathsep)]
+            names = {}
+            for i, d in enumerate(dirs):
+                self.stats['listings'] += 1
+                try:
+                    entries = os.listdir(d)
+                except OSError:
+                    entries = []
+                for name in entries:
+                    names.setdefault(name, []).append(i)
+            index = self.indexes[path] = (dirs, names)
+        return index
+
+    def find(self, names, path):
+        '''
+        Returns the first of names found in path as (name, full path), or
+        None. Also counts the checks a search of every directory for every
+        name would have made.
+        '''
+        dirs, index = self.index(path)
+        self.stats['lookups'] += 1
+        for name in names:
+            if os.sep in name:
+                self.stats['checks'] += 1
+                self.stats['naive_checks'] += 1
+                if is_executable(name):
+                    return name, name
+                continue
+            for i in index.get(name, ()):
+                candidate = os.path.join(dirs[i], name)
+                self.stats['checks'] += 1
+                if is_executable(candidate):
+                    self.stats['naive_checks'] += i + 1
+                    return name, candidate
+            self.stats['naive_checks'] += len(dirs)
+        return None
+
+    def path_prog(self, current, names, default, path):
+        '''
+        Returns the value AC_PATH_PROG gives a variable whose value is
+        current: current if it is an absolute path, or else the full path
+        of the first of names found, or default.
+        '''
+        if os.path.isabs(current):
+            return current
+        with self.lock:
+            found = self.find(names.split(), path)
+        if found is None:
+            return default
+        return found[1]
+
+    def check_prog(self, current, names, default, path):
+        '''
+        Returns the value AC_CHECK_PROGS gives a variable whose value is
+        current: current if it is set, or else the first of names found,
+        or default.
+        '''
+        if current:
+            return current
+        with self.lock:
+            found = self.find(names.split(), path)
+        if found is None:
+            return default
+        return found[0]
+
+
+class Substitutions(object):
+    '''
+    Runs the command substitutions the translator found to be free of side
+    effects. With memoize set, the output of each is kept, keyed on the
+    command and the values of the variables it depends on, and reused when
+    the same command runs again with the same values.
+    '''
+    def __init__(self, memoize):
+        self.memoize = memoize
+        self.memo = {}
+        self.stats = Counter()
+        self.saved = 0.0
+
+    def run(self, command, vars):
+        return subprocess.check_output(command, shell=True, env=vars).rstrip('\n')
+
+    def output(self, command, vars, depends):
+        if not self.memoize:
+            return self.run(command, vars)
+        key = (command,) + tuple([vars[v] for v in depends])
+        if key in self.memo:
+            output, elapsed = self.memo[key]
+            self.stats['hits'] += 1
+            self.saved += elapsed
+        else:
+            start = time.time()
+            output = self.run(command, vars)
+            elapsed = time.time() - start
+            self.memo[key] = (output, elapsed)
+            self.stats['misses'] += 1
+        return output
+
+
+class UnitOutput(object):
+    '''
+    Stands in for sys.stdout while units run, keeping what each unit writes
+    for Units to write out in the order of the units. With eager, the units
+    added before a statement ran before it in the script, so what they
+    wrote comes before what it writes.
+    '''
+    def __init__(self, stream, units):
+        self.stream = stream
+        self.units = units
+        self.softspace = 0
+
+    def write(self, data):
+        unit = self.units.current()
+        if unit is None:
+            if self.units.eager:
+                self.units.write_added()
+            self.stream.write(data)
+        else:
+            self.units.buffers.setdefault(unit, []).append(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Units(object):
+    '''
+    Runs the units of a script translated with --lazy: functions that only
+    set configure variables, each added with the units it depends on. A
+    unit runs once a later statement needs it, after those; with eager,
+    every unit runs as soon as it is added.
+
+    With more than one job, the units a statement needs run in a pool of
+    threads, each as soon as those it depends on are done, and with eager,
+    every unit starts in the background when it is added. What units write
+    to stdout is held and written in the order of the units, when a
+    statement needs them or at the end, so the output doesn't depend on
+    timing, and is the same with one job and with many. (With eager and
+    one job, units run where they are added, and write as they go.)
+    '''
+    def __init__(self, eager=False, jobs=1):
+        self.eager = eager
+        self.jobs = jobs
+        self.pending = {}
+        # The units that have been added, by id, with their dependencies,
+        # including those they needed while running.
+        self.depends = {}
+        # Events set when the units running now are done.
+        self.running = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = None
+        # Results of the tasks started in the pool, by unit.
+        self.results = {}
+        self.output = None
+        self.buffers = {}
+        self.written = set()
+        # The ids of the units in the order they were added, and how many of
+        # them write_added() wrote out.
+        self.added = []
+        self.added_written = 0
+        self.stats = Counter()
+
+    def start(self):
+        self.pool = ThreadPool(self.jobs)
+        self.capture()
+
+    def capture(self):
+        '''
+        Makes what units write to stdout go to their buffers.
+        '''
+        if self.output is None:
+            self.output = sys.stdout = UnitOutput(sys.stdout, self)
+
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            return stack[-1]
+        return None
+
+    def add(self, id, depends, function):
+        with self.lock:
+            self.stats['added'] += 1
+            self.added.append(id)
+            self.pending[id] = function
+            self.depends[id] = list(depends)
+        if self.eager and self.jobs > 1:
+            self.spawn([id])
+        elif self.eager:
+            self.need([id])
+
+    def need(self, ids):
+        unit = self.current()
+        if unit is not None:
+            self.depends[unit].extend(ids)
+            self.run(ids)
+        elif self.eager and self.jobs == 1:
+            self.run(ids)
+        else:
+            self.capture()
+            if self.jobs > 1:
+                self.spawn(ids)
+            self.run(ids)
+            self.check(ids)
+            if not self.eager:
+                self.write_output(ids)
+
+    def need_all(self):
+        with self.lock:
+            ids = sorted(set(self.pending) | set(self.running))
+        self.need(ids)
+
+    def finish(self, ids):
+        '''
+        Runs the units in ids, which set the AC_SUBST variables, and waits
+        for any still running. The messages of the units that never ran
+        are never written, so it says how many there were.
+        '''
+        self.need(ids)
+        if self.output is not None:
+            self.check(sorted(self.results))
+            self.write_output(sorted(self.buffers))
+        skipped = self.stats['added'] - self.stats['run']
+        if skipped:
+            sys.stdout.write('configure: skipped %d checks whose results are not used '
+                             '(run with --eager-units to run them)\n' % skipped)
+
+    def closure(self, ids):
+        '''
+        Returns ids and the units they depend on, in order.
+        '''
+        seen = set()
+        stack = list(ids)
+        while stack:
+            id = stack.pop()
+            if id not in seen:
+                seen.add(id)
+                stack.extend(self.depends.get(id, ()))
+        return sorted(seen)
+
+    def spawn(self, ids):
+        '''
+        Starts the units in ids and those they depend on in the pool, if
+        they haven't started yet.
+        '''
+        if self.pool is None:
+            self.start()
+        for id in self.closure(ids):
+            if id in self.pending and id not in self.results:
+                self.results[id] = self.pool.apply_async(self.run, ([id],))
+
+    def check(self, ids):
+        '''
+        Raises the errors of the units in ids and their dependencies that
+        ran in the pool.
+        '''
+        for id in self.closure(ids):
+            result = self.results.pop(id, None)
+            if result is not None:
+                result.get()
+
+    def write_output(self, ids):
+        for id in self.closure(ids):
+            if id not in self.written:
+                self.written.add(id)
+                self.output.stream.write(''.join(self.buffers.pop(id, [])))
+
+    def write_added(self):
+        '''
+        Waits for the units added so far and writes what they wrote.
+        '''
+        with self.lock:
+            ids = self.added[self.added_written:]
+            self.added_written = len(self.added)
+        self.check(ids)
+        self.write_output(ids)
+
+    def claim(self, id):
+        '''
+        Returns the function of unit id if it can run now, marking it as
+        running, or None if it ran or is running elsewhere.
+        '''
+        with self.lock:
+            function = self.pending.pop(id, None)
+            if function is not None:
+                self.running[id] = threading.Event()
+                self.stats['run'] += 1
+        return function
+
+    def wait(self, id):
+        with self.lock:
+            event = self.running.get(id)
+        if event is not None:
+            event.wait()
+
+    def run(self, ids):
+        # Depth first, with a stack of our own rather than recursion, as
+        # units can depend on long chains of others. A unit only waits for
+        # units with lower ids that are running, and runs those that
+        # haven't started itself, so threads never wait for each other in
+        # a cycle.
+        stack = list(reversed(ids))
+        while stack:
+            id = stack[-1]
+            depends = [d for d in self.depends.get(id, ()) if d in self.pending]
+            if id in self.pending and depends:
+                stack.extend(reversed(depends))
+                continue
+            stack.pop()
+            for d in self.depends.get(id, ()):
+                self.wait(d)
+            function = self.claim(id)
+            if function is None:
+                self.wait(id)
+            else:
+                self.execute(id, function)
+
+    def execute(self, id, function):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(id)
+        # Whatever happens, the unit is done, and those waiting for it go
+        # on. (The script is generated without try/finally.)
+        error = None
+        try:
+            function()
+        except BaseException:
+            error = sys.exc_info()
+        stack.pop()
+        with self.lock:
+            event = self.running.pop(id)
+        event.set()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+
+def report_runtime_stats(stream, substitutions, utilities, units, programs):
+    stream.write('substitution memo: %d hits, %d misses, %.3fs saved\n' %
+                 (substitutions.stats['hits'], substitutions.stats['misses'],
+                  substitutions.saved))
+    stream.write('utilities: %d run in-process, %d in a shell\n' %
+                 (utilities.stats['in_process'], utilities.stats['shell_fallbacks']))
+    if programs.stats['lookups']:
+        syscalls = (CHECK_SYSCALLS * programs.stats['checks'] +
+                    LISTING_SYSCALLS * programs.stats['listings'])
+        naive = CHECK_SYSCALLS * programs.stats['naive_checks']
+        stream.write('program lookups: %d, with %d checks and %d directory listings '
+                     'instead of %d checks, saving %d system calls\n' %
+                     (programs.stats['lookups'], programs.stats['checks'],
+                      programs.stats['listings'], programs.stats['naive_checks'],
+                      naive - syscalls))
+    if units.stats['added']:
+        stream.write('units: %d of %d run\n' % (units.stats['run'], units.stats['added']))
+
+
 def main(args):
-    vars = dict(os.environ)
+    vars = Vars(os.environ)
     # set positional parameters
     for i, a in enumerate(args):
         vars['argv%d' % i] = a
     exports = set(vars.keys())
+    probes = Probes()
+    utilities = Utilities()
     parser = make_arg_parser()
     args = parser.parse_args(args)
+    config_cache = ConfigCache(args.cache_file)
+    substitutions = Substitutions(args.memoize_substitutions)
+    units = Units(args.eager_units, args.unit_jobs or multiprocessing.cpu_count())
+    programs = Programs()
+    if args.runtime_stats:
+        atexit.register(report_runtime_stats, sys.stderr, substitutions, utilities,
+                        units, programs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def translate():
+    '''
+    Returns a function translating configure.in text to the source of a
+    Python script, with the given autoconf.Options.
+    '''
+    pytest.importorskip('m4')
+    pytest.importorskip('pysh.pyshyacc')
+    import autoconf
+
+    def translate(source, **options):
+        return autoconf.ConfigureTranslator(autoconf.Options(**options)).translate(source)
+    return translate
+
+
+@pytest.fixture
+def sample():
+    '''
+    The text of tests/data/configure.in.
+    '''
+    with open(os.path.join(ROOT, 'tests', 'data', 'configure.in')) as f:
+        return f.read()
+
+
+@pytest.fixture
+def run_script(tmpdir):
+    '''
+    Returns a function writing a generated script to a scratch directory
+    and running it there with the given arguments. It returns the exit
+    status and the output.
+    '''
+    def run_script(source, *args):
+        path = tmpdir.join('configure.py')
+        path.write(source)
+        process = subprocess.Popen([sys.executable, str(path)] + list(args),
+                                   cwd=str(tmpdir), stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        return process.returncode, output
+    return run_script
@@ -0,0 +1,82 @@
+'''
+MacroHandler caches the expansions of macro arguments, which must not
+outlive the input they were made for, or stand in for expansions that
+read files or run commands.
+'''
+
+import pytest
+
+
+@pytest.fixture
+def autoconf():
+    pytest.importorskip('m4')
+    pytest.importorskip('pysh.pyshyacc')
+    import autoconf
+    return autoconf
+
+
+def test_pure_arguments_are_cached(autoconf):
+    handler = autoconf.MacroHandler()
+    assert handler.expand_arg('[quoted] text') == 'quoted text'
+    assert handler.expand_arg('[quoted] text') == 'quoted text'
+    assert handler.stats['arg_cache_hits'] == 1
+    assert handler.stats['arg_cache_misses'] == 1
+
+
+def test_cache_is_per_input(autoconf):
+    handler = autoconf.MacroHandler()
+    handler.expand_arg('text')
+    snapshot = handler.snapshot()
+    handler.reset()
+    assert handler.arg_cache == {}
+    handler.expand_arg('text')
+    handler.restore(snapshot)
+    assert handler.arg_cache == {}
+
+
+def test_cache_is_bounded(autoconf, monkeypatch):
+    monkeypatch.setattr(autoconf, 'ARG_CACHE_SIZE', 3)
+    handler = autoconf.MacroHandler()
+    for i in range(10):
+        handler.expand_arg('text %d' % i)
+        assert len(handler.arg_cache) <= 3
+
+
+def test_included_files_are_read_again(autoconf, tmpdir):
+    path = tmpdir.join('included.m4')
+    handler = autoconf.MacroHandler()
+    arg = 'include([%s])' % path
+    path.write('first')
+    assert handler.expand_arg(arg) == 'first'
+    path.write('second')
+    assert handler.expand_arg(arg) == 'second'
+    assert arg not in handler.arg_cache
+
+
+@pytest.mark.parametrize('arg', [
+    'esyscmd([date])',
+    'syscmd([true])',
+    'sinclude([x.m4])',
+    'define([X], [1])X',
+    'indir([X])',
+    '__line__',
+])
+def test_impure_builtins_are_recognized(autoconf, arg):
+    assert autoconf.IMPURE_M4_RE.search(arg)
+
+
+def test_definitions_are_not_cached(autoconf):
+    handler = autoconf.MacroHandler()
+    arg = 'define([X], [1])X'
+    assert handler.expand_arg(arg) == '1'
+    assert arg not in handler.arg_cache
+
+
+def test_impure_invocations_skip_translation_cache(autoconf, tmpdir):
+    path = tmpdir.join('included.m4')
+    translator = autoconf.ConfigureTranslator(autoconf.Options(cache_dir=str(tmpdir.join('cache'))))
+    source = 'AC_MSG_RESULT(include([%s]))\n' % path
+    path.write('first')
+    assert 'first' in translator.translate(source)
+    path.write('second')
+    assert 'second' in translator.translate(source)
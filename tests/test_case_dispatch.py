@@ -0,0 +1,96 @@
+'''
+CaseDispatch must find the arm a case statement runs, which is the first
+whose patterns match the word, as matching each arm in turn does.
+'''
+
+import fnmatch
+import random
+
+import pytest
+
+import template
+
+
+def sequential(arms, word):
+    for i, patterns in enumerate(arms):
+        if any(fnmatch.fnmatchcase(word, p) for p in patterns):
+            return i
+    return -1
+
+
+def check(arms, words):
+    dispatch = template.CaseDispatch(arms)
+    for word in words:
+        assert dispatch(word) == sequential(arms, word), word
+
+
+WORDS = ['', 'a', 'b', 'ab', 'abc', 'x86_64', 'i686', 'Linux', 'linux-gnu',
+         'Darwin', 'a.b', 'a*b', '[x]', 'yes', 'no', 'foo\nbar']
+
+
+def test_exact_patterns():
+    check([('yes',), ('no', 'n'), ('a',), ('yes',)], WORDS + ['n'])
+
+
+def test_glob_patterns():
+    check([('i?86', 'x86_*'), ('*-gnu',), ('[Ll]inux',), ('a[!b]*',), ('*',)], WORDS)
+
+
+def test_first_matching_arm_wins():
+    # Exact and glob patterns of later arms matching the same words.
+    check([('a*',), ('ab',), ('abc', 'a?c'), ('*c',), ('ab',)], WORDS)
+    check([('ab',), ('a*',), ('*b',)], WORDS)
+    check([('*',), ('a',)], WORDS)
+
+
+def test_special_characters():
+    check([('a.b',), ('a\\*b',), ('[[]x]',), ('foo*',), ('*.*',)], WORDS)
+
+
+def test_no_match():
+    check([('x',), ('y*',)], ['', 'a', 'zy'])
+    check([], ['', 'a'])
+
+
+def test_runtime_patterns():
+    arms = [('Darwin',), None, ('Lin*',), None, ('*',)]
+    dynamic = {1: lambda: ['*nux', 'a*'], 3: lambda: ['Linux']}
+    expanded = [arm if arm is not None else dynamic[i]() for i, arm in enumerate(arms)]
+    dispatch = template.CaseDispatch(arms)
+    for word in WORDS:
+        assert dispatch(word, dynamic) == sequential(expanded, word)
+
+
+def test_runtime_patterns_only_expanded_when_reached():
+    reached = []
+
+    def patterns():
+        reached.append(True)
+        return ['x']
+    dispatch = template.CaseDispatch([('a',), None])
+    assert dispatch('a', {1: patterns}) == 0
+    assert not reached
+    assert dispatch('x', {1: patterns}) == 1
+    assert reached
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_many_arms(seed):
+    rng = random.Random(seed)
+    # More glob arms than fit in one regex.
+    count = template.CaseDispatch.GROUPS_PER_REGEX * 3 + 7
+    arms = []
+    words = []
+    for i in range(count):
+        name = 'w%d' % rng.randrange(count)
+        words.append(name)
+        kind = rng.randrange(4)
+        if kind == 0:
+            arms.append((name,))
+        elif kind == 1:
+            arms.append((name[:2] + '*',))
+        elif kind == 2:
+            arms.append(('*%s' % name[-1], name))
+        else:
+            arms.append(('w?%s' % name[2:],))
+    check(arms, words + ['w', 'x', ''])
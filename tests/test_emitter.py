@@ -0,0 +1,76 @@
+'''
+Writing the generated script a statement at a time must give the same
+source as filling in the whole template and dumping it with meta.
+'''
+
+import ast
+import copy
+import os
+import textwrap
+from cStringIO import StringIO
+
+import meta
+import pytest
+
+import emitter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = textwrap.dedent('''
+    vars["A"] = "x"
+    if vars.get("A", "") == "x":
+        sys.stdout.write(Format("{A}\\\\n")(vars, {}))
+    else:
+        pass
+    for X in for_loop([Format("a b")], vars, {}):
+        vars["X"] = X
+    _arm = CaseDispatch([("a*",), ("b",)])(vars["X"])
+    def _unit0():
+        vars["B"] = "y"
+    units.add(0, [], _unit0)
+    ''')
+
+
+def read_template():
+    with open(os.path.join(ROOT, 'template.py')) as f:
+        return ast.parse(f.read())
+
+
+def find_main(module):
+    return [n for n in module.body if isinstance(n, ast.FunctionDef) and n.name == 'main'][0]
+
+
+def test_same_source_as_meta():
+    statements = ast.parse(STATEMENTS).body
+    definitions = ast.parse('_format0 = Format("{A}")').body
+
+    whole = read_template()
+    find_main(whole).body.extend(copy.deepcopy(statements))
+    whole.body[-1:-1] = copy.deepcopy(definitions)
+    expected = meta.dump_python_source(whole)
+
+    module = read_template()
+    stream = StringIO()
+    source = emitter.SourceEmitter(module, find_main(module), stream)
+    source.begin()
+    for stmt in statements:
+        source.write(stmt)
+    source.finish(definitions)
+    assert stream.getvalue() == expected
+
+
+def test_unexpected_source_raises():
+    with pytest.raises(ValueError):
+        emitter.strip_prefix('def g():\n    pass\n', 'def f():\n')
+
+
+def test_translation_same_as_filled_template(translate, sample):
+    import autoconf
+    for lazy in (False, True):
+        translator = autoconf.ConfigureTranslator(autoconf.Options(lazy=lazy))
+        shell = translator.expand(sample)
+        translator.shell_translator.template = copy.deepcopy(translator.template)
+        translator.shell_translator.translate(shell, toplevel=True)
+        translator.macro_handler.thunks.finish()
+        expected = meta.dump_python_source(translator.shell_translator.template)
+        assert translate(sample, lazy=lazy) == expected
@@ -0,0 +1,46 @@
+'''
+Pipelines, which the generated script runs with the in-process utilities
+when it can, must give the same results as in the shell.
+'''
+
+import os
+import subprocess
+
+import pytest
+
+import template
+
+# sed -n isn't implemented in-process, so the utilities fall back to the
+# shell at runtime for the first of these.
+PIPELINES = [
+    'echo x | sed -n p',
+    'echo x | tr x y',
+    'echo x | sed -n /y/p',
+    'false | true',
+    'true | false',
+]
+
+
+def shell_branch(pipeline, negate):
+    script = 'if %s%s >/dev/null; then echo then; else echo else; fi' % (
+        '! ' if negate else '', pipeline)
+    return subprocess.check_output(['/bin/sh', '-c', script]).strip()
+
+
+@pytest.mark.parametrize('negate', [False, True])
+@pytest.mark.parametrize('pipeline', PIPELINES)
+def test_pipeline_status(translate, run_script, pipeline, negate):
+    configure = ('if %s%s; then R=then; else R=else; fi\n'
+                 'echo "R=$R"\n' % ('! ' if negate else '', pipeline))
+    status, output = run_script(translate(configure))
+    assert status == 0
+    assert output.splitlines()[-1] == 'R=' + shell_branch(pipeline, negate)
+
+
+def test_fallback_gives_status_of_pipeline():
+    utilities = template.Utilities()
+    status = utilities.call([['echo', 'x'], ['sed', '-n', '/x/p'], ['grep', 'y']],
+                            'echo x | sed -n /x/p | grep y', dict(os.environ))
+    # The status of the command the utilities fell back to, not negated.
+    assert status == 1
+    assert utilities.stats['shell_fallbacks'] == 1
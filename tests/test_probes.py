@@ -0,0 +1,92 @@
+'''
+Compiler probes may start ahead of where the script has them, so what
+they run with must not depend on anything they are moved past.
+'''
+
+import ast
+import os
+
+import meta
+import pytest
+
+import template
+
+
+class Pool(object):
+    '''
+    Records the probes submitted instead of running them.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def apply_async(self, function, args):
+        self.calls.append(args)
+        return args
+
+
+def submit(vars, lang='C', kind='compile'):
+    probes = template.Probes()
+    probes.pool = Pool()
+    probes.submit(vars, lang, kind, 'int x;')
+    command, source, ext, env = probes.pool.calls[0]
+    return command, env
+
+
+def test_command_from_vars(monkeypatch):
+    monkeypatch.setenv('CFLAGS', '-O0')
+    vars = template.Vars(os.environ)
+    vars.update(CC='mycc', CFLAGS='-O2', CPPFLAGS='-DX', LDFLAGS='-L.', LIBS='-lm')
+    assert submit(vars)[0] == ['mycc', '-O2', '-DX', '-c', 'conftest.c', '-o', 'conftest.o']
+    assert submit(vars, kind='link')[0] == ['mycc', '-O2', '-DX', 'conftest.c', '-o',
+                                            'conftest', '-L.', '-lm']
+
+
+def test_environment_only_takes_probe_inputs(monkeypatch):
+    monkeypatch.setenv('CFLAGS', '-O0')
+    monkeypatch.setenv('LIBS', '-lc')
+    monkeypatch.setenv('KEPT', 'environ')
+    vars = template.Vars(os.environ)
+    vars.update(CC='mycc', CFLAGS='-O2', PATH='/probe/bin', KEPT='vars', ac_cv_x='yes')
+    del vars['LIBS']
+    env = submit(vars)[1]
+    assert env['CC'] == 'mycc'
+    assert env['CFLAGS'] == '-O2'
+    assert env['PATH'] == '/probe/bin'
+    assert 'LIBS' not in env
+    assert env['KEPT'] == 'environ'
+    assert 'ac_cv_x' not in env
+    assert set(env) - set(template.PROBE_ENV) <= set(os.environ)
+
+
+def test_probe_env_is_what_hoisting_tracks():
+    pytest.importorskip('m4')
+    pytest.importorskip('pysh.pyshyacc')
+    import autoconf
+    assert set(template.PROBE_ENV) == autoconf.PROBE_INPUTS
+
+
+HOIST = '''
+vars["A"] = "1"
+sys.stdout.write("checking\\\\n")
+{blocker}
+_probe0 = probes.submit(vars, "C", "compile", "int x;")
+'''
+
+
+@pytest.mark.parametrize('blocker, moves', [
+    ('vars["OTHER"] = "x"', True),
+    ('vars["CFLAGS"] = "-O2"', False),
+    ('vars["PATH"] = "/bin"', False),
+    ('sys.exit(1)', False),
+    ('subprocess.call(["touch", "conftest.h"])', False),
+])
+def test_hoisting(blocker, moves):
+    pytest.importorskip('m4')
+    pytest.importorskip('pysh.pyshyacc')
+    import autoconf
+    body = ast.parse(HOIST.format(blocker=blocker)).body
+    hoisted = autoconf.hoist_probes(body)
+    source = [meta.dump_python_source(s).strip() for s in hoisted]
+    assert (source[0].startswith('_probe0')) == moves
+    assert sorted(source) == sorted(meta.dump_python_source(s).strip()
+                                    for s in ast.parse(HOIST.format(blocker=blocker)).body)
@@ -0,0 +1,129 @@
+'''
+split_toplevel must cut a script only between complete top-level commands,
+so that translating the chunks separately, as -j N does, gives what
+translating the whole script gives.
+'''
+
+import subprocess
+
+import pytest
+
+import shellsplit
+
+# Scripts, with the chunks they split into.
+SCRIPTS = {
+    'simple': ['A=1\n', 'B=2\n', 'echo "$A $B"\n'],
+    'if': ['A=1\n', 'if test "$A" = 1; then\n  B=2\nelse\n  B=3\nfi\n', 'echo $B\n'],
+    'case': [
+        'case "$host" in\n'
+        '*-linux*|*-gnu*)\n'
+        '  OS=linux\n'
+        '  ;;\n'
+        '(darwin*) OS=mac ;;\n'
+        '*)\n'
+        '  case "$OS" in a) ;; esac\n'
+        '  OS=other\n'
+        '  ;;\n'
+        'esac\n',
+        'echo $OS\n',
+    ],
+    'heredoc': [
+        'cat > conftest.h <<EOF\n'
+        'if\n'
+        'fi\n'
+        'esac\n'
+        'EOF\n',
+        'cat <<-"END" | sed s/a/b/\n'
+        '\tcase done\n'
+        '\tEND\n',
+        'echo after\n',
+    ],
+    'heredoc in if': [
+        'if true; then\n'
+        '  cat <<EOF\n'
+        'fi\n'
+        'EOF\n'
+        'fi\n',
+        'echo after\n',
+    ],
+    'function': [
+        'check ()\n'
+        '{\n'
+        '  if test -n "$1"; then\n'
+        '    echo yes\n'
+        '  fi\n'
+        '}\n',
+        'other() {\n  check x\n}\n',
+        'check y\n',
+    ],
+    'continued': [
+        'test -n "$A" &&\n  echo a ||\n  echo b\n',
+        'echo x |\n  sed s/x/y/\n',
+        'echo \\\n  continued\n',
+    ],
+    'quotes': [
+        'A="if\nfi"\n',
+        "B='case\n'\n",
+        'C=`echo "do\n done"`\n',
+        'D=$(case x in x) echo x;; esac)\n',
+        '# if a comment\n',
+        'for f in if fi; do\n  echo $f\ndone\n',
+    ],
+    'subshell': ['(\n  cd dir\n  make\n)\n', '{ echo a\n  echo b; }\n'],
+}
+
+
+@pytest.mark.parametrize('name', sorted(SCRIPTS))
+def test_split(name):
+    chunks = SCRIPTS[name]
+    assert shellsplit.split_toplevel(''.join(chunks)) == chunks
+
+
+@pytest.mark.parametrize('name', sorted(SCRIPTS))
+def test_chunks_are_complete_commands(name):
+    for chunk in SCRIPTS[name]:
+        process = subprocess.Popen(['/bin/sh', '-n'], stdin=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        error = process.communicate(chunk)[1]
+        assert process.returncode == 0, (chunk, error)
+
+
+@pytest.mark.parametrize('script', [
+    'if true; then\n  echo a\n',
+    'case x in\nx) echo x\n',
+    'while true; do\n  echo a\n',
+])
+def test_unfinished_script_is_one_chunk(script):
+    script = 'A=1\n' + script + 'B=2\n'
+    assert shellsplit.split_toplevel(script) == [script]
+
+
+def test_group_chunks():
+    chunks = [c for name in sorted(SCRIPTS) for c in SCRIPTS[name]]
+    for count in (1, 2, 4, 100):
+        groups = shellsplit.group_chunks(chunks, count)
+        assert ''.join(groups) == ''.join(chunks)
+        assert len(groups) <= min(count, len(chunks)) + 1
+    assert shellsplit.group_chunks(chunks, 1) == [''.join(chunks)]
+
+
+def outcome(translate, source, jobs):
+    try:
+        return translate(source, jobs=jobs)
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('name', sorted(SCRIPTS))
+def test_jobs_translate_like_serial(translate, sample, name):
+    # Many copies, so the script splits into many chunks, with the
+    # commands above crossing the boundaries between them.
+    source = sample + ''.join(SCRIPTS[name]) * 20 + sample
+    serial = outcome(translate, source, 1)
+    for jobs in (2, 4):
+        assert outcome(translate, source, jobs) == serial
+
+
+def test_jobs_translate_sample_like_serial(translate, sample):
+    serial = translate(sample * 10)
+    assert translate(sample * 10, jobs=4) == serial
@@ -0,0 +1,78 @@
+'''
+The code of each macro invocation goes in the output exactly once: taking
+a thunk twice is an error, and one never taken is warned about.
+'''
+
+import warnings
+from collections import Counter
+
+import pytest
+
+
+@pytest.fixture
+def autoconf():
+    pytest.importorskip('m4')
+    pytest.importorskip('pysh.pyshyacc')
+    import autoconf
+    return autoconf
+
+
+def make_table(autoconf, count):
+    table = autoconf.ThunkTable(Counter())
+    for i in range(count):
+        table.add(autoconf.ast.parse('x = %d' % i).body)
+    return table
+
+
+def test_taken_once(autoconf):
+    table = make_table(autoconf, 2)
+    table.take(0)
+    with pytest.raises(autoconf.UnhandledTranslation):
+        table.take(0)
+    with pytest.raises(autoconf.UnhandledTranslation):
+        table.peek(0)
+
+
+def test_rollback_puts_thunks_back(autoconf):
+    table = make_table(autoconf, 2)
+    table.begin()
+    table.take(0)
+    table.rollback()
+    table.take(0)
+    table.take(1)
+    assert table.pending_size == 0
+
+
+def test_unused_thunks_warn(autoconf):
+    table = make_table(autoconf, 3)
+    table.take(1)
+    with pytest.warns(autoconf.UnusedThunkWarning) as record:
+        table.finish()
+    assert 'thunks 0, 2 were' in str(record[0].message)
+    assert table.stats['thunks_unused'] == 2
+    assert not table.entries
+
+
+def test_all_used_is_quiet(autoconf):
+    table = make_table(autoconf, 2)
+    table.take(0)
+    table.take(1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        table.finish()
+
+
+def test_translation_uses_every_thunk(translate, sample):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for lazy in (False, True):
+            translate(sample, lazy=lazy)
+
+
+def test_thunk_used_twice_fails_translation(autoconf, sample):
+    translator = autoconf.ConfigureTranslator()
+    shell = translator.expand(sample)
+    placeholder = autoconf.THUNK_RE.search(shell).group(0)
+    translator.shell_translator.template = translator.template
+    with pytest.raises(autoconf.UnhandledTranslation):
+        translator.shell_translator.translate(shell + placeholder + '\n', toplevel=True)
@@ -0,0 +1,163 @@
+'''
+Units of a script translated with --lazy must give the same variables and
+output whether they run when needed, eagerly, or in a pool of threads.
+'''
+
+import random
+import sys
+import time
+from cStringIO import StringIO
+
+import pytest
+
+import template
+
+SKIPPED_NOTE = 'configure: skipped %d checks whose results are not used'
+
+MODES = [(False, 1), (False, 4), (True, 1), (True, 4)]
+
+
+def add_checks(units, vars, order):
+    '''
+    Adds units like those of a script: checks writing a message and
+    setting a variable, some of them using the results of others.
+    '''
+    def check(id, name, value):
+        def function():
+            # Gives units running in parallel the chance to finish out of
+            # order.
+            time.sleep(0.001 * (7 - id))
+            sys.stdout.write('checking %s... %s\n' % (name, value()))
+            vars[name] = value()
+            order.append(id)
+        return function
+    units.add(0, [], check(0, 'A', lambda: 'a'))
+    units.add(1, [], check(1, 'B', lambda: 'b'))
+    units.add(2, [0], check(2, 'C', lambda: vars['A'] + 'c'))
+    units.add(3, [], check(3, 'UNUSED', lambda: 'u'))
+    units.add(4, [1, 2], check(4, 'D', lambda: vars['B'] + vars['C'] + 'd'))
+
+
+def run_script(eager, jobs, monkeypatch):
+    output = StringIO()
+    monkeypatch.setattr(sys, 'stdout', output)
+    vars = {}
+    order = []
+    units = template.Units(eager, jobs)
+    add_checks(units, vars, order)
+    units.need([2])
+    sys.stdout.write('C=%s\n' % vars['C'])
+    units.finish([4])
+    return vars, order, output.getvalue(), units
+
+
+@pytest.mark.parametrize('eager, jobs', MODES)
+def test_same_variables(eager, jobs, monkeypatch):
+    vars = run_script(eager, jobs, monkeypatch)[0]
+    assert vars.pop('UNUSED', 'u') == 'u'
+    assert vars == {'A': 'a', 'B': 'b', 'C': 'ac', 'D': 'bacd'}
+
+
+@pytest.mark.parametrize('eager', [False, True])
+def test_same_output_in_parallel(eager, monkeypatch):
+    serial = run_script(eager, 1, monkeypatch)[2]
+    assert run_script(eager, 4, monkeypatch)[2] == serial
+
+
+def run_graph(seed, eager, jobs, monkeypatch):
+    '''
+    Runs a random graph of units, some of which need others while
+    running, with statements needing some of them in between.
+    '''
+    output = StringIO()
+    monkeypatch.setattr(sys, 'stdout', output)
+    rand = random.Random(seed)
+    units = template.Units(eager, jobs)
+    vars = {}
+
+    def unit(id, needs):
+        def function():
+            sys.stdout.write('unit %d starts\n' % id)
+            if needs:
+                units.need(needs)
+            vars[id] = sum(vars[n] for n in needs) + id
+            sys.stdout.write('unit %d: %d\n' % (id, vars[id]))
+        return function
+    for id in range(30):
+        depends = sorted(rand.sample(range(id), min(id, rand.randint(0, 2))))
+        needs = sorted(rand.sample(range(id), min(id, rand.randint(0, 2))))
+        units.add(id, depends, unit(id, needs))
+        if rand.random() < 0.2:
+            ids = sorted(rand.sample(range(id + 1), 2 if id else 1))
+            units.need(ids)
+            sys.stdout.write('statement after %d: %r\n' % (id, [vars[i] for i in ids]))
+    units.finish([29])
+    return vars, output.getvalue()
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('eager', [False, True])
+def test_random_graphs_same_in_parallel(seed, eager, monkeypatch):
+    serial = run_graph(seed, eager, 1, monkeypatch)
+    assert run_graph(seed, eager, 4, monkeypatch) == serial
+
+
+def test_lazy_runs_needed_units_in_order(monkeypatch):
+    vars, order, output, units = run_script(False, 1, monkeypatch)
+    assert order == [0, 2, 1, 4]
+    assert units.stats == {'added': 5, 'run': 4}
+    assert output.splitlines() == [
+        'checking A... a',
+        'checking C... ac',
+        'C=ac',
+        'checking B... b',
+        'checking D... bacd',
+        SKIPPED_NOTE % 1 + ' (run with --eager-units to run them)',
+    ]
+
+
+def test_eager_output_is_that_of_the_script(monkeypatch):
+    vars, order, output, units = run_script(True, 1, monkeypatch)
+    assert order == [0, 1, 2, 3, 4]
+    assert output.splitlines() == [
+        'checking A... a',
+        'checking B... b',
+        'checking C... ac',
+        'checking UNUSED... u',
+        'checking D... bacd',
+        'C=ac',
+    ]
+
+
+def test_errors_reach_the_statement_needing_the_unit(monkeypatch):
+    monkeypatch.setattr(sys, 'stdout', StringIO())
+    for jobs in (1, 4):
+        units = template.Units(False, jobs)
+
+        def fail():
+            raise KeyError('X')
+        units.add(0, [], fail)
+        units.add(1, [0], lambda: None)
+        with pytest.raises(KeyError):
+            units.need([1])
+
+
+def run_translation(run_script, source, *args):
+    status, output = run_script(source, '--cache-file', '/dev/null', *args)
+    assert status == 0
+    return output
+
+
+def test_translated_modes_agree(translate, run_script, sample):
+    plain = run_translation(run_script, translate(sample))
+    lazy = translate(sample, lazy=True)
+    eager = run_translation(run_script, lazy, '--eager-units', '--unit-jobs', '1')
+    assert eager == plain
+    assert run_translation(run_script, lazy, '--eager-units', '--unit-jobs', '4') == plain
+
+    needed = run_translation(run_script, lazy, '--unit-jobs', '1')
+    assert run_translation(run_script, lazy, '--unit-jobs', '4') == needed
+    results = [l for l in plain.splitlines() if l.startswith('RESULT ')]
+    assert [l for l in needed.splitlines() if l.startswith('RESULT ')] == results
+    assert SKIPPED_NOTE.split('%d')[0] in needed
+    assert SKIPPED_NOTE.split('%d')[0] not in plain
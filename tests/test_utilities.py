@@ -0,0 +1,226 @@
+'''
+The in-process utilities of the generated script must give the output and
+exit status /bin/sh gives, and leave the same files behind.
+'''
+
+import os
+import pipes
+import subprocess
+
+import pytest
+
+import template
+
+PIPELINES = [
+    [['true']],
+    [[':']],
+    [['false']],
+    [['echo', 'a', 'b  c']],
+    [['echo', '-n', 'x']],
+    [['echo']],
+    [['basename', '/a/b/c.h']],
+    [['basename', '/a/b/c.h', '.h']],
+    [['basename', 'c.h', 'c.h']],
+    [['basename', '/a/b/']],
+    [['basename', '/']],
+    [['dirname', '/a/b/c']],
+    [['dirname', 'c']],
+    [['dirname', '/c']],
+    [['dirname', 'a//b//']],
+    [['dirname', '/']],
+    [['expr', '1', '+', '2']],
+    [['expr', '7', '/', '-2']],
+    [['expr', '-7', '%', '2']],
+    [['expr', '3', '*', '4', '-', '12']],
+    [['expr', '2', '<', '10']],
+    [['expr', 'b', '<', 'a']],
+    [['expr', 'abc', '=', 'abc']],
+    [['expr', '', '|', '0']],
+    [['expr', 'x', '&', '']],
+    [['expr', 'x', '|', 'y']],
+    [['expr', 'libfoo.so.1', ':', 'lib\\(.*\\)\\.so']],
+    [['expr', 'abcd', ':', 'ab*']],
+    [['expr', 'abcd', ':', 'x']],
+    [['expr', '(', '1', '+', '2', ')', '*', '3']],
+    [['echo', 'Hello World'], ['tr', 'a-z', 'A-Z']],
+    [['echo', 'a.b.c'], ['tr', '.', '_']],
+    [['echo', 'abcabc'], ['tr', 'abc', 'x']],
+    [['echo', 'a-b c'], ['tr', '-d', ' -']],
+    [['echo', 'a/b'], ['tr', '/', '\\\\']],
+    [['echo', 'foo bar foo'], ['sed', 's/foo/baz/']],
+    [['echo', 'foo bar foo'], ['sed', 's/foo/baz/g']],
+    [['echo', 'a1b22'], ['sed', 's/[0-9][0-9]*/<&>/g']],
+    [['echo', 'key=value'], ['sed', 's/\\(.*\\)=\\(.*\\)/\\2=\\1/']],
+    [['echo', '/usr/lib'], ['sed', 's,/,:,g']],
+    [['echo', 'x.y'], ['sed', '-e', 's/x/a/', '-e', 's/\\./-/']],
+    [['echo', 'aaa'], ['sed', 's/a*/b/; s/b/c/']],
+    [['echo', 'ab'], ['sed', 's/^a/x/;s/b$/y/']],
+    [['echo', 'a b'], ['cat']],
+    [['echo', 'a'], ['cat', '-']],
+    [['echo', 'a'], ['sed', 's/a/b/'], ['tr', 'b', 'c'], ['cat']],
+]
+
+
+def shell_command(pipeline):
+    return ' | '.join(' '.join(pipes.quote(a) for a in argv) for argv in pipeline)
+
+
+def shell(command, cwd):
+    process = subprocess.Popen(['/bin/sh', '-c', command], cwd=cwd,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[0]
+    return process.returncode, output
+
+
+@pytest.mark.parametrize('pipeline', PIPELINES, ids=shell_command)
+def test_output_and_status(tmpdir, pipeline):
+    status, output, errors = template.Utilities().run(pipeline, None)
+    assert (status, output) == shell(shell_command(pipeline), str(tmpdir))
+
+
+def test_cat_files(tmpdir):
+    tmpdir.join('a').write('one\n')
+    tmpdir.join('b').write('two')
+    with tmpdir.as_cwd():
+        status, output, errors = template.Utilities().run([['cat', 'a', 'b']], None)
+        assert (status, output) == shell('cat a b', str(tmpdir))
+        status, output, errors = template.Utilities().run([['cat', 'a', 'missing']], None)
+        assert (status, output) == shell('cat a missing', str(tmpdir))
+        assert errors
+
+
+def test_stdin(tmpdir):
+    tmpdir.join('in').write('x y\n')
+    with tmpdir.as_cwd():
+        status, output, errors = template.Utilities().run([['sed', 's/x/z/']], 'in')
+    assert (status, output) == (0, 'z y\n')
+
+
+def tree(directory):
+    '''
+    Returns the files, links and directories under directory, with the
+    contents of files and the targets of links.
+    '''
+    found = {}
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            key = os.path.relpath(path, directory)
+            if os.path.islink(path):
+                found[key] = ('link', os.readlink(path))
+            elif os.path.isdir(path):
+                found[key] = ('dir',)
+            else:
+                with open(path) as f:
+                    found[key] = ('file', f.read())
+    return found
+
+
+def populate(directory):
+    directory.join('file').write('data\n')
+    directory.join('other').write('other\n')
+    directory.mkdir('dir').join('inner').write('inner\n')
+    directory.mkdir('empty')
+
+
+FILE_COMMANDS = [
+    [['mkdir', 'new']],
+    [['mkdir', 'dir']],
+    [['mkdir', '-p', 'a/b/c']],
+    [['mkdir', '-p', 'dir']],
+    [['rm', 'file']],
+    [['rm', 'missing']],
+    [['rm', '-f', 'missing', 'file']],
+    [['rm', 'dir']],
+    [['rm', '-rf', 'dir']],
+    [['rm', '-r', 'empty', 'other']],
+    [['touch', 'file', 'new']],
+    [['cp', 'file', 'copy']],
+    [['cp', 'file', 'dir']],
+    [['cp', '-f', 'file', 'other']],
+    [['cp', 'missing', 'copy']],
+    [['mv', 'file', 'moved']],
+    [['mv', 'file', 'dir']],
+    [['mv', 'missing', 'moved']],
+    [['ln', '-s', 'file', 'link']],
+    [['ln', '-s', 'file', 'dir']],
+    [['ln', '-sf', 'other', 'file']],
+    [['ln', 'file', 'hard']],
+    [['ln', 'file', 'other']],
+    [['echo', 'x'], ['touch', 'new']],
+]
+
+
+@pytest.mark.parametrize('pipeline', FILE_COMMANDS, ids=shell_command)
+def test_file_commands(tmpdir, pipeline):
+    ours = tmpdir.mkdir('ours')
+    theirs = tmpdir.mkdir('theirs')
+    populate(ours)
+    populate(theirs)
+    with ours.as_cwd():
+        status, output, errors = template.Utilities().run(pipeline, None)
+    assert (status, output) == shell(shell_command(pipeline), str(theirs))
+    assert tree(str(ours)) == tree(str(theirs))
+
+
+UNSUPPORTED = [
+    [['grep', 'x']],
+    [['echo', 'a\\nb']],
+    [['sed', '-n', 'p']],
+    [['sed', 's/a/b/w out']],
+    [['sed', 'y/ab/cd/']],
+    [['tr', '[:lower:]', '[:upper:]']],
+    [['basename', '--', 'x']],
+    [['mkdir']],
+    [['cp', '-r', 'dir', 'copy']],
+    [['expr', '1', '/', '0']],
+    [['expr', 'a', '+', '1']],
+    [['rm', '-i', 'file']],
+    # Only the last command may change files, as a later one could still
+    # make the whole pipeline run in the shell.
+    [['touch', 'new'], ['tr', '-q']],
+    [['rm', 'file'], ['cat']],
+]
+
+
+@pytest.mark.parametrize('pipeline', UNSUPPORTED, ids=shell_command)
+def test_unsupported(tmpdir, pipeline):
+    populate(tmpdir)
+    before = tree(str(tmpdir))
+    with tmpdir.as_cwd():
+        with pytest.raises(template.Unsupported):
+            template.Utilities().run(pipeline, None)
+    assert tree(str(tmpdir)) == before
+
+
+@pytest.mark.parametrize('pipeline', UNSUPPORTED[:6] + UNSUPPORTED[-2:], ids=shell_command)
+def test_fallback(tmpdir, pipeline):
+    ours = tmpdir.mkdir('ours')
+    theirs = tmpdir.mkdir('theirs')
+    populate(ours)
+    populate(theirs)
+    command = shell_command(pipeline) + ' > result'
+    utilities = template.Utilities()
+    with ours.as_cwd():
+        status = utilities.call(pipeline, command, dict(os.environ))
+    assert utilities.stats['shell_fallbacks'] == 1
+    assert status == shell(command, str(theirs))[0]
+    assert tree(str(ours)) == tree(str(theirs))
+
+
+def test_redirections(tmpdir):
+    utilities = template.Utilities()
+    out = str(tmpdir.join('out'))
+    assert utilities.call([['echo', 'a']], 'echo a', {}, stdout=out) == 0
+    assert utilities.call([['echo', 'b']], 'echo b', {}, stdout=out, append=True) == 0
+    assert tmpdir.join('out').read() == 'a\nb\n'
+    assert utilities.call([['echo', 'c']], 'echo c', {}, stdout=out) == 0
+    assert tmpdir.join('out').read() == 'c\n'
+    assert utilities.stats['in_process'] == 3
+
+
+def test_redirection_to_unwritable_file(tmpdir, capfd):
+    utilities = template.Utilities()
+    path = str(tmpdir.join('missing', 'out'))
+    assert utilities.call([['echo', 'a']], 'echo a', {}, stdout=path) == 1
+    assert path in capfd.readouterr()[1]
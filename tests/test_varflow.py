@@ -0,0 +1,185 @@
+'''
+Constant folding must not change what the generated main() does.
+'''
+
+import ast
+import copy
+import textwrap
+
+import pytest
+
+import template
+import varflow
+
+# Each runs with FLAG unset, and set to yes, which the folder can't know.
+PROGRAMS = {
+    'straight-line': '''
+        vars["A"] = "x"
+        vars["B"] = Format("{A}-y")(vars, {})
+        if vars.get("B", "") == "x-y":
+            vars["C"] = "1"
+        else:
+            vars["C"] = "2"
+        ''',
+    'case': '''
+        vars["OS"] = "Linux"
+        case = Format("{OS}")(vars, {})
+        _arm = CaseDispatch([("Darwin",), ("Lin*", "Free*"), ("*ux",)])(case)
+        if _arm == 0:
+            vars["KIND"] = "mac"
+        elif _arm == 1:
+            vars["KIND"] = "unix"
+        elif _arm == 2:
+            vars["KIND"] = "other"
+        else:
+            vars["KIND"] = "none"
+        vars["R"] = Format("{KIND}/{OS}")(vars, {})
+        ''',
+    'case-runtime-arm': '''
+        vars["OS"] = "Linux"
+        case = Format("{OS}")(vars, {})
+        _arm = CaseDispatch([None, ("Linux",)])(case, {0: lambda: [Format("{FLAG}")(vars, {})]})
+        if _arm == 0:
+            vars["KIND"] = "flag"
+        elif _arm == 1:
+            vars["KIND"] = "linux"
+        ''',
+    'write-in-branch': '''
+        vars["A"] = "x"
+        if vars.get("FLAG", "") == "yes":
+            vars["A"] = "y"
+        vars["B"] = Format("{A}")(vars, {})
+        if vars.get("A", "") == "x":
+            vars["C"] = "still x"
+        ''',
+    'same-write-in-both-branches': '''
+        if vars.get("FLAG", "") == "yes":
+            vars["A"] = "z"
+            vars["D"] = "1"
+        else:
+            vars["A"] = "z"
+            vars["D"] = "2"
+        vars["B"] = Format("{A}{D}")(vars, {})
+        ''',
+    'write-in-loop': '''
+        vars["A"] = "0"
+        for X in for_loop([Format("a b"), quoted(Format("{FLAG} c"))], vars, {}):
+            vars["X"] = X
+            vars["A"] = Format("{A}{X}")(vars, {})
+        vars["B"] = Format("{A}")(vars, {})
+        ''',
+    'loop-over-known-words': '''
+        vars["WORDS"] = "p q"
+        vars["OUT"] = ""
+        for X in for_loop([Format("{WORDS}"), quoted(Format("{WORDS}"))], vars, {}):
+            vars["X"] = X
+            vars["OUT"] = Format("{OUT}[{X}]")(vars, {})
+        ''',
+    'unset': '''
+        vars["A"] = "x"
+        del vars["A"]
+        vars["B"] = Format("<{A}>")(vars, {})
+        ''',
+    'command-output': '''
+        vars["A"] = "x"
+        vars["B"] = Format("{A}{cmd0}")(vars, {"cmd0": "out"})
+        vars["C"] = Format("{A}{cmd0}")(vars, {"cmd0": vars.get("FLAG", "")})
+        ''',
+    'alias': '''
+        vars["A"] = "x"
+        env = vars
+        env["A"] = "y"
+        vars["B"] = Format("{A}")(vars, {})
+        ''',
+    'update': '''
+        vars["A"] = "x"
+        vars.update({"A": "y"})
+        vars["B"] = Format("{A}")(vars, {})
+        ''',
+    'keyword': '''
+        vars["A"] = "x"
+        change(env=vars)
+        vars["B"] = Format("{A}")(vars, {})
+        ''',
+}
+
+
+def change(env):
+    env['A'] = 'changed'
+
+
+def parse(source):
+    return ast.parse(textwrap.dedent(source)).body
+
+
+def run(statements, flag):
+    namespace = {
+        'Format': template.Format,
+        'CaseDispatch': template.CaseDispatch,
+        'for_loop': template.for_loop,
+        'quoted': template.quoted,
+        'change': change,
+        'vars': template.Vars(),
+    }
+    if flag:
+        namespace['vars']['FLAG'] = flag
+    module = ast.fix_missing_locations(ast.Module(statements))
+    exec compile(module, '<generated>', 'exec') in namespace
+    return dict(namespace['vars'])
+
+
+def fold(statements):
+    folder = varflow.ConstantFolder()
+    folded = []
+    for stmt in statements:
+        folded.extend(folder.fold_statement(stmt))
+    return folded, folder
+
+
+@pytest.mark.parametrize('flag', ['', 'yes'])
+@pytest.mark.parametrize('name', sorted(PROGRAMS))
+def test_folding_keeps_results(name, flag):
+    statements = parse(PROGRAMS[name])
+    folded, folder = fold(copy.deepcopy(statements))
+    assert run(folded, flag) == run(statements, flag)
+
+
+def test_folds_known_values():
+    folded, folder = fold(parse(PROGRAMS['straight-line']))
+    # The if is gone, as its test is known.
+    assert not any(isinstance(stmt, ast.If) for stmt in folded)
+    assert folder.stats['branches_removed'] == 1
+    folded, folder = fold(parse(PROGRAMS['case']))
+    assert ast.dump(folded[-1].value) == ast.dump(ast.Str('unix/Linux'))
+
+
+@pytest.mark.parametrize('name', ['alias', 'update', 'keyword'])
+def test_forgets_after_other_uses_of_vars(name):
+    folded, folder = fold(parse(PROGRAMS[name]))
+    # B is still computed at runtime.
+    assert not isinstance(folded[-1].value, ast.Str)
+
+
+@pytest.mark.parametrize('code', [
+    'env = vars',
+    'vars.update({})',
+    'vars.setdefault("A", "")',
+    'vars.pop("A")',
+    'change(env=vars)',
+    'change(vars)',
+    'vars = {}',
+    'vars[name] = ""',
+])
+def test_written_vars_gives_up(code):
+    assert varflow.written_vars(ast.parse(code).body[0]) is None
+
+
+@pytest.mark.parametrize('code,written', [
+    ('vars["A"] = vars.get("B", "")', set(['A'])),
+    ('del vars["A"]', set(['A'])),
+    ('subprocess.call("x", shell=True, env=vars)', set()),
+    ('utilities.call([], "x", vars)', set()),
+    ('sys.stdout.write(Format("{A}")(vars, {}))', set()),
+])
+def test_written_vars(code, written):
+    assert varflow.written_vars(ast.parse(code).body[0]) == written
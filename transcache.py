@@ -0,0 +1,74 @@
+'''
+On-disk cache of translation results, used to retranslate only the parts
+of a configure.in that changed since the last run.
+'''
+
+import cPickle as pickle
+import errno
+import hashlib
+import os
+import tempfile
+from collections import Counter
+
+class TranslationCache(object):
+    '''
+    Maps content hashes to pickled values, one file per entry under
+    `directory`. `salt` is mixed into every key, so entries written by a
+    different version of the translator are never found.
+    '''
+    def __init__(self, directory, salt=''):
+        self.directory = directory
+        self.salt = salt
+        self.stats = Counter()
+
+    def key(self, kind, *parts):
+        h = hashlib.sha1(self.salt)
+        for p in parts:
+            h.update('%d:' % len(p))
+            h.update(p)
+        return '%s-%s' % (kind, h.hexdigest())
+
+    def path(self, key):
+        kind, digest = key.split('-', 1)
+        return os.path.join(self.directory, kind, digest[:2], digest[2:])
+
+    def get(self, key):
+        '''
+        Returns the value stored under key, or None.
+        '''
+        kind = key.split('-', 1)[0]
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = pickle.load(f)
+        except Exception:
+            # A missing, truncated or otherwise unreadable entry is a miss.
+            value = None
+        self.stats['%s_cache_%s' % (kind, 'misses' if value is None else 'hits')] += 1
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file and rename it into place so concurrent
+        # runs never see a partial entry.
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def report(self, stream):
+        for kind in ('macro', 'chunk'):
+            hits = self.stats['%s_cache_hits' % kind]
+            total = hits + self.stats['%s_cache_misses' % kind]
+            if total:
+                stream.write('%s cache: reused %d of %d (%.1f%%)\n' %
+                             (kind, hits, total, 100.0 * hits / total))
@@ -0,0 +1,466 @@
+'''
+Helpers for finding out which configure variables (keys of `vars` in the
+generated script) a piece of translated Python code touches, and a pass
+folding the variables whose values are known at translation time.
+'''
+
+import ast
+import fnmatch
+import operator
+import string
+from collections import Counter
+
+# Classes of the generated script's template whose instances are compiled
+# forms of their arguments, and are called to use them.
+COMPILED_CONSTRUCTORS = set([
+    'Format',
+    'CaseDispatch',
+])
+
+# Functions of the generated script and its template that take `vars` as
+# an argument without modifying it.
+READONLY_VAR_FUNCTIONS = set([
+    'Format()',
+    'for_loop',
+    'probes.submit',
+    'config_cache.lookup',
+    'config_cache.store',
+    'utilities.call',
+    'substitutions.output',
+    'subprocess.call',
+    'subprocess.check_output',
+])
+
+# Methods of `vars` that don't modify it.
+READONLY_VAR_METHODS = set([
+    'get',
+    'keys',
+    'items',
+    'iteritems',
+    'copy',
+])
+
+def call_name(call):
+    '''
+    Returns the dotted name of the function called by an ast.Call, or None
+    if it isn't a plain (dotted) name. Calling an instance of one of
+    COMPILED_CONSTRUCTORS, as in Format('...')(vars, {}), is called
+    'Format()'.
+    '''
+    parts = []
+    f = call.func
+    if isinstance(f, ast.Call):
+        name = call_name(f)
+        if name in COMPILED_CONSTRUCTORS:
+            return name + '()'
+        return None
+    while isinstance(f, ast.Attribute):
+        parts.append(f.attr)
+        f = f.value
+    if not isinstance(f, ast.Name):
+        return None
+    parts.append(f.id)
+    return '.'.join(reversed(parts))
+
+def is_literal(node):
+    '''
+    Returns whether node is a constant, or a list or tuple of them.
+    '''
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return all(is_literal(e) for e in node.elts)
+    return constant_value(node)[0]
+
+def is_vars(node):
+    return isinstance(node, ast.Name) and node.id == 'vars'
+
+def subscript_key(node):
+    '''
+    For vars['X'], returns 'X'. Returns None for a subscript of vars with a
+    computed key.
+    '''
+    if isinstance(node.slice, ast.Index) and isinstance(node.slice.value, ast.Str):
+        return node.slice.value.s
+    return None
+
+def written_vars(node):
+    '''
+    Returns the set of variables that node may assign or delete, or None if
+    that can't be determined, for instance because a key is computed at
+    runtime, vars is passed to a function that may change it, one of its
+    methods that modify it is called, or it is used in any other way, like
+    being rebound or aliased.
+    '''
+    written = set()
+    # The uses of vars accounted for.
+    seen = set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Subscript) and is_vars(n.value):
+            seen.add(id(n.value))
+            if isinstance(n.ctx, (ast.Store, ast.Del)):
+                key = subscript_key(n)
+                if key is None:
+                    return None
+                written.add(key)
+        elif isinstance(n, ast.Attribute) and is_vars(n.value):
+            if n.attr not in READONLY_VAR_METHODS:
+                return None
+            seen.add(id(n.value))
+        elif isinstance(n, ast.Call):
+            passed = [a for a in n.args + [k.value for k in n.keywords] if is_vars(a)]
+            if passed and call_name(n) not in READONLY_VAR_FUNCTIONS:
+                return None
+            seen.update(id(a) for a in passed)
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and n.id == 'vars' and id(n) not in seen:
+            return None
+    return written
+
+def read_vars(node, call_reads=lambda call: None):
+    '''
+    Returns the set of variables that node may read, or None if that can't
+    be determined. call_reads(call) gives the variables read by a call
+    passed vars that isn't a Format or for_loop, or None if it could read
+    any of them.
+    '''
+    read = set()
+    seen = set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Subscript) and is_vars(n.value):
+            key = subscript_key(n)
+            if key is None:
+                return None
+            read.add(key)
+            seen.add(id(n.value))
+        elif isinstance(n, ast.Call):
+            name = call_name(n)
+            if name == 'vars.get':
+                if not n.args or not isinstance(n.args[0], ast.Str):
+                    return None
+                read.add(n.args[0].s)
+                seen.add(id(n.func.value))
+            elif name == 'Format':
+                if not n.args or not isinstance(n.args[0], ast.Str):
+                    return None
+                read.update(format_fields(n.args[0].s))
+            passed = [a for a in n.args + [k.value for k in n.keywords] if is_vars(a)]
+            if not passed:
+                continue
+            if name not in ('Format()', 'for_loop'):
+                reads = call_reads(n)
+                if reads is None:
+                    return None
+                read.update(reads)
+            seen.update(id(a) for a in passed)
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and n.id == 'vars' and id(n) not in seen:
+            # vars used in some other way
+            return None
+    return read
+
+def calls(node):
+    '''
+    Yields the dotted names of all functions called in node. Calls to
+    anything else than a dotted name yield None.
+    '''
+    for n in ast.walk(node):
+        if isinstance(n, ast.Call):
+            yield call_name(n)
+
+def assigned_names(node):
+    '''
+    Returns the set of local names node assigns or deletes.
+    '''
+    return set(n.id for n in ast.walk(node)
+               if isinstance(n, ast.Name) and not isinstance(n.ctx, ast.Load))
+
+def loaded_names(node):
+    return set(n.id for n in ast.walk(node)
+               if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load))
+
+
+FORMATTER = string.Formatter()
+
+def format_fields(template):
+    '''
+    Returns the names of the fields of a format string.
+    '''
+    return set(field for literal, field, spec, conversion in FORMATTER.parse(template)
+               if field is not None)
+
+COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+def constant(value):
+    if isinstance(value, bool):
+        return ast.Name(str(value), ast.Load())
+    if isinstance(value, (int, long)):
+        return ast.Num(value)
+    return ast.Str(value)
+
+def constant_value(node):
+    '''
+    Returns (True, value) if node is a constant, (False, None) otherwise.
+    '''
+    if isinstance(node, ast.Str):
+        return True, node.s
+    if isinstance(node, ast.Num):
+        return True, node.n
+    if isinstance(node, ast.Name) and node.id in ('True', 'False', 'None'):
+        return True, {'True': True, 'False': False, 'None': None}[node.id]
+    return False, None
+
+def escape(s):
+    return s.replace('{', '{{').replace('}', '}}')
+
+class ConstantFolder(ast.NodeTransformer):
+    '''
+    Follows the straight-line code of the generated main() to find the
+    variables that hold known strings, and replaces reads of them with the
+    strings. Tests that become constant, like case statements on a known
+    word, are evaluated, and the branches they rule out
+    are removed.
+
+    Variables are known from an assignment of a constant until anything
+    that may change them. After an if, only what both branches agree on
+    is known; a for loop forgets everything its body may set.
+
+    What may change them is what written_vars() finds, so this relies on
+    the generated code only writing to vars through vars['NAME'] = ...
+    and del vars['NAME']. Any other use of vars that could change it makes
+    written_vars() give up, and everything known is forgotten.
+    '''
+    def __init__(self):
+        self.known = {}
+        self.names = {}
+        self.stats = Counter()
+
+    def fold(self, statements):
+        out = []
+        for stmt in statements:
+            out.extend(self.fold_statement(stmt))
+        return out
+
+    def forget(self, node):
+        written = written_vars(node)
+        if written is None:
+            self.known.clear()
+        else:
+            for var in written:
+                self.known.pop(var, None)
+        for name in assigned_names(node):
+            self.names.pop(name, None)
+
+    def fold_statement(self, stmt):
+        if isinstance(stmt, ast.If):
+            return self.fold_if(stmt)
+        if isinstance(stmt, ast.For):
+            stmt.iter = self.visit(stmt.iter)
+            self.forget(stmt)
+            known, names = dict(self.known), dict(self.names)
+            stmt.body = self.fold(stmt.body) or [ast.Pass()]
+            self.known, self.names = known, names
+            return [stmt]
+        if isinstance(stmt, ast.Assign):
+            stmt.value = self.visit(stmt.value)
+            self.forget(stmt)
+            is_constant, value = constant_value(stmt.value)
+            if is_constant and len(stmt.targets) == 1:
+                target = stmt.targets[0]
+                if isinstance(target, ast.Subscript) and is_vars(target.value):
+                    key = subscript_key(target)
+                    if key is not None and isinstance(value, basestring):
+                        self.known[key] = value
+                elif isinstance(target, ast.Name) and value is not None:
+                    # the word of a case statement, or the number of the
+                    # arm it matched
+                    self.names[target.id] = value
+            return [stmt]
+        if isinstance(stmt, (ast.Expr, ast.Print)):
+            stmt = self.visit(stmt)
+        self.forget(stmt)
+        return [stmt]
+
+    def fold_if(self, stmt):
+        stmt.test = self.visit(stmt.test)
+        is_constant, value = constant_value(stmt.test)
+        if is_constant:
+            self.stats['branches_removed'] += 1
+            return self.fold(stmt.body if value else stmt.orelse)
+        known, names = dict(self.known), dict(self.names)
+        stmt.body = self.fold(stmt.body) or [ast.Pass()]
+        body_known, body_names = self.known, self.names
+        self.known, self.names = known, names
+        stmt.orelse = self.fold(stmt.orelse)
+        self.known = dict((k, v) for k, v in self.known.iteritems()
+                          if body_known.get(k) == v)
+        self.names = dict((k, v) for k, v in self.names.iteritems()
+                          if body_names.get(k) == v)
+        return [stmt]
+
+    # Expressions
+
+    def generic_visit(self, node):
+        if isinstance(node, (ast.Lambda, ast.GeneratorExp, ast.ListComp)):
+            return node
+        return ast.NodeTransformer.generic_visit(self, node)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.names:
+            return constant(self.names[node.id])
+        return node
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        if isinstance(node.ctx, ast.Load) and is_vars(node.value):
+            key = subscript_key(node)
+            if key in self.known:
+                self.stats['constants_folded'] += 1
+                return ast.Str(self.known[key])
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        is_constant, value = constant_value(node.operand)
+        if is_constant and isinstance(node.op, ast.Not):
+            return constant(not value)
+        return node
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        stop = bool if isinstance(node.op, ast.Or) else operator.not_
+        values = []
+        for i, v in enumerate(node.values):
+            is_constant, value = constant_value(v)
+            if is_constant and stop(value):
+                # Evaluation stops here, with this value.
+                values.append(v)
+                break
+            if is_constant and i < len(node.values) - 1:
+                # Evaluation goes on to the next value.
+                continue
+            values.append(v)
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def compare(self, node, left, op, right):
+        left_constant, left = constant_value(left)
+        right_constant, right = constant_value(right)
+        if left_constant and right_constant and type(op) in COMPARISONS:
+            return constant(COMPARISONS[type(op)](left, right))
+        return node
+
+    def visit_BinOp(self, node):
+        # test(1) comparisons are translated as BinOps.
+        self.generic_visit(node)
+        return self.compare(node, node.left, node.op, node.right)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) != 1:
+            return node
+        return self.compare(node, node.left, node.ops[0], node.comparators[0])
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        name = call_name(node)
+        if name == 'vars.get' and len(node.args) == 2:
+            key_constant, key = constant_value(node.args[0])
+            if key_constant and key in self.known:
+                self.stats['constants_folded'] += 1
+                return ast.Str(self.known[key])
+        elif name == 'Format()':
+            return self.fold_format_call(node)
+        elif name == 'CaseDispatch()':
+            return self.fold_case_dispatch(node)
+        elif name == 'for_loop':
+            return self.fold_for_loop(node)
+        return node
+
+    def fold_case_dispatch(self, node):
+        '''
+        Evaluates a CaseDispatch of a known word, up to the first arm with
+        patterns only known at runtime.
+        '''
+        word_constant, word = constant_value(node.args[0])
+        arms = node.func.args[0]
+        if not word_constant or not isinstance(arms, ast.List):
+            return node
+        for i, arm in enumerate(arms.elts):
+            if not isinstance(arm, ast.Tuple):
+                return node
+            if any(fnmatch.fnmatchcase(word, p.s) for p in arm.elts):
+                return ast.Num(i)
+        return ast.Num(-1)
+
+    def fold_template(self, template, extra):
+        '''
+        Fills the known variables and constant extra values into a format
+        string. Returns the new format string, and whether nothing is left
+        to fill in at runtime.
+        '''
+        out = []
+        complete = True
+        for literal, field, spec, conversion in FORMATTER.parse(template):
+            if spec or conversion:
+                return template, False
+            out.append(escape(literal))
+            if field is None:
+                continue
+            if field in extra:
+                is_constant, value = constant_value(extra[field])
+            else:
+                is_constant = field in self.known
+                value = self.known.get(field)
+                if is_constant:
+                    self.stats['constants_folded'] += 1
+            if is_constant:
+                out.append(escape(value))
+            else:
+                out.append('{%s}' % field)
+                complete = False
+        return ''.join(out), complete
+
+    def format_extra(self, node):
+        '''
+        Returns the extra values of a Format() or for_loop() call by name,
+        and whether they are all constants.
+        '''
+        extra = dict((k.s, v) for k, v in zip(node.keys, node.values))
+        return extra, all(constant_value(v)[0] for v in node.values)
+
+    def fold_format_call(self, node):
+        template = node.func.args[0]
+        if not isinstance(template, ast.Str) or not isinstance(node.args[1], ast.Dict):
+            return node
+        extra, constant_extra = self.format_extra(node.args[1])
+        template.s, complete = self.fold_template(template.s, extra)
+        if complete and constant_extra:
+            return ast.Str(template.s.replace('{{', '{').replace('}}', '}'))
+        return node
+
+    def fold_for_loop(self, node):
+        items, extra = node.args[0], node.args[2]
+        if not isinstance(items, ast.List) or not isinstance(extra, ast.Dict):
+            return node
+        extra, all_complete = self.format_extra(extra)
+        words = []
+        for item in items.elts:
+            quoted = call_name(item) == 'quoted'
+            template = (item.args[0] if quoted else item).args[0]
+            if not isinstance(template, ast.Str):
+                return node
+            template.s, complete = self.fold_template(template.s, extra)
+            value = template.s.replace('{{', '{').replace('}}', '}')
+            words.extend([value] if quoted else value.split())
+            all_complete = all_complete and complete
+        if all_complete:
+            return ast.List([ast.Str(w) for w in words], ast.Load())
+        return node